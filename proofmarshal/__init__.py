@@ -20,7 +20,7 @@ Provides serialization and deserialization for complex, immutable,
 cryptographic proofs.
 """
 
-class ProofmarshalError:
+class ProofmarshalError(Exception):
     """Base class for all proofmarshal-related errors"""
 
 class DeserializationError(ProofmarshalError):
@@ -29,6 +29,33 @@ class DeserializationError(ProofmarshalError):
 class DataTruncatedError(DeserializationError):
     """Truncated data encountered while deserializing"""
 
+class DeserializationLimitError(DeserializationError):
+    """Resource limit exceeded while deserializing"""
+
+class DeserializationLimits:
+    """Resource limits for deserializing untrusted data
+
+    max_total_bytes   - maximum number of bytes read in total
+    max_bytes_length  - maximum length of a single variable-length bytes field
+    max_varuint_bytes - maximum number of bytes in a single varuint
+    max_depth         - maximum nesting depth of objects and tree nodes
+    max_objs          - maximum number of objects deserialized
+
+    A limit of None means no limit.
+    """
+
+    def __init__(self, *,
+                 max_total_bytes=None,
+                 max_bytes_length=None,
+                 max_varuint_bytes=None,
+                 max_depth=None,
+                 max_objs=None):
+        self.max_total_bytes = max_total_bytes
+        self.max_bytes_length = max_bytes_length
+        self.max_varuint_bytes = max_varuint_bytes
+        self.max_depth = max_depth
+        self.max_objs = max_objs
+
 class SerializationContext:
     """Context for serialization
 
@@ -65,6 +92,14 @@ class DeserializationContext:
     def read_obj(self, attr_name, serialization_class=None):
         raise NotImplementedError
 
+    def enter_node(self):
+        """Enter a nested node of the structure being deserialized"""
+        pass
+
+    def leave_node(self):
+        """Leave a nested node of the structure being deserialized"""
+        pass
+
 class StreamSerializationContext(SerializationContext):
     def __init__(self, fd):
         self.fd = fd
@@ -109,10 +144,38 @@ class StreamSerializationContext(SerializationContext):
         serialization_class.ctx_serialize(value, self)
 
 class StreamDeserializationContext(DeserializationContext):
-    def __init__(self, fd):
+    def __init__(self, fd, limits=None):
         self.fd = fd
 
+        if limits is None:
+            limits = DeserializationLimits()
+        self.limits = limits
+
+        self.bytes_read = 0
+        self.objs_read = 0
+        self.depth = 0
+
+    def _account_read(self, l):
+        """Account for l bytes about to be read
+
+        Checked prior to reading so that a bogus length can't make us
+        allocate an arbitrary amount of memory.
+        """
+        if self.limits.max_total_bytes is not None \
+                and self.bytes_read + l > self.limits.max_total_bytes:
+            raise DeserializationLimitError('total bytes read would exceed limit of %d bytes' % \
+                                                self.limits.max_total_bytes)
+        self.bytes_read += l
+
+    def _check_varuint_length(self, shift):
+        """Check that another byte of a varuint may be read"""
+        if self.limits.max_varuint_bytes is not None \
+                and shift // 7 >= self.limits.max_varuint_bytes:
+            raise DeserializationLimitError('varuint longer than limit of %d bytes' % \
+                                                self.limits.max_varuint_bytes)
+
     def fd_read(self, l):
+        self._account_read(l)
         r = self.fd.read(l)
         if len(r) != l:
             raise DataTruncatedError('Tried to read %d bytes but only read %d bytes' % \
@@ -124,6 +187,7 @@ class StreamDeserializationContext(DeserializationContext):
         shift = 0
 
         while True:
+            self._check_varuint_length(shift)
             b = self.fd_read(1)[0]
             value |= (b & 0b01111111) << shift
             if not (b & 0b10000000):
@@ -135,10 +199,81 @@ class StreamDeserializationContext(DeserializationContext):
     def read_bytes(self, attr_name, expected_length=None):
         if expected_length is None:
             expected_length = self.read_varuint(None)
+
+            if self.limits.max_bytes_length is not None \
+                    and expected_length > self.limits.max_bytes_length:
+                raise DeserializationLimitError('bytes length %d exceeds limit of %d bytes' % \
+                                                    (expected_length, self.limits.max_bytes_length))
+
         return self.fd_read(expected_length)
 
+    def enter_node(self):
+        """Enter a nested node of the structure being deserialized
+
+        Must be paired with a call to leave_node()
+        """
+        self.depth += 1
+        if self.limits.max_depth is not None and self.depth > self.limits.max_depth:
+            raise DeserializationLimitError('nesting depth exceeds limit of %d' % \
+                                                self.limits.max_depth)
+
+    def leave_node(self):
+        self.depth -= 1
+        assert self.depth >= 0
+
     def read_obj(self, attr_name, serialization_class):
-        return serialization_class.ctx_deserialize(self)
+        self.objs_read += 1
+        if self.limits.max_objs is not None and self.objs_read > self.limits.max_objs:
+            raise DeserializationLimitError('number of objects exceeds limit of %d' % \
+                                                self.limits.max_objs)
+
+        self.enter_node()
+        try:
+            return serialization_class.ctx_deserialize(self)
+        finally:
+            self.leave_node()
+
+class BufferDeserializationContext(StreamDeserializationContext):
+    """Deserialize directly from a buffer
+
+    Any object supporting slicing and indexing will do, such as bytes or an
+    mmap. Avoids the overhead of a file object, which matters as
+    deserialization does many small reads.
+    """
+    def __init__(self, buf, limits=None):
+        super().__init__(None, limits=limits)
+        self.buf = buf
+        self.pos = 0
+
+    def fd_read(self, l):
+        self._account_read(l)
+        r = bytes(self.buf[self.pos:self.pos + l])
+        if len(r) != l:
+            raise DataTruncatedError('Tried to read %d bytes but only read %d bytes' % \
+                                        (l, len(r)))
+        self.pos += l
+        return r
+
+    def read_varuint(self, attr_name):
+        value = 0
+        shift = 0
+
+        while True:
+            # Inlines fd_read(1), as varuints are read byte by byte
+            self._check_varuint_length(shift)
+            self._account_read(1)
+            try:
+                b = self.buf[self.pos]
+            except IndexError:
+                raise DataTruncatedError('Tried to read 1 bytes but only read 0 bytes')
+            self.pos += 1
+
+            value |= (b & 0b01111111) << shift
+            if not (b & 0b10000000):
+                break
+            shift += 7
+
+        return value
 
 class BytesSerializationContext(StreamSerializationContext):
     def __init__(self):
@@ -149,8 +284,8 @@ class BytesSerializationContext(StreamSerializationContext):
         return self.fd.getvalue()
 
 class BytesDeserializationContext(StreamDeserializationContext):
-    def __init__(self, buf):
-        super().__init__(io.BytesIO(buf))
+    def __init__(self, buf, limits=None):
+        super().__init__(io.BytesIO(buf), limits=limits)
 
     # FIXME: need to check that there isn't extra crap at end of object
 
@@ -245,9 +380,9 @@ class Serializer:
         return ctx.getbytes()
 
     @classmethod
-    def stream_deserialize(cls, fd):
+    def stream_deserialize(cls, fd, limits=None):
         """Deserialize from a stream"""
-        ctx = StreamDeserializationContext(fd)
+        ctx = StreamDeserializationContext(fd, limits=limits)
         return cls.ctx_deserialize(ctx)
 
     @classmethod
@@ -257,9 +392,9 @@ class Serializer:
         self.ctx_serialize(ctx)
 
     @classmethod
-    def deserialize(cls, buf):
+    def deserialize(cls, buf, limits=None):
         """Deserialize from bytes"""
-        ctx = BytesDeserializationContext(buf)
+        ctx = BytesDeserializationContext(buf, limits=limits)
         return cls.ctx_deserialize(ctx)
 
     @classmethod
@@ -281,6 +416,18 @@ class Serializer:
         cls.ctx_serialize(self, ctx)
         return hmac.HMAC(cls.HASH_HMAC_KEY, ctx.getbytes(), hashlib.sha256).digest()
 
+def _unpickle_immutable_proof(cls, buf, cached_attrs):
+    """Recreate an ImmutableProof pickled by ImmutableProof.__reduce__()"""
+    import proofmarshal.memoize
+
+    ctx = proofmarshal.memoize.MemoizedStreamDeserializationContext(io.BytesIO(buf))
+    self = ctx.read_obj(None, cls)
+
+    for attr_name, value in cached_attrs.items():
+        object.__setattr__(self, attr_name, value)
+
+    return self
+
 class ImmutableProof:
     """Base class for immutable proof objects
 
@@ -290,6 +437,10 @@ class ImmutableProof:
 
     HASH_HMAC_KEY = None
 
+    # Cached attributes that are carried along when pickling, saving the
+    # unpickler from having to recalculate them.
+    PICKLED_CACHED_ATTRS = ('_cached_hash',)
+
     def __setattr__(self, name, value):
         raise AttributeError('Object is immutable')
 
@@ -312,9 +463,9 @@ class ImmutableProof:
         return ctx.getbytes()
 
     @classmethod
-    def stream_deserialize(cls, fd):
+    def stream_deserialize(cls, fd, limits=None):
         """Deserialize from a stream"""
-        ctx = StreamDeserializationContext(fd)
+        ctx = StreamDeserializationContext(fd, limits=limits)
         return cls.ctx_deserialize(ctx)
 
     def stream_serialize(self, fd):
@@ -323,9 +474,9 @@ class ImmutableProof:
         self.ctx_serialize(ctx)
 
     @classmethod
-    def deserialize(cls, buf):
+    def deserialize(cls, buf, limits=None):
         """Deserialize from bytes"""
-        ctx = BytesDeserializationContext(buf)
+        ctx = BytesDeserializationContext(buf, limits=limits)
         return cls.ctx_deserialize(ctx)
 
     def json_serialize(self):
@@ -353,6 +504,24 @@ class ImmutableProof:
             object.__setattr__(self, '_cached_hash', self.calc_hash())
             return self._cached_hash
 
+    def __reduce__(self):
+        # Pickled as the memoized proofmarshal serialization, which is both
+        # compact and the only way to construct an immutable object.
+        import proofmarshal.memoize
+
+        fd = io.BytesIO()
+        ctx = proofmarshal.memoize.MemoizedStreamSerializationContext(fd)
+        ctx.write_obj(None, self)
+
+        cached_attrs = {}
+        for attr_name in self.PICKLED_CACHED_ATTRS:
+            try:
+                cached_attrs[attr_name] = getattr(self, attr_name)
+            except AttributeError:
+                pass
+
+        return (_unpickle_immutable_proof, (self.__class__, fd.getvalue(), cached_attrs))
+
     def __hash__(self):
         return hash(self.hash)
 
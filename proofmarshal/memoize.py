@@ -20,15 +20,18 @@ class MemoizedStreamSerializationContext(proofmarshal.StreamSerializationContext
 
         self.serialized_objs = {}
 
+    def _memo_key(self, obj, serialization_class):
+        """Key identifying objects that only need to be serialized once"""
+        if serialization_class is None:
+            return obj.hash
+        else:
+            return serialization_class.calc_hash(obj)
+
     def write_obj(self, attr_name, obj, serialization_class=None):
-        obj_hash = None
+        obj_hash = self._memo_key(obj, serialization_class)
         if serialization_class is None:
-            obj_hash = obj.hash
             serialization_class = obj.__class__
 
-        else:
-            obj_hash = serialization_class.calc_hash(obj)
-
         if obj_hash in self.serialized_objs:
             idx = self.serialized_objs[obj_hash]
             assert idx > 0
@@ -44,13 +47,16 @@ class MemoizedStreamSerializationContext(proofmarshal.StreamSerializationContext
 
 class MemoizedStreamDeserializationContext(proofmarshal.StreamDeserializationContext):
     """Memoized deserialization of a stream"""
-    def __init__(self, fd):
-        super().__init__(fd)
+    def __init__(self, fd, limits=None):
+        super().__init__(fd, limits=limits)
         self.deserialized_objs = []
 
     def read_obj(self, attr_name, deserialization_class):
         idx = self.read_varuint(None)
         if idx:
+            if idx > len(self.deserialized_objs):
+                raise proofmarshal.DeserializationError('memoized object index %d out of range' % idx)
+
             obj = self.deserialized_objs[idx-1]
             return obj
 
@@ -59,3 +65,8 @@ class MemoizedStreamDeserializationContext(proofmarshal.StreamDeserializationCon
             self.deserialized_objs.append(obj)
             idx = len(self.deserialized_objs)
             return obj
+
+class MemoizedBufferDeserializationContext(MemoizedStreamDeserializationContext,
+                                           proofmarshal.BufferDeserializationContext):
+    """Memoized deserialization of a buffer"""
+    pass
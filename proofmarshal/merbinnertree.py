@@ -93,15 +93,21 @@ class MerbinnerTree(proofmarshal.ImmutableProof, dict):
                 left_sum = do_recurse(left_items)
                 right_sum = do_recurse(right_items)
 
-                return self.sum_func(left_sum, right_sum)
+                if sum_needed:
+                    return self.sum_func(left_sum, right_sum)
+                return None
 
-        items = [(self.key_gethash(key), key, value, self.value_getsum(value)) for key, value in self.items()]
+        # Sums are only serialized while hashing, and finding them may be
+        # expensive, so don't otherwise.
+        sum_needed = isinstance(ctx, proofmarshal.HashSerializationContext)
+        items = [(self.key_gethash(key), key, value, self.value_getsum(value) if sum_needed else None)
+                    for key, value in self.items()]
 
         final_sum = recurse(ctx, items, 0)
 
     def _ctx_deserialize(self, ctx):
         items = {}
-        def recurse():
+        def recurse(depth):
             node_type = ctx.read_varuint('type')
 
             if node_type == 0:
@@ -117,10 +123,20 @@ class MerbinnerTree(proofmarshal.ImmutableProof, dict):
 
             elif node_type == 2:
                 # Inner node
-                recurse() # left
-                recurse() # right
+                #
+                # Key hashes are 256 bits, so a valid tree can never be deeper
+                # than that.
+                if depth >= 256:
+                    raise proofmarshal.DeserializationError('merbinnertree too deep')
+
+                ctx.enter_node()
+                try:
+                    recurse(depth+1) # left
+                    recurse(depth+1) # right
+                finally:
+                    ctx.leave_node()
 
             else:
                 raise proofmarshal.DeserializationError('unsupported merbinnertree node type: %d' % node_type)
 
-        recurse()
+        recurse(0)
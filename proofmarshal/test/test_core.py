@@ -174,3 +174,92 @@ class Test_ImmutableProof(unittest.TestCase):
 
         b3 = boxed_objs(b'', 1)
         self.assertNotEqual(b1, b3)
+
+class Test_ImmutableProof_pickle(unittest.TestCase):
+    def test_roundtrip(self):
+        """Pickle roundtrip"""
+        import pickle
+
+        obj = boxed_objs(b'hello world', 42)
+        obj_hash = obj.hash
+
+        obj2 = pickle.loads(pickle.dumps(obj))
+        self.assertIsNot(obj, obj2)
+        self.assertEqual(obj2.buf.buf, b'hello world')
+        self.assertEqual(obj2.i.i, 42)
+
+        # cached hash is carried along
+        self.assertEqual(obj2._cached_hash, obj_hash)
+        self.assertEqual(obj2.calc_hash(), obj_hash)
+
+        with self.assertRaises(AttributeError):
+            obj2.buf = None
+
+class Test_DeserializationLimits(unittest.TestCase):
+    def test_max_bytes_length(self):
+        """Bytes field length limit is checked before reading"""
+        buf = boxed_bytes(b'a'*100).serialize()
+
+        boxed_bytes.deserialize(buf, limits=DeserializationLimits(max_bytes_length=100))
+        with self.assertRaises(DeserializationLimitError):
+            boxed_bytes.deserialize(buf, limits=DeserializationLimits(max_bytes_length=99))
+
+        # A huge claimed length fails without being allocated
+        with self.assertRaises(DeserializationLimitError):
+            boxed_bytes.deserialize(x('ffffffffffffffff7f'), limits=DeserializationLimits(max_bytes_length=1000))
+
+    def test_max_total_bytes(self):
+        buf = boxed_objs(b'a'*10, 1).serialize()
+
+        boxed_objs.deserialize(buf, limits=DeserializationLimits(max_total_bytes=len(buf)))
+        with self.assertRaises(DeserializationLimitError):
+            boxed_objs.deserialize(buf, limits=DeserializationLimits(max_total_bytes=len(buf)-1))
+
+    def test_max_varuint_bytes(self):
+        buf = boxed_varuint(2**21).serialize()
+        self.assertEqual(len(buf), 4)
+
+        boxed_varuint.deserialize(buf, limits=DeserializationLimits(max_varuint_bytes=4))
+        with self.assertRaises(DeserializationLimitError):
+            boxed_varuint.deserialize(buf, limits=DeserializationLimits(max_varuint_bytes=3))
+
+    def test_max_depth_and_objs(self):
+        buf = boxed_objs(b'', 0).serialize()
+
+        boxed_objs.deserialize(buf, limits=DeserializationLimits(max_depth=1))
+        with self.assertRaises(DeserializationLimitError):
+            boxed_objs.deserialize(buf, limits=DeserializationLimits(max_depth=0))
+
+        ctx = BytesDeserializationContext(buf, limits=DeserializationLimits(max_objs=2))
+        ctx.read_obj(None, boxed_bytes)
+        ctx.read_obj(None, boxed_varuint)
+        with self.assertRaises(DeserializationLimitError):
+            ctx.read_obj(None, boxed_varuint)
+
+class Test_BufferDeserializationContext(unittest.TestCase):
+    def test(self):
+        """Same results as deserializing from a stream"""
+        for obj in (boxed_varuint(0), boxed_varuint(2**64), boxed_bytes(b'a'*300), boxed_objs(b'abc', 12345)):
+            buf = obj.serialize()
+            for buf_type in (bytes, bytearray, memoryview):
+                ctx = BufferDeserializationContext(buf_type(buf))
+                obj2 = ctx.read_obj(None, obj.__class__)
+                self.assertEqual(obj2, obj)
+                self.assertEqual(ctx.bytes_read, len(buf))
+                self.assertEqual(ctx.pos, len(buf))
+
+    def test_truncated(self):
+        buf = boxed_objs(b'abc', 2**32).serialize()
+        for i in range(len(buf)):
+            with self.assertRaises(DataTruncatedError):
+                BufferDeserializationContext(buf[:i]).read_obj(None, boxed_objs)
+
+    def test_limits(self):
+        buf = boxed_objs(b'a'*10, 2**21).serialize()
+
+        BufferDeserializationContext(buf, limits=DeserializationLimits(max_total_bytes=len(buf))).read_obj(None, boxed_objs)
+        with self.assertRaises(DeserializationLimitError):
+            BufferDeserializationContext(buf, limits=DeserializationLimits(max_total_bytes=len(buf)-1)).read_obj(None, boxed_objs)
+
+        with self.assertRaises(DeserializationLimitError):
+            BufferDeserializationContext(buf, limits=DeserializationLimits(max_varuint_bytes=2)).read_obj(None, boxed_objs)
@@ -158,3 +158,8 @@ class Test_SummedMerbinnerTree(unittest.TestCase):
                 assert False and "invalid test: unknown mode"
 
             self.assertEqual(b2x(expected_digest), b2x(actual_digest))
+
+    def test_deserialize_too_deep(self):
+        """Hostile deeply nested trees are rejected"""
+        with self.assertRaises(proofmarshal.DeserializationError):
+            BytesBytesMerbinnerTree.deserialize(b'\x02'*257)
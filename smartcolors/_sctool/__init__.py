@@ -19,6 +19,7 @@ import bitcoin.core
 import bitcoin.rpc
 
 import smartcolors.db
+import smartcolors.io
 
 class ParseCOutPointArg(argparse.Action):
     @staticmethod
@@ -55,6 +56,22 @@ def make_arg_parser():
                         default='~/.smartcolors',
                         dest='datadir',
                         help="Data directory")
+    parser.add_argument("--db-backend",
+                        choices=('files', 'log', 'sqlite'),
+                        default='files',
+                        help="Colordb storage backend (default: %(default)s)")
+    parser.add_argument("--utxo-only", action='store_true',
+                        help="Forget colored outputs once they're spent, keeping only the colored UTXO set")
+    parser.add_argument("--index-spends", action='store_true',
+                        help="Index every spend seen by db scan, so colordefs added later can be traced")
+    parser.add_argument("--fsync",
+                        choices=('commit', 'none'),
+                        default='commit',
+                        help="When the files backend syncs changes to disk: once per commit, or never, "
+                             "leaving the db consistent but possibly missing recent commits after a crash "
+                             "(default: %(default)s)")
+    parser.add_argument("--no-deserialization-limits", action='store_true',
+                        help="Don't limit the resources used to read proof, colordef and snapshot files; only safe if they're trusted")
     parser.add_argument("--fee-per-kb",type=float,default=0.0001,
                                  help="Fee-per-kb to use")
     parser.add_argument("--dust",type=float,default=0.0001,
@@ -125,15 +142,37 @@ def main(argv, parser=None):
     args.dust = int(args.dust * bitcoin.core.COIN)
     logging.debug('Dust threshold: %d satoshis' % args.dust)
 
+    if args.no_deserialization_limits:
+        args.file_limits = args.snapshot_limits = None
+    else:
+        args.file_limits = smartcolors.io.DEFAULT_FILE_LIMITS
+        args.snapshot_limits = smartcolors.io.DEFAULT_SNAPSHOT_LIMITS
+
     args.datadir = os.path.expanduser(args.datadir)
 
-    colordb_path = os.path.join(args.datadir, network, 'colordb')
-    logging.debug('Colordb path: %s' % colordb_path)
-    args.colordb = smartcolors.db.PersistentColorProofDb(colordb_path)
+    args.colordb_path = os.path.join(args.datadir, network, 'colordb')
+    logging.debug('Colordb path: %s' % args.colordb_path)
+    args.colordb_class = smartcolors.db.COLORDB_BACKENDS[args.db_backend]
+    args.colordb_kwargs = dict(utxo_only=args.utxo_only,
+                               index_spends=args.index_spends)
+    if args.db_backend == 'files':
+        args.colordb_kwargs['fsync'] = args.fsync == 'commit'
+
+    # Commands that only read the db don't need to wait for, or lock out, a
+    # writer such as a running scan.
+    readonly = not getattr(args, 'writes_colordb', False)
+    try:
+        args.colordb = args.colordb_class(args.colordb_path, readonly=readonly,
+                                           **args.colordb_kwargs)
+    except smartcolors.db.ColorProofDbLockedError as exp:
+        parser.exit(1, 'Could not open colordb: %s\n' % exp)
 
     args.proxy = bitcoin.rpc.Proxy()
 
     if not hasattr(args, 'cmd_func'):
         parser.error('No command specified')
 
-    args.cmd_func(args)
+    try:
+        args.cmd_func(args)
+    finally:
+        args.colordb.close()
@@ -112,7 +112,7 @@ class cmd_decodecolordef:
         parser.set_defaults(cmd_func=self.do)
 
     def do(self, args):
-        colordef = ColorDefFileSerializer.stream_deserialize(args.fd)
+        colordef = ColorDefFileSerializer.stream_deserialize(args.fd, limits=args.file_limits)
 
         print('ColorDef Hash: %s' % b2x(colordef.hash))
         print('VERSION: %d' % colordef.VERSION)
@@ -54,6 +54,11 @@ class cmd_prove:
                 dest='hex_txs',
                 help='Hex-encoded tx')
 
+        parser.add_argument('--prune',
+                action='store_true',
+                dest='prune',
+                help='Prune prevout proofs that do not affect the qty of the outpoint')
+
         parser.add_argument('outpoint', metavar='TXID:N',
                 action=ParseCOutPointArg,
                 help='Transaction outpoint')
@@ -69,10 +74,10 @@ class cmd_prove:
     def do(self, args):
         colordef = None
 
-        db = ColorProofDb()
+        db = ColorProofDb(prune_proofs=args.prune)
 
         for proof_fd in args.colorproof_fds:
-            proof = ColorProofFileSerializer.stream_deserialize(proof_fd)
+            proof = ColorProofFileSerializer.stream_deserialize(proof_fd, limits=args.file_limits)
 
             if colordef is not None:
                 if proof.colordef != colordef:
@@ -84,7 +89,7 @@ class cmd_prove:
             logging.info('Loaded proof: %r' % proof)
 
         if args.colordef_fd is not None:
-            colordef = ColorDefFileSerializer.stream_deserialize(args.colordef_fd)
+            colordef = ColorDefFileSerializer.stream_deserialize(args.colordef_fd, limits=args.file_limits)
             db.addcolordef(colordef)
 
             logging.info('Loaded colordef: %r' % colordef)
@@ -146,7 +151,7 @@ class cmd_decodeproof:
         parser.set_defaults(cmd_func=self.do)
 
     def do(self, args):
-        proof = ColorProofFileSerializer.stream_deserialize(args.fd)
+        proof = ColorProofFileSerializer.file_deserialize(args.fd, limits=args.file_limits)
 
         print('Proof class: %s' % proof.__class__.__name__)
         print('Colordef: %s' % b2x(proof.colordef.hash))
@@ -176,7 +181,7 @@ class cmd_rewriteproof:
         parser.set_defaults(cmd_func=self.do)
 
     def do(self, args):
-        proof = ColorProofFileSerializer.stream_deserialize(args.fd, check_hash=False)
+        proof = ColorProofFileSerializer.stream_deserialize(args.fd, check_hash=False, limits=args.file_limits)
         args.fd.seek(0)
         args.fd.truncate()
         ColorProofFileSerializer.stream_serialize(proof, args.fd)
@@ -187,11 +192,20 @@ class cmd_validateproof:
     def __init__(self, subparsers):
         parser = subparsers.add_parser('validateproof',
                     help='Validate a color proof')
+        parser.add_argument('--budget', metavar='STEPS',
+                type=int,
+                default=None,
+                dest='budget',
+                help='Abort if validation takes more than this many steps')
         parser.add_argument('fd', metavar='FILE',
                 type=argparse.FileType('rb'),
                 help='Color proof file')
         parser.set_defaults(cmd_func=self.do)
 
     def do(self, args):
-        proof = ColorProofFileSerializer.stream_deserialize(args.fd)
-        proof.validate()
+        proof = ColorProofFileSerializer.file_deserialize(args.fd, limits=args.file_limits)
+
+        logging.info('Estimated validation cost: %r' % proof.calc_validation_cost())
+
+        steps = proof.validate(budget=args.budget)
+        logging.info('Valid; took %d steps' % steps)
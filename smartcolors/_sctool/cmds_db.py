@@ -16,38 +16,62 @@
 import argparse
 import logging
 import os
+import shutil
+import time
+
+import proofmarshal
 
 from bitcoin.core import *
 from bitcoin.core.script import *
 from bitcoin.wallet import CBitcoinAddress
 
 from smartcolors.core import *
+from smartcolors.core.db import ColorProofDbConcurrentWriteError
+from smartcolors.core.tracer import ColorTracer
 from smartcolors._sctool import ParseCOutPointArg
-from smartcolors.io import ColorDefFileSerializer
+from smartcolors.io import ColorDefFileSerializer, ColorProofDbSnapshotSerializer
 from smartcolors.db import PersistentColorProofDb
 
+def make_get_tx(proxy):
+    """Make a get_tx() function for tracing that fetches txs over RPC"""
+    # Txs are traced in the order they were mined, so consecutive ones are
+    # often in the same block
+    last_blk = (None, None)
+    def get_tx(txid, height, index):
+        nonlocal last_blk
+        if last_blk[0] != height:
+            last_blk = (height, proxy.getblock(proxy.getblockhash(height)))
+        return last_blk[1].vtx[index]
+    return get_tx
+
 class cmd_db_addcolordef:
     def __init__(self, subparsers):
         parser = subparsers.add_parser('addcolordef',
                     help='Add a color definition to the database')
 
+        parser.add_argument('--trace', action='store_true',
+            help='Follow the color through blocks already scanned with --index-spends')
         parser.add_argument('fd', type=argparse.FileType('rb'), metavar='FILE',
             help='Color definition file')
-        parser.set_defaults(cmd_func=self.do)
+        parser.set_defaults(cmd_func=self.do, writes_colordb=True)
 
     def do(self, args):
-        colordef = ColorDefFileSerializer.stream_deserialize(args.fd)
+        colordef = ColorDefFileSerializer.stream_deserialize(args.fd, limits=args.file_limits)
 
         args.colordb.addcolordef(colordef)
         logging.info('Added colordef: %s' % b2x(colordef.hash))
 
+        if args.trace:
+            stats = args.colordb.trace_colordef(colordef, make_get_tx(args.proxy))
+            logging.info('Trace stats: %r' % stats)
+
 class cmd_db_addtx:
     def __init__(self, subparsers):
         parser = subparsers.add_parser('addtx',
                     help='Add a transaction to the database manually')
         parser.add_argument('txid', type=lx,
             help='Transaction id')
-        parser.set_defaults(cmd_func=self.do)
+        parser.set_defaults(cmd_func=self.do, writes_colordb=True)
 
     def do(self, args):
         tx = args.proxy.getrawtransaction(args.txid)
@@ -59,30 +83,329 @@ class cmd_db_scan:
                     help='Scan the blockchain for colored transactions')
         parser.add_argument('height', type=int,
             help='Starting height')
-        parser.set_defaults(cmd_func=self.do)
+        parser.add_argument('--commit-interval', type=int, default=0, metavar='MS',
+            help='Commit the blocks scanned in the last MS milliseconds together, rather than each block on its own')
+        parser.set_defaults(cmd_func=self.do, writes_colordb=True)
+
+    @staticmethod
+    def rewind(colordb, height):
+        """Disconnect every block at or above height"""
+        tip_height = height
+        while colordb.get_block_hash(tip_height + 1) is not None:
+            tip_height += 1
+
+        while tip_height >= height:
+            blk_hash = colordb.disconnect_block(tip_height)
+            logging.warning('Reorg: disconnected blk %d %s' % (tip_height, b2lx(blk_hash)))
+            tip_height -= 1
+
+    def scan_block(self, args, cur_height):
+        """Scan the block at cur_height, returning the next height to scan"""
+        blk_hash = args.proxy.getblockhash(cur_height)
+
+        stored_blk_hash = args.colordb.get_block_hash(cur_height)
+        if stored_blk_hash == blk_hash:
+            logging.debug('Blk: %d %s already scanned' % (cur_height, b2lx(blk_hash)))
+            return cur_height + 1
+
+        elif stored_blk_hash is not None:
+            self.rewind(args.colordb, cur_height)
+
+        blk = args.proxy.getblock(blk_hash)
+
+        # The block we have below this one may have been reorged out too
+        prev_blk_hash = args.colordb.get_block_hash(cur_height - 1) if cur_height > 0 else None
+        if prev_blk_hash is not None and prev_blk_hash != blk.hashPrevBlock:
+            return cur_height - 1
+
+        logging.info('Blk: %d %s' % (cur_height, b2lx(blk_hash)))
+        args.colordb.addblock(blk, cur_height)
+        return cur_height + 1
 
     def do(self, args):
         cur_height = args.height
-        while cur_height <= args.proxy.getblockcount():
-            blk_hash = args.proxy.getblockhash(cur_height)
-            blk = args.proxy.getblock(blk_hash)
-            logging.info('Blk: %d %s' % (cur_height, b2lx(blk_hash)))
+        tip_height = args.proxy.getblockcount()
+        while cur_height <= tip_height:
+            # Every block scanned within the interval is committed at once;
+            # with no interval each block is committed on its own.
+            with args.colordb.batch():
+                commit_time = time.monotonic() + args.commit_interval / 1000
+                while cur_height <= tip_height:
+                    cur_height = self.scan_block(args, cur_height)
+                    if time.monotonic() >= commit_time:
+                        break
+
+            tip_height = args.proxy.getblockcount()
+
+        if getattr(args.colordb, 'cache', None) is not None:
+            logging.info('Cache stats: %s' % args.colordb.cache)
+
+class cmd_db_trace:
+    def __init__(self, subparsers):
+        parser = subparsers.add_parser('trace',
+                    help='List the outputs currently holding a color by tracing it through the spends index')
+        parser.add_argument('fd', type=argparse.FileType('rb'), metavar='FILE',
+            help='Color definition file')
+        parser.set_defaults(cmd_func=self.do)
+
+    def do(self, args):
+        colordef = ColorDefFileSerializer.stream_deserialize(args.fd, limits=args.file_limits)
 
-            for tx in blk.vtx:
-                args.colordb.addtx(tx)
+        tracer = ColorTracer(colordef, args.colordb.get_spend, make_get_tx(args.proxy))
+        for colorproof in tracer.trace():
+            logging.debug('Reached %s:%d %d' % (b2lx(colorproof.outpoint.hash), colorproof.outpoint.n, colorproof.qty))
 
-            cur_height += 1
+        for outpoint, colorproof in sorted(tracer.colored_outpoints.items(), key=lambda item: item[0].serialize()):
+            print('%s:%d %d' % (b2lx(outpoint.hash), outpoint.n, colorproof.qty))
+        logging.info('Trace stats: %r' % tracer.stats)
 
 class cmd_db_statehash:
     def __init__(self, subparsers):
         parser = subparsers.add_parser('statehash',
-                    help='Calculate the db state hash')
+                    help='Show the db state hash')
+        parser.add_argument('--verify', action='store_true',
+            help='Recalculate the state hash from scratch and check it matches')
+        parser.add_argument('--full', action='store_true',
+            help='Calculate the (slow) full state hash used by earlier versions instead')
         parser.set_defaults(cmd_func=self.do)
 
     def do(self, args):
-        state_hash = args.colordb.calc_state_hash()
+        if args.full:
+            state_hash = args.colordb.snapshot_read(lambda colordb: colordb.calc_state_hash())
+
+        else:
+            state_hash, recalculated_state_hash = args.colordb.snapshot_read(
+                    lambda colordb: (colordb.state_hash,
+                                     colordb.calc_state_commitment().digest() if args.verify else None))
+
+            if args.verify and state_hash != recalculated_state_hash:
+                args.parser.exit(1, 'State hash mismatch! %s != %s\n' % \
+                                        (b2x(state_hash), b2x(recalculated_state_hash)))
+
         print(b2x(state_hash))
 
+class cmd_db_diff:
+    def __init__(self, subparsers):
+        parser = subparsers.add_parser('diff',
+                    help='Show how the db differs from another db')
+        parser.add_argument('other_colordb_path', metavar='DIR',
+            help='Other colordb directory')
+        parser.set_defaults(cmd_func=self.do)
+
+    @staticmethod
+    def describe_state_elem(elem):
+        elem_type = elem[0]
+        if elem_type == PersistentColorProofDb.STATE_ELEM_COLORDEF:
+            return 'colordef %s' % b2x(elem[1:33])
+
+        elif elem_type == PersistentColorProofDb.STATE_ELEM_GENESIS_OUTPOINT:
+            outpoint = COutPoint.deserialize(elem[1:37])
+            return 'genesis outpoint %s:%d colordef %s' % \
+                    (b2lx(outpoint.hash), outpoint.n, b2x(elem[37:69]))
+
+        elif elem_type == PersistentColorProofDb.STATE_ELEM_GENESIS_SCRIPTPUBKEY:
+            return 'genesis scriptPubKey %s colordef %s' % \
+                    (b2x(elem[33:]), b2x(elem[1:33]))
+
+        elif elem_type == PersistentColorProofDb.STATE_ELEM_COLORPROOF:
+            outpoint = COutPoint.deserialize(elem[1:37])
+            return 'colored outpoint %s:%d colordef %s proof %s' % \
+                    (b2lx(outpoint.hash), outpoint.n, b2x(elem[37:69]), b2x(elem[69:101]))
+
+        else:
+            return 'unknown %s' % b2x(elem)
+
+    def do(self, args):
+        other_colordb = args.colordb_class(args.other_colordb_path, readonly=True)
+
+        def diff(colordb):
+            with other_colordb.snapshot():
+                differing_buckets = colordb.state_commitment.diff(other_colordb.state_commitment)
+                logging.info('%d state buckets differ' % len(differing_buckets))
+
+                return colordb.diff_state(other_colordb)
+
+        only_in_self, only_in_other = args.colordb.snapshot_read(diff)
+        other_colordb.close()
+
+        for elem in sorted(only_in_self):
+            print('- %s' % self.describe_state_elem(elem))
+        for elem in sorted(only_in_other):
+            print('+ %s' % self.describe_state_elem(elem))
+
+class cmd_db_migrate:
+    def __init__(self, subparsers):
+        parser = subparsers.add_parser('migrate',
+                    help='Migrate a file-backed db to a different directory layout')
+        parser.add_argument('--fanout', type=int, default=PersistentColorProofDb.DEFAULT_FANOUT,
+            help='Levels of hash-prefix subdirectories (default: %(default)d)')
+        parser.set_defaults(cmd_func=self.do, writes_colordb=True)
+
+    def do(self, args):
+        if not isinstance(args.colordb, PersistentColorProofDb):
+            args.parser.exit(1, 'Only file-backed dbs have a directory layout\n')
+
+        if args.fanout < 0:
+            args.parser.exit(1, 'Fanout must not be negative\n')
+
+        logging.info('Migrating from fanout %d to %d' % (args.colordb.fanout, args.fanout))
+        args.colordb.migrate_layout(args.fanout)
+
+class cmd_db_reindex:
+    def __init__(self, subparsers):
+        parser = subparsers.add_parser('reindex',
+                    help='Rebuild the indexes missing from a db created by an older version')
+        parser.set_defaults(cmd_func=self.do, writes_colordb=True)
+
+    def do(self, args):
+        if args.colordb.best_colorproofs_complete:
+            logging.info('Best proof index already complete')
+        else:
+            args.colordb.reindex_best_colorproofs()
+
+        if args.colordb.state_elems_complete:
+            logging.info('State element index already complete')
+        else:
+            args.colordb.reindex_state_elems()
+
+        if args.colordb.spent_outpoints_complete:
+            logging.info('Spent outpoint index already complete')
+        else:
+            args.colordb.reindex_spent_outpoints()
+
+class cmd_db_gc:
+    def __init__(self, subparsers):
+        parser = subparsers.add_parser('gc',
+                    help='Remove unneeded proofs and compact the db')
+        parser.add_argument('--keep-superseded', action='store_true',
+            help="Keep proofs for which there's a better proof of the same outpoint")
+        parser.add_argument('--spent', action='store_true',
+            help='Remove proofs of outpoints known to be spent')
+        parser.add_argument('--no-compact', action='store_false', dest='compact',
+            help="Only remove proofs; don't reclaim the space they used")
+        parser.add_argument('--tmp-max-age', type=int, default=PersistentColorProofDb.DEFAULT_TMP_MAX_AGE,
+            help='Remove temporary files older than this many seconds (file-backed dbs only; default: %(default)d)')
+        parser.set_defaults(cmd_func=self.do, writes_colordb=True)
+
+    def do(self, args):
+        n = args.colordb.gc(superseded=not args.keep_superseded, spent=args.spent)
+        logging.info('Removed %d proofs' % n)
+
+        if args.compact:
+            if isinstance(args.colordb, PersistentColorProofDb):
+                stats = args.colordb.compact(tmp_max_age=args.tmp_max_age)
+            else:
+                stats = args.colordb.compact()
+
+            for name, value in sorted(stats.items()):
+                logging.info('%s: %d' % (name, value))
+
+class cmd_db_export:
+    def __init__(self, subparsers):
+        parser = subparsers.add_parser('export',
+                    help='Export a snapshot of the db')
+        parser.add_argument('fd', type=argparse.FileType('wb'), metavar='FILE',
+            help="Snapshot file; '-' for stdout")
+        parser.set_defaults(cmd_func=self.do)
+
+    def do(self, args):
+        # Can't be retried, as the snapshot is written as we go
+        try:
+            with args.colordb.snapshot():
+                n = ColorProofDbSnapshotSerializer.stream_serialize(args.colordb, args.fd)
+                state_hash = args.colordb.state_hash
+        except ColorProofDbConcurrentWriteError:
+            args.parser.exit(1, 'Db changed during export, snapshot is inconsistent; try again\n')
+
+        args.fd.flush()
+        logging.info('Exported %d proofs, state hash %s' % (n, b2x(state_hash)))
+
+class cmd_db_import:
+    def __init__(self, subparsers):
+        parser = subparsers.add_parser('import',
+                    help="Import a snapshot into an empty db; the snapshot's indexes, such as balances, are trusted")
+        parser.add_argument('fd', type=argparse.FileType('rb'), metavar='FILE',
+            help="Snapshot file; '-' for stdin")
+        parser.set_defaults(cmd_func=self.do, writes_colordb=True)
+
+    def do(self, args):
+        if any(True for colordef in args.colordb.colordefs):
+            args.parser.exit(1, 'Snapshots can only be imported into an empty db\n')
+
+        # Imported into a new db alongside, which only replaces the empty db
+        # once the snapshot has been verified.
+        import_path = args.colordb_path + '-import'
+        if os.path.exists(import_path):
+            logging.warning('Removing %s left by an interrupted import' % import_path)
+            shutil.rmtree(import_path)
+
+        import_colordb = args.colordb_class(import_path, **args.colordb_kwargs)
+        try:
+            try:
+                ColorProofDbSnapshotSerializer.stream_deserialize(args.fd, import_colordb, limits=args.snapshot_limits)
+                state_hash = import_colordb.state_hash
+            finally:
+                import_colordb.close()
+        except proofmarshal.DeserializationError as exp:
+            shutil.rmtree(import_path)
+            args.parser.exit(1, 'Bad snapshot, db left unchanged: %s\n' % exp)
+
+        args.colordb.close()
+        shutil.rmtree(args.colordb_path)
+        os.rename(import_path, args.colordb_path)
+        args.colordb = args.colordb_class(args.colordb_path, **args.colordb_kwargs)
+
+        logging.info('Imported snapshot, state hash %s' % b2x(state_hash))
+
+class cmd_db_balance:
+    def __init__(self, subparsers):
+        parser = subparsers.add_parser('balance',
+                    help='Show the colored balance of an address')
+        parser.add_argument('--utxos', action='store_true',
+            help='List the individual colored outputs too')
+        parser.add_argument('address', type=CBitcoinAddress,
+            help='Address')
+        parser.set_defaults(cmd_func=self.do)
+
+    def do(self, args):
+        colored_utxos = args.colordb.snapshot_read(
+                lambda colordb: colordb.get_colored_utxos(args.address.to_scriptPubKey()))
+
+        balance = {}
+        for outpoint, colordef_hash, qty in colored_utxos:
+            balance[colordef_hash] = balance.get(colordef_hash, 0) + qty
+
+        for colordef_hash, qty in sorted(balance.items()):
+            print('%s %d' % (b2x(colordef_hash), qty))
+
+            if args.utxos:
+                for outpoint, utxo_colordef_hash, utxo_qty in colored_utxos:
+                    if utxo_colordef_hash == colordef_hash:
+                        print('    %s:%d %d' % (b2lx(outpoint.hash), outpoint.n, utxo_qty))
+
+class cmd_db_stats:
+    def __init__(self, subparsers):
+        parser = subparsers.add_parser('stats',
+                    help='Show supply and holder statistics for each color')
+        parser.add_argument('colordef_hashes', type=x, nargs='*', metavar='COLORDEF_HASH',
+            help='Only show these colordefs')
+        parser.set_defaults(cmd_func=self.do)
+
+    def do(self, args):
+        def get_stats(colordb):
+            return {colordef.hash:colordb.get_colordef_stats(colordef)
+                        for colordef in colordb.colordefs
+                            if not args.colordef_hashes or colordef.hash in args.colordef_hashes}
+
+        stats_by_colordef_hash = args.colordb.snapshot_read(get_stats)
+
+        for colordef_hash, stats in sorted(stats_by_colordef_hash.items()):
+            if stats is None:
+                print('%s no stats; added before stats were kept' % b2x(colordef_hash))
+            else:
+                print('%s issued %d unspent %d destroyed %d holders %d' % \
+                        (b2x(colordef_hash), stats['issued'], stats['unspent'], stats['destroyed'], stats['holders']))
+
 def add_db_cmds(subparsers):
     db_parser = subparsers.add_parser('db',
             help='ColorProof Database')
@@ -92,4 +415,13 @@ def add_db_cmds(subparsers):
     cmd_db_addcolordef(db_subparsers)
     cmd_db_addtx(db_subparsers)
     cmd_db_scan(db_subparsers)
+    cmd_db_trace(db_subparsers)
     cmd_db_statehash(db_subparsers)
+    cmd_db_diff(db_subparsers)
+    cmd_db_migrate(db_subparsers)
+    cmd_db_reindex(db_subparsers)
+    cmd_db_gc(db_subparsers)
+    cmd_db_export(db_subparsers)
+    cmd_db_import(db_subparsers)
+    cmd_db_balance(db_subparsers)
+    cmd_db_stats(db_subparsers)
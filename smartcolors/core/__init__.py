@@ -14,6 +14,7 @@ import struct
 
 import bitcoin.core.serialize
 import proofmarshal
+import proofmarshal.memoize
 import proofmarshal.merbinnertree
 
 from bitcoin.core import COutPoint, CTransaction, b2lx, x, b2x, Hash
@@ -190,7 +191,7 @@ class ColorDef(proofmarshal.ImmutableProof):
     def _ctx_deserialize(self, ctx):
         version = ctx.read_varuint('version')
         if version != self.VERSION:
-            raise SerializationError('wrong version: got %d; expected %d' % (version, self.VERSION))
+            raise proofmarshal.DeserializationError('wrong version: got %d; expected %d' % (version, self.VERSION))
 
         birthdate_blockheight = ctx.read_varuint('birthdate_blockheight')
         object.__setattr__(self, 'birthdate_blockheight', birthdate_blockheight)
@@ -223,6 +224,34 @@ class ColorDef(proofmarshal.ImmutableProof):
         pad = bitcoin.core.serialize.Hash(b)[0:4]
         return struct.unpack('<I', pad)[0]
 
+    def decrypt_nSequence(self, txin):
+        """Decrypt the nSequence of a txin
+
+        Returns the decrypted nSequence.
+        """
+        # bit #7 turns nSequence decryption on and off; important in case a
+        # future CHECKSIG or something can create signatures that don't sign
+        # the prevout
+        decrypted_nSequence = txin.nSequence
+        if txin.nSequence & 0b10000000:
+            decrypted_nSequence ^= self.nSequence_pad(txin.prevout)
+        return decrypted_nSequence
+
+    def calc_txin_routing(self, txin, tx):
+        """Calculate which outputs a txin may send color to
+
+        Returns a set of vout indexes, or None if the kernel used by the txin
+        isn't supported.
+        """
+        kernel_num = txin.nSequence & 0x7F
+
+        if kernel_num == 0x7E:
+            colored_bitfield = (self.decrypt_nSequence(txin) >> 16) & 0xFFFF
+            return {j for j in range(min(len(tx.vout), 16)) if (colored_bitfield >> j) & 0b1 == 1}
+
+        else:
+            return None
+
     def calc_color_transferred(self, txin, color_qty_in, color_qtys_out, tx):
         """Calculate the color transferred by a specific txin
 
@@ -241,12 +270,7 @@ class ColorDef(proofmarshal.ImmutableProof):
         # bits 6-0 are used to determine what kernel to use
         kernel_num = txin.nSequence & 0x7F
 
-        # bit #7 turns nSequence decryption on and off; important in case a
-        # future CHECKSIG or something can create signatures that don't sign
-        # the prevout
-        decrypted_nSequence = txin.nSequence
-        if txin.nSequence & 0b10000000:
-            decrypted_nSequence ^= self.nSequence_pad(txin.prevout)
+        decrypted_nSequence = self.decrypt_nSequence(txin)
 
         if kernel_num == 0x7F:
             # PUSHDATA routing
@@ -342,6 +366,37 @@ class ColorDef(proofmarshal.ImmutableProof):
 class ColorProofValidationError(Exception):
     pass
 
+class _ByteCounter:
+    """File-like object that only counts the bytes written to it"""
+    def __init__(self):
+        self.count = 0
+
+    def write(self, buf):
+        self.count += len(buf)
+
+class _IdentityMemoizedSerializationContext(proofmarshal.memoize.MemoizedStreamSerializationContext):
+    """Memoized serialization that tells proofs apart by identity
+
+    Finding the hash of a deserialized proof applies the kernel to its entire
+    history, which is exactly what estimating the cost of doing so must avoid.
+    Proofs, and the prevout proof trees whose hashes depend on theirs, are
+    told apart by identity instead; everything else is still told apart by
+    hash.
+
+    Objects told apart by identity are kept alive until the context is, as
+    otherwise their ids could be reused.
+    """
+    def __init__(self, fd):
+        super().__init__(fd)
+        self.objs_by_id = {}
+
+    def _memo_key(self, obj, serialization_class):
+        if isinstance(obj, (ColorProof, PrevoutProofsMerbinnerTree)):
+            self.objs_by_id.setdefault(id(obj), obj)
+            return id(obj)
+        else:
+            return super()._memo_key(obj, serialization_class)
+
 class ColorProof(proofmarshal.ImmutableProof):
     """Prove that a specific outpoint is colored"""
 
@@ -366,7 +421,7 @@ class ColorProof(proofmarshal.ImmutableProof):
     def _ctx_deserialize(self, ctx):
         version = ctx.read_varuint('version')
         if version != self.VERSION:
-            raise Exception('wrong version: got %d; expected %d' % (version, self.VERSION))
+            raise proofmarshal.DeserializationError('wrong version: got %d; expected %d' % (version, self.VERSION))
 
         colordef = ctx.read_obj('colordef', ColorDef)
         object.__setattr__(self, 'colordef', colordef)
@@ -374,25 +429,151 @@ class ColorProof(proofmarshal.ImmutableProof):
     @classmethod
     def ctx_deserialize(cls, ctx):
         colorproof_type = ctx.read_varuint('colorproof_type')
-        cls = ColorProof.COLORPROOF_CLASSES_BY_TYPE[colorproof_type]
+        try:
+            cls = ColorProof.COLORPROOF_CLASSES_BY_TYPE[colorproof_type]
+        except KeyError:
+            raise proofmarshal.DeserializationError('unknown colorproof type %d' % colorproof_type)
         self = cls.__new__(cls)
         self._ctx_deserialize(ctx)
         return self
 
     def _validate(self):
+        """Validate this proof alone
+
+        Called once the prevout proofs have been validated, so their qtys are
+        known.
+        """
         raise NotImplementedError
 
-    def validate(self):
-        """Validate the proof"""
+    def _get_prevout_proofs(self):
+        """Return the {prevout:ColorProof} dict this proof directly depends on"""
+        return {}
+
+    def _validation_steps(self):
+        """Number of steps it takes to validate this proof alone"""
+        return 1
 
-        remaining_proofs = (self,)
-        while remaining_proofs:
-            next_remaining_proofs = []
+    def _iter_dag(self, skip=None):
+        """Return every unique proof in the proof DAG, prevout proofs first
+
+        Proofs are told apart by identity rather than hash, as finding the
+        hash, or qty, of a deserialized proof applies the kernel to its entire
+        history. Done iteratively as histories can be long.
+
+        skip - optional function; proofs for which it returns true are left
+               out, along with any history only reachable through them
+        """
+        ordered_proofs = []
+        seen = {} # id:proof, keeping the proofs alive so ids aren't reused
+
+        remaining = [(self, False)]
+        while remaining:
+            proof, prevouts_done = remaining.pop()
+            if prevouts_done:
+                ordered_proofs.append(proof)
+                continue
+
+            if id(proof) in seen:
+                continue
+            seen[id(proof)] = proof
+
+            if skip is not None and skip(proof):
+                continue
+
+            remaining.append((proof, True))
+            remaining.extend((prevout_proof, False) for prevout_proof in proof._get_prevout_proofs().values()
+                                if id(prevout_proof) not in seen)
+
+        return ordered_proofs
+
+    def validate(self, budget=None):
+        """Validate the proof
+
+        Each unique proof in the proof DAG is validated once, prevout proofs
+        first.
+
+        budget - optional maximum number of validation steps; see
+                 calc_validation_cost(). If exceeded
+                 ColorProofBudgetExceededError is raised before any kernel is
+                 applied.
+        """
+        proofs = self._iter_dag()
 
-            for proof in remaining_proofs:
-                next_remaining_proofs.extend(proof._validate())
+        steps = sum(proof._validation_steps() for proof in proofs)
+        if budget is not None and steps > budget:
+            raise ColorProofBudgetExceededError('validation budget of %d steps exceeded' % budget)
 
-            remaining_proofs = next_remaining_proofs
+        for proof in proofs:
+            proof._validate()
+
+        return steps
+
+    def calc_validation_cost(self):
+        """Estimate the cost of validating this proof
+
+        Walks the proof DAG without validating or hashing it, counting each
+        unique proof and transaction once.
+
+        Returns a ColorProofValidationCost
+        """
+        cost = ColorProofValidationCost()
+
+        txids = set()
+
+        for proof in self._iter_dag():
+            cost.proofs += 1
+            cost.steps += proof._validation_steps()
+
+            # The proof itself, plus the outpoint or transaction it commits to
+            cost.hash_ops += 2
+
+            tx = getattr(proof, 'tx', None)
+            if tx is not None:
+                txid = tx.GetHash()
+                if txid not in txids:
+                    txids.add(txid)
+                    cost.txs += 1
+
+            prevout_proofs = proof._get_prevout_proofs()
+            if isinstance(proof, TransferredColorProof):
+                cost.kernel_applications += 1
+
+                # Hashing the prevout proofs merbinner tree takes roughly one
+                # hash per key and two per leaf.
+                cost.hash_ops += 3 * len(prevout_proofs) + 1
+
+        fd = _ByteCounter()
+        ctx = _IdentityMemoizedSerializationContext(fd)
+        ctx.write_obj(None, self)
+        cost.serialized_size = fd.count
+
+        return cost
+
+class ColorProofBudgetExceededError(ColorProofValidationError):
+    pass
+
+class ColorProofValidationCost:
+    """Estimated cost of validating a ColorProof
+
+    proofs              - number of unique proofs
+    txs                 - number of unique transactions
+    kernel_applications - number of times the color kernel is applied
+    hash_ops            - approximate number of hash operations
+    serialized_size     - size in bytes of the memoized serialization
+    steps               - validation steps, as metered by ColorProof.validate()
+    """
+
+    def __init__(self):
+        self.proofs = 0
+        self.txs = 0
+        self.kernel_applications = 0
+        self.hash_ops = 0
+        self.serialized_size = 0
+        self.steps = 0
+
+    def __repr__(self):
+        return 'ColorProofValidationCost(proofs=%d, txs=%d, kernel_applications=%d, hash_ops=%d, serialized_size=%d, steps=%d)' % \
+                (self.proofs, self.txs, self.kernel_applications, self.hash_ops, self.serialized_size, self.steps)
 
 def register_colorproof_class(cls):
     ColorProof.COLORPROOF_CLASSES_BY_TYPE[cls.COLORPROOF_TYPE] = cls
@@ -420,14 +601,15 @@ class GenesisOutPointColorProof(ColorProof):
 
     @property
     def qty(self):
-        return self.colordef.genesis_outpoints[self.outpoint]
+        try:
+            return self.colordef.genesis_outpoints[self.outpoint]
+        except KeyError:
+            raise ColorProofValidationError('outpoint not in genesis outpoints')
 
     def _validate(self):
         if self.outpoint not in self.colordef.genesis_outpoints:
             raise ColorProofValidationError('outpoint not in genesis outpoints')
 
-        return ()
-
 @register_colorproof_class
 class GenesisScriptPubKeyColorProof(ColorProof):
     """Prove that an outpoint is colored because it is a genesis scriptPubKey"""
@@ -461,7 +643,9 @@ class GenesisScriptPubKeyColorProof(ColorProof):
     def qty(self):
         # FIXME: add/remove msbdrop padding should be part of the colordef to
         # make it more generic
-        return remove_msbdrop_value_padding(self.tx.vout[self.outpoint.n].nValue)
+        if not (0 <= self.n < len(self.tx.vout)):
+            raise ColorProofValidationError('outpoint does not match transaction')
+        return remove_msbdrop_value_padding(self.tx.vout[self.n].nValue)
 
     def _validate(self):
         if not (0 <= self.n < len(self.tx.vout)):
@@ -470,8 +654,6 @@ class GenesisScriptPubKeyColorProof(ColorProof):
         if self.tx.vout[self.n].scriptPubKey not in self.colordef.genesis_scriptPubKeys:
             raise ColorProofValidationError('scriptPubKey not a genesis scriptPubKey')
 
-        return ()
-
 
 class PrevoutProofsMerbinnerTree(proofmarshal.merbinnertree.MerbinnerTree):
     HASH_HMAC_KEY = x('486a3b9f0cc1adc7f0f7f3e388b89dbc')
@@ -496,6 +678,8 @@ class TransferredColorProof(ColorProof):
 
     COLORPROOF_TYPE = 3
 
+    PICKLED_CACHED_ATTRS = ('_cached_hash', '_cached_qty')
+
     @property
     def outpoint(self):
         return COutPoint(self.tx.GetHash(), self.n)
@@ -550,11 +734,80 @@ class TransferredColorProof(ColorProof):
             object.__setattr__(self, '_cached_qty', self.calc_qty())
             return self._cached_qty
 
-    def _validate(self):
-        yield from self.prevout_proofs.values()
+    def prune(self, recursive=True, _pruned_proofs=None):
+        """Prune prevout proofs that can't affect the qty of this outpoint
+
+        Color is allocated to outputs input by input, and within an input
+        output by output, so an input can only affect the qty of this
+        outpoint if it sends color to it, or fills an earlier output that a
+        later relevant input sends color to. Inputs with zero qty never send
+        color anywhere.
+
+        recursive - also prune the prevout proofs themselves
+
+        Returns a TransferredColorProof with the same qty, or self if nothing
+        was pruned.
+        """
+        if _pruned_proofs is None:
+            _pruned_proofs = {}
+
+        try:
+            return _pruned_proofs[self.hash]
+        except KeyError:
+            pass
+
+        relevant_txouts = {self.n}
+        relevant_prevouts = set()
+        for txin in reversed(self.tx.vin):
+            prevout_proof = self.prevout_proofs.get(txin.prevout)
+            if prevout_proof is None or prevout_proof.qty == 0:
+                continue
 
+            routing = self.colordef.calc_txin_routing(txin, self.tx)
+            if routing is None:
+                # Don't know what the kernel does, so keep everything.
+                return self
+
+            hits = routing & relevant_txouts
+            if hits:
+                relevant_prevouts.add(txin.prevout)
+
+                # How much color this txin sends to the relevant outputs
+                # depends on how full the outputs before them are.
+                last_hit = max(hits)
+                relevant_txouts.update(j for j in routing if j <= last_hit)
+
+        prevout_proofs = {}
+        for prevout in relevant_prevouts:
+            prevout_proof = self.prevout_proofs[prevout]
+            if recursive and isinstance(prevout_proof, TransferredColorProof):
+                prevout_proof = prevout_proof.prune(recursive=True, _pruned_proofs=_pruned_proofs)
+            prevout_proofs[prevout] = prevout_proof
+
+        if all(prevout_proof is self.prevout_proofs.get(prevout) for prevout, prevout_proof in prevout_proofs.items()) \
+                and len(prevout_proofs) == len(self.prevout_proofs):
+            pruned_proof = self
+
+        else:
+            pruned_proof = TransferredColorProof(self.colordef, self.outpoint, self.tx, prevout_proofs)
+            assert pruned_proof.qty == self.qty
+
+        _pruned_proofs[self.hash] = pruned_proof
+        return pruned_proof
+
+    def _get_prevout_proofs(self):
+        return self.prevout_proofs
+
+    def _validation_steps(self):
+        # Applying the kernel iterates over every input, and for every
+        # colored input over the outputs.
+        return 1 + len(self.tx.vin) + len(self.prevout_proofs) * min(len(self.tx.vout), 16)
+
+    def _validate(self):
         if not (0 <= self.n < len(self.tx.vout)):
             raise ColorProofValidationError('outpoint does not match transaction')
 
-        self.calc_qty()
+        # The prevout proofs were validated first, so their qtys are cached
+        # and this applies the kernel to this tx alone.
+        object.__setattr__(self, '_cached_qty', self.calc_qty())
 
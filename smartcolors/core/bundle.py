@@ -0,0 +1,135 @@
+# Copyright (C) 2014 Peter Todd <pete@petertodd.org>
+#
+# This file is part of python-smartcolors.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of python-smartcolors, including this file, may be copied, modified,
+# propagated, or distributed except according to the terms contained in the
+# LICENSE file.
+
+from smartcolors.core import (
+        ColorProofBudgetExceededError,
+        GenesisOutPointColorProof,
+        GenesisScriptPubKeyColorProof,
+        TransferredColorProof
+)
+
+class ColorProofBundle:
+    """A set of ColorProofs sharing their common history
+
+    Proofs added to the bundle are rebuilt as needed so that every unique
+    subproof, colordef and transaction is stored exactly once, no matter how
+    many of the proofs in the bundle depend on it. Memory usage is thus
+    proportional to the unique history of the proofs, rather than the sum of
+    the individual proofs.
+
+    colorproofs     - set of all ColorProofs added to the bundle
+    proofs_by_hash  - all unique proofs, including prevout proofs: {hash:ColorProof}
+    colordefs       - all unique ColorDefs: {hash:ColorDef}
+    txs             - all unique transactions: {txid:CTransaction}
+    """
+
+    def __init__(self, colorproofs=()):
+        self.colorproofs = set()
+        self.proofs_by_hash = {}
+        self.colordefs = {}
+        self.txs = {}
+
+        for colorproof in colorproofs:
+            self.add(colorproof)
+
+    def __len__(self):
+        return len(self.colorproofs)
+
+    def __iter__(self):
+        return iter(self.colorproofs)
+
+    def __contains__(self, colorproof):
+        return colorproof in self.colorproofs
+
+    def _intern_colordef(self, colordef):
+        return self.colordefs.setdefault(colordef.hash, colordef)
+
+    def _intern_tx(self, tx):
+        return self.txs.setdefault(tx.GetHash(), tx)
+
+    def _intern_proof(self, colorproof):
+        """Intern a proof whose prevout proofs have all been interned"""
+
+        colordef = self._intern_colordef(colorproof.colordef)
+
+        if isinstance(colorproof, GenesisOutPointColorProof):
+            if colordef is colorproof.colordef:
+                return colorproof
+            interned_proof = GenesisOutPointColorProof(colordef, colorproof.outpoint)
+
+        elif isinstance(colorproof, GenesisScriptPubKeyColorProof):
+            tx = self._intern_tx(colorproof.tx)
+            if colordef is colorproof.colordef and tx is colorproof.tx:
+                return colorproof
+            interned_proof = GenesisScriptPubKeyColorProof(colordef, colorproof.outpoint, tx)
+
+        elif isinstance(colorproof, TransferredColorProof):
+            tx = self._intern_tx(colorproof.tx)
+            prevout_proofs = {prevout:self.proofs_by_hash[prevout_proof.hash]
+                                for prevout, prevout_proof in colorproof.prevout_proofs.items()}
+
+            if colordef is colorproof.colordef and tx is colorproof.tx \
+                    and all(prevout_proof is colorproof.prevout_proofs[prevout]
+                            for prevout, prevout_proof in prevout_proofs.items()):
+                return colorproof
+
+            interned_proof = TransferredColorProof(colordef, colorproof.outpoint, tx, prevout_proofs)
+
+            # The qty is unchanged, so don't make the kernel run again.
+            object.__setattr__(interned_proof, '_cached_qty', colorproof.qty)
+
+        else:
+            raise TypeError('unknown ColorProof class %r' % colorproof.__class__)
+
+        object.__setattr__(interned_proof, '_cached_hash', colorproof.hash)
+        return interned_proof
+
+    def add(self, colorproof):
+        """Add a proof to the bundle
+
+        Returns the equivalent proof stored in the bundle.
+        """
+        def in_bundle(proof):
+            # Only proofs whose hash is already known can be looked up without
+            # applying the kernel.
+            proof_hash = getattr(proof, '_cached_hash', None)
+            return proof_hash is not None and proof_hash in self.proofs_by_hash
+
+        # Prevout proofs come first, so finding the hash of each proof only
+        # applies the kernel to its own tx, rather than recursing through its
+        # whole history.
+        for proof in colorproof._iter_dag(skip=in_bundle):
+            if proof.hash not in self.proofs_by_hash:
+                self.proofs_by_hash[proof.hash] = self._intern_proof(proof)
+
+        interned_colorproof = self.proofs_by_hash[colorproof.hash]
+        self.colorproofs.add(interned_colorproof)
+        return interned_colorproof
+
+    def validate(self, budget=None):
+        """Validate every proof in the bundle
+
+        Each unique subproof is validated exactly once.
+
+        budget - optional maximum number of validation steps, as with
+                 ColorProof.validate()
+
+        Returns the number of steps taken.
+        """
+        steps = sum(proof._validation_steps() for proof in self.proofs_by_hash.values())
+        if budget is not None and steps > budget:
+            raise ColorProofBudgetExceededError('validation budget of %d steps exceeded' % budget)
+
+        # Proofs were added prevout proofs first
+        for proof in self.proofs_by_hash.values():
+            proof._validate()
+
+        return steps
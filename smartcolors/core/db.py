@@ -9,20 +9,238 @@
 # propagated, or distributed except according to the terms contained in the
 # LICENSE file.
 
+import collections.abc
+import contextlib
 import hashlib
 import os
 import struct
 
 import bitcoin.core.serialize
+import proofmarshal
 
 from bitcoin.core import COutPoint, CTransaction, b2lx, Hash
 from bitcoin.core.script import CScript
 
 from smartcolors.core import (
+        ColorProof,
         GenesisOutPointColorProof,
         GenesisScriptPubKeyColorProof,
         TransferredColorProof
 )
+from smartcolors.core.tracer import ColorTracer
+
+class ColorProofDbConcurrentWriteError(Exception):
+    """The db was written to by another process while being read"""
+    pass
+
+class MultisetHash:
+    """Incrementally updatable hash of a set of byte strings
+
+    Implements MuHash: each element is hashed to an integer modulo a large
+    prime, and the digest is derived from the product of those integers.
+    Multiplication is commutative, so the digest doesn't depend on the order
+    elements were added in, and elements can be added or removed in constant
+    time. Removals are tracked as a separate denominator to avoid a modular
+    inversion per removal.
+    """
+
+    MODULUS = 2**3072 - 1103717
+    ELEM_LEN = 384
+
+    def __init__(self, numerator=1, denominator=1):
+        self.numerator = numerator
+        self.denominator = denominator
+
+    @classmethod
+    def _elem_to_int(cls, elem):
+        return int.from_bytes(hashlib.shake_256(elem).digest(cls.ELEM_LEN), 'little') % cls.MODULUS
+
+    def add(self, elem):
+        """Add an element to the set"""
+        self.numerator = (self.numerator * self._elem_to_int(elem)) % self.MODULUS
+
+    def remove(self, elem):
+        """Remove an element from the set"""
+        self.denominator = (self.denominator * self._elem_to_int(elem)) % self.MODULUS
+
+    def digest(self):
+        """Return the 32 byte digest of the set"""
+        if self.denominator != 1:
+            self.numerator = (self.numerator * pow(self.denominator, -1, self.MODULUS)) % self.MODULUS
+            self.denominator = 1
+
+        return hashlib.sha256(self.numerator.to_bytes(self.ELEM_LEN, 'little')).digest()
+
+    def serialize(self):
+        return self.numerator.to_bytes(self.ELEM_LEN, 'little') + self.denominator.to_bytes(self.ELEM_LEN, 'little')
+
+    @classmethod
+    def deserialize(cls, buf):
+        if len(buf) != 2*cls.ELEM_LEN:
+            raise ValueError('expected %d bytes; got %d' % (2*cls.ELEM_LEN, len(buf)))
+        return cls(int.from_bytes(buf[:cls.ELEM_LEN], 'little'),
+                   int.from_bytes(buf[cls.ELEM_LEN:], 'little'))
+
+    def __eq__(self, other):
+        if isinstance(other, MultisetHash):
+            return self.digest() == other.digest()
+        else:
+            return NotImplemented
+
+class StateTree:
+    """Merkleized state commitment
+
+    Elements are sorted into a fixed number of buckets by a prefix of the
+    hash of their key, and each bucket is a MultisetHash. The bucket digests
+    are the leaves of a radix-16 merkle tree, whose root commits to the whole
+    state.
+
+    Two trees can be compared node by node, descending only into nodes whose
+    hashes differ, to find the buckets that differ in a number of steps
+    proportional to the number of differences times the depth of the tree.
+
+    Nodes are identified by their prefix, a string of hex digits; the root is
+    the empty string, buckets are depth digits long.
+    """
+
+    DEFAULT_DEPTH = 2
+
+    HEX_DIGITS = '0123456789abcdef'
+
+    def __init__(self, *, depth=DEFAULT_DEPTH):
+        self.depth = depth
+        self.buckets = {}
+        self._node_hashes = {}
+
+    def key_prefix(self, key):
+        """Return the prefix of the bucket key belongs in"""
+        return hashlib.sha256(key).hexdigest()[0:self.depth]
+
+    def _get_bucket(self, prefix):
+        try:
+            return self.buckets[prefix]
+        except KeyError:
+            bucket = self.buckets[prefix] = MultisetHash()
+            return bucket
+
+    def _bucket_changed(self, prefix):
+        for i in range(len(prefix)+1):
+            self._node_hashes.pop(prefix[0:i], None)
+
+    def add(self, key, elem):
+        """Add an element to the bucket for key"""
+        prefix = self.key_prefix(key)
+        self._get_bucket(prefix).add(elem)
+        self._bucket_changed(prefix)
+
+    def remove(self, key, elem):
+        """Remove an element from the bucket for key"""
+        prefix = self.key_prefix(key)
+        self._get_bucket(prefix).remove(elem)
+        self._bucket_changed(prefix)
+
+    def node_hash(self, prefix=''):
+        """Return the hash of a node"""
+        try:
+            return self._node_hashes[prefix]
+        except KeyError:
+            pass
+
+        if len(prefix) == self.depth:
+            h = self._get_bucket(prefix).digest()
+
+        else:
+            assert len(prefix) < self.depth
+            midstate = hashlib.sha256()
+            for child_prefix in self.child_prefixes(prefix):
+                midstate.update(self.node_hash(child_prefix))
+            h = midstate.digest()
+
+        self._node_hashes[prefix] = h
+        return h
+
+    def child_prefixes(self, prefix):
+        """Return the prefixes of the children of a node"""
+        return [prefix + digit for digit in self.HEX_DIGITS]
+
+    def digest(self):
+        """Return the root hash"""
+        return self.node_hash('')
+
+    def diff(self, other):
+        """Find the buckets that differ from another tree
+
+        other only needs a node_hash() method, so could be a proxy for a
+        remote replica.
+
+        Returns a set of bucket prefixes.
+        """
+        if getattr(other, 'depth', self.depth) != self.depth:
+            raise ValueError('trees have different depths')
+
+        differing_buckets = set()
+        remaining_prefixes = ['']
+        while remaining_prefixes:
+            prefix = remaining_prefixes.pop()
+            if self.node_hash(prefix) == other.node_hash(prefix):
+                continue
+
+            if len(prefix) == self.depth:
+                differing_buckets.add(prefix)
+            else:
+                remaining_prefixes.extend(self.child_prefixes(prefix))
+
+        return differing_buckets
+
+    def __eq__(self, other):
+        if isinstance(other, StateTree):
+            return self.digest() == other.digest()
+        else:
+            return NotImplemented
+
+class PrefixIndex(collections.abc.MutableMapping):
+    """In-memory index of bytes to bytes whose keys can be listed by prefix
+
+    Keys are grouped by their first prefix_length bytes, so iter_prefix()
+    only looks at the keys sharing a prefix.
+    """
+
+    def __init__(self, prefix_length):
+        self.prefix_length = prefix_length
+        self._groups = {} # {prefix:{key:value}}
+        self._len = 0
+
+    def __getitem__(self, key):
+        return self._groups[key[0:self.prefix_length]][key]
+
+    def __setitem__(self, key, value):
+        group = self._groups.setdefault(key[0:self.prefix_length], {})
+        if key not in group:
+            self._len += 1
+        group[key] = value
+
+    def __delitem__(self, key):
+        prefix = key[0:self.prefix_length]
+        group = self._groups[prefix]
+        del group[key]
+        self._len -= 1
+        if not group:
+            del self._groups[prefix]
+
+    def __iter__(self):
+        for group in tuple(self._groups.values()):
+            yield from tuple(group)
+
+    def __len__(self):
+        return self._len
+
+    def iter_prefix(self, prefix):
+        """Iterate over the (key, value) pairs whose keys start with prefix
+
+        prefix must be prefix_length bytes long.
+        """
+        assert len(prefix) == self.prefix_length
+        yield from tuple(self._groups.get(prefix, {}).items())
 
 class ColorProofDb:
     """Database of ColorProofs
@@ -34,16 +252,554 @@ class ColorProofDb:
     genesis_outpoints     - all known genesis outpoints: {COutPoint:set(ColorDef)}
     genesis_scriptPubKeys - all known genesis scriptPubKeys: {scriptPubKey:set(ColorDef)}
     colored_outpoints     - all known colored outpoints: {COutPoint:{ColorDef:set(ColorProof)}}
+
+    state_commitment      - StateTree of the above, updated as they change
+
+    spent_outpoints       - colored outpoints spent by transactions given to
+                            addtx(): {serialized COutPoint:spending txid}.
+                            Complete once the SPENT_OUTPOINTS_COMPLETE_KEY
+                            key is present; dbs created before spends were
+                            recorded must be reindexed.
+    outpoint_heights      - heights of the blocks given to addblock() that
+                            created colored outpoints:
+                            {serialized COutPoint:little-endian uint32}
+    scriptPubKey_utxos    - unspent colored outpoints by the SHA256 of their
+                            scriptPubKey: {scriptPubKey hash + colordef hash
+                            + serialized COutPoint:SCRIPTPUBKEY_UTXO}, along
+                            with the number of them for each colordef held:
+                            {scriptPubKey hash + colordef
+                            hash:SCRIPTPUBKEY_HOLDING}. Genesis outpoints
+                            aren't included, as their scriptPubKeys aren't
+                            known.
+    best_colorproofs      - the best proof of each colored outpoint, for each
+                            colordef it's colored by: a concatenation of
+                            BEST_COLORPROOF entries. Complete once the
+                            BEST_COLORPROOFS_COMPLETE_KEY key is present;
+                            dbs created before it existed must be
+                            reindexed.
+    state_elems           - every state commitment element, so diff_state()
+                            can list the elements of a bucket without
+                            reading the whole db: {ascii hex state
+                            commitment bucket prefix + SHA256 of the
+                            element:element}. Only maintained once
+                            complete, which it is once the
+                            STATE_ELEMS_COMPLETE_KEY key is present.
+    spends                - if index_spends is set, every outpoint spent by
+                            the blocks given to addblock(), colored or not:
+                            {serialized COutPoint:SPEND}; see
+                            trace_colordef()
+    colordef_stats        - running totals for each colordef:
+                            {colordef hash:COLORDEF_STATS}; see
+                            get_colordef_stats()
+    block_hashes          - hashes of the most recent blocks given to
+                            addblock(): {little-endian uint32 height:hash}
+    block_undo            - the changes each of those blocks made, so
+                            disconnect_block() can undo them:
+                            {block hash:serialized undo entries}
+
+    prune_proofs          - if true, prevout proofs irrelevant to a colored
+                            output are pruned from the proofs addtx() creates
+    utxo_only             - if true, addtx() removes colored outpoints once
+                            spent, rather than recording the spend; their
+                            proofs remain part of the proofs of the outputs
+                            the color moved to
+    index_spends          - if true, addblock() records every spend in
+                            spends
+
+    The above, and any other names in INDEX_NAMES, are indexes mapping bytes
+    to bytes. They aren't part of the state commitment. spent_outpoints and
+    outpoint_heights entries are removed along with the outpoints they're
+    about. Those named in INDEX_PREFIX_LENGTHS also have an iter_prefix()
+    method listing the entries whose keys start with a prefix of that
+    length; see PrefixIndex.
     """
 
-    def __init__(self):
+    INDEX_NAMES = ('spent_outpoints', 'outpoint_heights', 'scriptPubKey_utxos', 'best_colorproofs',
+                   'state_elems', 'spends', 'colordef_stats', 'block_hashes', 'block_undo')
+    INDEX_PREFIX_LENGTHS = {'scriptPubKey_utxos': 32,
+                            'state_elems': StateTree.DEFAULT_DEPTH}
+
+    # colordef hash, colorproof hash, proof_priority_key(), qty
+    BEST_COLORPROOF = struct.Struct('<32s32sBQ')
+    BEST_COLORPROOFS_COMPLETE_KEY = b'complete'
+
+    SPENT_OUTPOINTS_COMPLETE_KEY = b'complete'
+
+    # qty
+    SCRIPTPUBKEY_UTXO = struct.Struct('<Q')
+    # number of unspent colored outpoints
+    SCRIPTPUBKEY_HOLDING = struct.Struct('<Q')
+
+    STATE_ELEMS_COMPLETE_KEY = b'complete'
+
+    # spending txid, height, index of the tx in its block
+    SPEND = struct.Struct('<32sII')
+
+    # issued, unspent, destroyed, holders
+    COLORDEF_STATS = struct.Struct('<QQQQ')
+    COLORDEF_STATS_FIELDS = ('issued', 'unspent', 'destroyed', 'holders')
+
+    # Undo data is kept for this many of the most recent blocks; reorgs
+    # deeper than that need a rescan. None to keep it forever.
+    MAX_REORG_DEPTH = 100
+
+    def __init__(self, *, prune_proofs=False, utxo_only=False, index_spends=False):
+        self.prune_proofs = prune_proofs
+        self.utxo_only = utxo_only
+        self.index_spends = index_spends
+
         self.colordefs = set()
         self.genesis_outpoints = {}
         self.genesis_scriptPubKeys = {}
         self.colored_outpoints = {}
 
+        self.state_commitment = StateTree()
+
+        for index_name in self.INDEX_NAMES:
+            setattr(self, index_name, self._make_memory_index(index_name))
+
+        # Undo entries for the block being added, if any
+        self._block_undo = None
+
+    @classmethod
+    def _make_memory_index(cls, name):
+        """Make the named index in memory"""
+        prefix_length = cls.INDEX_PREFIX_LENGTHS.get(name)
+        if prefix_length is None:
+            return {}
+        else:
+            return PrefixIndex(prefix_length)
+
+    def _make_index(self, name):
+        """Make the named index; backends override this to store it"""
+        return self._make_memory_index(name)
+
+    def _init_indexes(self):
+        """Replace the in-memory indexes with the backend's own
+
+        Called by backends once they're ready for _make_index() to be
+        called.
+        """
+        for index_name in self.INDEX_NAMES:
+            setattr(self, index_name, self._make_index(index_name))
+
+    def _set_index(self, index_name, key, value):
+        index = getattr(self, index_name)
+        if self._block_undo is not None:
+            self._block_undo.append((self.UNDO_INDEX, index_name, key, index.get(key)))
+        index[key] = value
+
+    def _pop_index(self, index_name, key):
+        value = getattr(self, index_name).pop(key, None)
+        if value is not None and self._block_undo is not None:
+            self._block_undo.append((self.UNDO_INDEX, index_name, key, value))
+        return value
+
+    def _update_scriptPubKey_utxos(self, colorproof, qty=None):
+        """Add or, if qty is None, remove a colorproof's scriptPubKey_utxos entry
+
+        Returns False if the proof doesn't say what the scriptPubKey is.
+        """
+        tx = getattr(colorproof, 'tx', None)
+        if tx is None:
+            return False
+
+        outpoint = colorproof.outpoint
+        holding_key = hashlib.sha256(tx.vout[outpoint.n].scriptPubKey).digest() + colorproof.colordef.hash
+        key = holding_key + outpoint.serialize()
+
+        old_value = self.scriptPubKey_utxos.get(key)
+        if qty is not None:
+            value = self.SCRIPTPUBKEY_UTXO.pack(qty)
+            if value != old_value:
+                self._set_index('scriptPubKey_utxos', key, value)
+        elif old_value is not None:
+            self._pop_index('scriptPubKey_utxos', key)
+
+        if (old_value is None) != (qty is None):
+            delta = 1 if qty is not None else -1
+            (n,) = self.SCRIPTPUBKEY_HOLDING.unpack(self.scriptPubKey_utxos.get(holding_key,
+                                                                                self.SCRIPTPUBKEY_HOLDING.pack(0)))
+            n += delta
+            if n:
+                self._set_index('scriptPubKey_utxos', holding_key, self.SCRIPTPUBKEY_HOLDING.pack(n))
+            else:
+                self._pop_index('scriptPubKey_utxos', holding_key)
+
+            # Holders are counted once, however many outpoints they hold
+            if n == (1 if delta > 0 else 0):
+                self._update_colordef_stats(colorproof.colordef, holders=delta)
+        return True
+
+    @classmethod
+    def _best_colorproof_key(cls, colorproof):
+        # Ties are broken by hash so every db picks the same proof
+        return (cls.proof_priority_key(colorproof), colorproof.hash)
+
+    def _get_best_colorproof_entries(self, outpoint):
+        """Return {colordef hash:(colorproof hash, priority, qty)} for an outpoint"""
+        entries = self.best_colorproofs.get(outpoint.serialize(), b'')
+        return {colordef_hash:(colorproof_hash, priority, qty)
+                    for colordef_hash, colorproof_hash, priority, qty in self.BEST_COLORPROOF.iter_unpack(entries)}
+
+    def _set_best_colorproof_entries(self, outpoint, entries):
+        entries = b''.join(self.BEST_COLORPROOF.pack(colordef_hash, *entry)
+                                for colordef_hash, entry in sorted(entries.items()))
+        if entries:
+            self._set_index('best_colorproofs', outpoint.serialize(), entries)
+        else:
+            self._pop_index('best_colorproofs', outpoint.serialize())
+
+    def _update_best_colorproof(self, outpoint, colordef, colorproof):
+        """Make colorproof the best proof of outpoint, if it's better"""
+        entries = self._get_best_colorproof_entries(outpoint)
+        best_entry = entries.get(colordef.hash)
+        if best_entry is not None:
+            best_colorproof_hash, best_priority, best_qty = best_entry
+
+            # Make sure that the color quantities proven by all proofs are
+            # identical. (for now)
+            assert colorproof.qty == best_qty
+
+            if (best_priority, best_colorproof_hash) <= self._best_colorproof_key(colorproof):
+                return
+
+        entries[colordef.hash] = (colorproof.hash, self.proof_priority_key(colorproof), colorproof.qty)
+        self._set_best_colorproof_entries(outpoint, entries)
+
+    @property
+    def best_colorproofs_complete(self):
+        """Whether best_colorproofs covers every colored outpoint"""
+        return self.BEST_COLORPROOFS_COMPLETE_KEY in self.best_colorproofs
+
+    def reindex_best_colorproofs(self):
+        """Rebuild best_colorproofs from colored_outpoints
+
+        Slow! Only needed for dbs created before the index existed.
+        """
+        with self.batch():
+            for outpoint, colorproofs_by_colordef in self.colored_outpoints.items():
+                entries = {}
+                for colordef, colorproofs in colorproofs_by_colordef.items():
+                    best_colorproof = min(colorproofs, key=self._best_colorproof_key)
+                    entries[colordef.hash] = (best_colorproof.hash,
+                                              self.proof_priority_key(best_colorproof),
+                                              best_colorproof.qty)
+                self._set_best_colorproof_entries(outpoint, entries)
+            self.best_colorproofs[self.BEST_COLORPROOFS_COMPLETE_KEY] = b''
+
+    def _get_colorproof(self, outpoint, colordef_hash, colorproof_hash):
+        """Get a proof of a colored outpoint by hash
+
+        Backends override this with something faster than searching.
+
+        Raises KeyError if not present.
+        """
+        for colordef, colorproofs in self.colored_outpoints.get(outpoint, {}).items():
+            if colordef.hash == colordef_hash:
+                for colorproof in colorproofs:
+                    if colorproof.hash == colorproof_hash:
+                        return colorproof
+        raise KeyError(colorproof_hash)
+
+    def get_best_colorproofs(self, outpoint):
+        """Return the best proof of an outpoint for each colordef coloring it
+
+        Returns {ColorDef:ColorProof}
+        """
+        if self.best_colorproofs_complete:
+            best_colorproofs = {}
+            for colordef_hash, (colorproof_hash, priority, qty) in self._get_best_colorproof_entries(outpoint).items():
+                colorproof = self._get_colorproof(outpoint, colordef_hash, colorproof_hash)
+                best_colorproofs[colorproof.colordef] = colorproof
+            return best_colorproofs
+
+        else:
+            return {colordef:min(colorproofs, key=self._best_colorproof_key)
+                        for colordef, colorproofs in self.colored_outpoints.get(outpoint, {}).items()}
+
+    def _state_elems_key(self, key, elem):
+        return self.state_commitment.key_prefix(key).encode('ascii') + hashlib.sha256(elem).digest()
+
+    def _state_add(self, key, elem):
+        """Add an element to the state commitment"""
+        self.state_commitment.add(key, elem)
+        if self.state_elems_complete:
+            self._set_index('state_elems', self._state_elems_key(key, elem), elem)
+
+    def _state_remove(self, key, elem):
+        """Remove an element from the state commitment"""
+        self.state_commitment.remove(key, elem)
+        if self.state_elems_complete:
+            self._pop_index('state_elems', self._state_elems_key(key, elem))
+
+    @property
+    def state_elems_complete(self):
+        """Whether state_elems covers every state commitment element"""
+        return self.state_commitment.depth == self.INDEX_PREFIX_LENGTHS['state_elems'] \
+                and self.STATE_ELEMS_COMPLETE_KEY in self.state_elems
+
+    def reindex_state_elems(self):
+        """Rebuild state_elems from scratch
+
+        Slow! Only needed for dbs created before the index existed.
+        """
+        if self.state_commitment.depth != self.INDEX_PREFIX_LENGTHS['state_elems']:
+            raise ValueError('state_elems can only index a state commitment of depth %d' % \
+                                self.INDEX_PREFIX_LENGTHS['state_elems'])
+
+        with self.batch():
+            for index_key in list(self.state_elems.keys()):
+                del self.state_elems[index_key]
+            for key, elem in self.iter_state_elems():
+                self.state_elems[self._state_elems_key(key, elem)] = elem
+            self.state_elems[self.STATE_ELEMS_COMPLETE_KEY] = b''
+
+    def iter_bucket_state_elems(self, prefix):
+        """Iterate over the elements in a bucket of the state commitment"""
+        if self.state_elems_complete:
+            for index_key, elem in self.state_elems.iter_prefix(prefix.encode('ascii')):
+                yield elem
+
+        else:
+            for key, elem in self.iter_state_elems():
+                if self.state_commitment.key_prefix(key) == prefix:
+                    yield elem
+
+    def _update_colordef_stats(self, colordef, **deltas):
+        """Add deltas to the named fields of a colordef's stats"""
+        if not any(deltas.values()):
+            return
+
+        stats = self.get_colordef_stats(colordef)
+        if stats is None:
+            return
+
+        for name, delta in deltas.items():
+            stats[name] += delta
+            assert stats[name] >= 0
+
+        self._set_index('colordef_stats', colordef.hash,
+                        self.COLORDEF_STATS.pack(*(stats[name] for name in self.COLORDEF_STATS_FIELDS)))
+
+    def get_colordef_stats(self, colordef):
+        """Return the running totals for a colordef
+
+        Returns a dict of:
+
+        issued    - color created by genesis outpoints and scriptPubKeys
+        unspent   - color held by colored outpoints not known to be spent
+        destroyed - color that transactions didn't send to any output
+        holders   - number of scriptPubKeys holding unspent color; genesis
+                    outpoints aren't counted as their scriptPubKeys aren't
+                    known
+
+        Returns None for colordefs added before stats were kept.
+        """
+        stats_bytes = self.colordef_stats.get(colordef.hash)
+        if stats_bytes is None:
+            return None
+        return dict(zip(self.COLORDEF_STATS_FIELDS, self.COLORDEF_STATS.unpack(stats_bytes)))
+
+    def get_colored_utxos(self, scriptPubKey):
+        """Return the unspent colored outpoints of a scriptPubKey
+
+        Returns a list of (outpoint, colordef hash, qty) tuples.
+        """
+        utxos = []
+        for key, value in sorted(self.scriptPubKey_utxos.iter_prefix(hashlib.sha256(scriptPubKey).digest())):
+            if len(key) == 64:
+                continue # SCRIPTPUBKEY_HOLDING entry
+
+            (qty,) = self.SCRIPTPUBKEY_UTXO.unpack(value)
+            utxos.append((COutPoint.deserialize(key[64:]), key[32:64], qty))
+        return utxos
+
+    def get_balance(self, scriptPubKey):
+        """Return the colored balance of a scriptPubKey: {colordef hash:qty}"""
+        balance = {}
+        for outpoint, colordef_hash, qty in self.get_colored_utxos(scriptPubKey):
+            balance[colordef_hash] = balance.get(colordef_hash, 0) + qty
+        return balance
+
+    def is_spent(self, outpoint):
+        """Return true if a colored outpoint is known to have been spent"""
+        return outpoint.serialize() in self.spent_outpoints
+
+    @property
+    def spent_outpoints_complete(self):
+        """Whether spent_outpoints covers every spend of a colored outpoint"""
+        return self.SPENT_OUTPOINTS_COMPLETE_KEY in self.spent_outpoints
+
+    def _iter_inferred_spends(self):
+        """Infer spends of colored outpoints from the transactions of the stored proofs
+
+        Yields (outpoint, spending txid) tuples.
+        """
+        for outpoint, colorproofs_by_colordef in self.colored_outpoints.items():
+            for colordef, colorproof_set in colorproofs_by_colordef.items():
+                for colorproof in colorproof_set:
+                    if isinstance(colorproof, TransferredColorProof):
+                        txid = colorproof.tx.GetHash()
+                        for txin in colorproof.tx.vin:
+                            yield (txin.prevout, txid)
+
+    def reindex_spent_outpoints(self):
+        """Record the spends implied by the stored proofs in spent_outpoints
+
+        Slow! Only needed for dbs created before spends were recorded.
+        """
+        spends = {outpoint.serialize():txid for outpoint, txid in self._iter_inferred_spends()
+                        if outpoint in self.colored_outpoints}
+
+        with self.batch():
+            for outpoint_bytes, txid in spends.items():
+                if outpoint_bytes not in self.spent_outpoints:
+                    self.spent_outpoints[outpoint_bytes] = txid
+            self.spent_outpoints[self.SPENT_OUTPOINTS_COMPLETE_KEY] = b''
+
+    # The (key, elem) pairs committed to by the state commitment. Elements are
+    # prefixed by a unique tag byte, followed by fixed length fields, so no two
+    # kinds of element can be confused for one another. Everything related to
+    # an outpoint is keyed by that outpoint, so differences between dbs can be
+    # localized to outpoints.
+    STATE_ELEM_COLORDEF = 1
+    STATE_ELEM_GENESIS_OUTPOINT = 2
+    STATE_ELEM_GENESIS_SCRIPTPUBKEY = 3
+    STATE_ELEM_COLORPROOF = 4
+
+    @classmethod
+    def _colordef_state_elem(cls, colordef):
+        return (colordef.hash,
+                bytes([cls.STATE_ELEM_COLORDEF]) + colordef.hash)
+
+    @classmethod
+    def _genesis_outpoint_state_elem(cls, outpoint, colordef):
+        return (outpoint.serialize(),
+                bytes([cls.STATE_ELEM_GENESIS_OUTPOINT]) + outpoint.serialize() + colordef.hash)
+
+    @classmethod
+    def _genesis_scriptPubKey_state_elem(cls, scriptPubKey, colordef):
+        return (bytes(scriptPubKey),
+                bytes([cls.STATE_ELEM_GENESIS_SCRIPTPUBKEY]) + colordef.hash + scriptPubKey)
+
+    @classmethod
+    def _colorproof_state_elem(cls, outpoint, colordef, colorproof):
+        return (outpoint.serialize(),
+                bytes([cls.STATE_ELEM_COLORPROOF]) + outpoint.serialize() + colordef.hash + colorproof.hash)
+
+    def _add_colorproof(self, outpoint, colordef, colorproof):
+        """Add a colorproof to colored_outpoints
+
+        Returns True if the proof was added, False if already present.
+        """
+        colorproof_set = self.colored_outpoints \
+                .setdefault(outpoint, {}) \
+                .setdefault(colordef, set())
+
+        if colorproof in colorproof_set:
+            return False
+
+        # Color is only counted once per outpoint, whatever the number of
+        # proofs for it.
+        new_colored_outpoint = not len(colorproof_set)
+
+        colorproof_set.add(colorproof)
+        self._state_add(*self._colorproof_state_elem(outpoint, colordef, colorproof))
+        self._update_best_colorproof(outpoint, colordef, colorproof)
+
+        if new_colored_outpoint and isinstance(colorproof, GenesisScriptPubKeyColorProof):
+            self._update_colordef_stats(colordef, issued=colorproof.qty)
+
+        if not self.is_spent(outpoint):
+            self._update_scriptPubKey_utxos(colorproof, colorproof.qty)
+            if new_colored_outpoint:
+                self._update_colordef_stats(colordef, unspent=colorproof.qty)
+
+        if self._block_undo is not None:
+            self._block_undo.append((self.UNDO_ADDED_COLORPROOF, outpoint, colordef, colorproof))
+        return True
+
+    def _remove_colorproof(self, outpoint, colordef, colorproof):
+        """Remove a colorproof from colored_outpoints
+
+        Outpoints and colordefs left without proofs are removed too.
+
+        Returns True if the proof was removed, False if not present.
+        """
+        colorproofs_by_colordef = self.colored_outpoints.get(outpoint)
+        if colorproofs_by_colordef is None:
+            return False
+
+        colorproof_set = colorproofs_by_colordef.get(colordef)
+        if colorproof_set is None or colorproof not in colorproof_set:
+            return False
+
+        colorproof_set.remove(colorproof)
+
+        best_colorproof_entries = self._get_best_colorproof_entries(outpoint)
+        if best_colorproof_entries.get(colordef.hash, (None,))[0] == colorproof.hash:
+            if len(colorproof_set):
+                best_colorproof = min(colorproof_set, key=self._best_colorproof_key)
+                best_colorproof_entries[colordef.hash] = (best_colorproof.hash,
+                                                          self.proof_priority_key(best_colorproof),
+                                                          best_colorproof.qty)
+            else:
+                del best_colorproof_entries[colordef.hash]
+            self._set_best_colorproof_entries(outpoint, best_colorproof_entries)
+
+        if not len(colorproof_set):
+            del colorproofs_by_colordef[colordef]
+            self._update_scriptPubKey_utxos(colorproof)
+            if not self.is_spent(outpoint):
+                self._update_colordef_stats(colordef, unspent=-colorproof.qty)
+            if not len(colorproofs_by_colordef):
+                del self.colored_outpoints[outpoint]
+
+        self._state_remove(*self._colorproof_state_elem(outpoint, colordef, colorproof))
+
+        if self._block_undo is not None:
+            self._block_undo.append((self.UNDO_REMOVED_COLORPROOF, outpoint, colordef, colorproof))
+
+        if outpoint not in self.colored_outpoints:
+            # Nothing left to index the outpoint for
+            self._pop_index('spent_outpoints', outpoint.serialize())
+            self._pop_index('outpoint_heights', outpoint.serialize())
+        return True
+
+    @staticmethod
+    def proof_priority_key(colorproof):
+        """Sort key putting the best of several proofs for an outpoint first
+
+        Genesis outpoints > scriptPubKey > transferred color > anything else
+        """
+        if isinstance(colorproof, GenesisOutPointColorProof):
+            return 0
+        elif isinstance(colorproof, GenesisScriptPubKeyColorProof):
+            return 1
+        elif isinstance(colorproof, TransferredColorProof):
+            return 2
+        else:
+            return 3
+
+    @property
+    def state_hash(self):
+        """Hash committing to the state of the database
+
+        Maintained incrementally, so unlike calc_state_hash() this is fast.
+        """
+        return self.state_commitment.digest()
+
     def addcolordef(self, colordef):
         """Add a color definition to the database"""
+        self._addcolordef(colordef)
+
+    def _addcolordef(self, colordef, *, genesis_proofs=True):
+        """Add a color definition
+
+        If genesis_proofs is false the proofs of the genesis outpoints aren't
+        added to colored_outpoints; used when they're added separately.
+        """
 
         # FIXME: add support for pruned definitions
         assert not colordef.is_pruned()
@@ -51,7 +807,18 @@ class ColorProofDb:
         if colordef in self.colordefs:
             return # already added, so we can stop now
 
+        # Trivially complete if nothing has been indexed yet
+        if not (self.best_colorproofs_complete and self.spent_outpoints_complete) \
+                and not any(True for outpoint in self.colored_outpoints):
+            self.best_colorproofs[self.BEST_COLORPROOFS_COMPLETE_KEY] = b''
+            self.spent_outpoints[self.SPENT_OUTPOINTS_COMPLETE_KEY] = b''
+        if not self.state_elems_complete and not any(True for other_colordef in self.colordefs):
+            self.state_elems[self.STATE_ELEMS_COMPLETE_KEY] = b''
+
         self.colordefs.add(colordef)
+        self._state_add(*self._colordef_state_elem(colordef))
+        self._set_index('colordef_stats', colordef.hash,
+                        self.COLORDEF_STATS.pack(sum(colordef.genesis_outpoints.values()), 0, 0, 0))
 
         for genesis_outpoint, qty in colordef.genesis_outpoints.items():
             outpoint_colordef_set = self.genesis_outpoints.setdefault(genesis_outpoint, set())
@@ -60,15 +827,14 @@ class ColorProofDb:
             # times.
             assert colordef not in outpoint_colordef_set
             outpoint_colordef_set.add(colordef)
+            self._state_add(*self._genesis_outpoint_state_elem(genesis_outpoint, colordef))
 
             # Genesis outpoints don't need the transactions themselves to be
             # proven, so create the corresponding proofs and add them to the
             # colored_outpoints
-            colorproof = GenesisOutPointColorProof(colordef, genesis_outpoint)
-            self.colored_outpoints \
-                .setdefault(genesis_outpoint, {}) \
-                .setdefault(colordef, set()) \
-                .add(colorproof)
+            if genesis_proofs:
+                colorproof = GenesisOutPointColorProof(colordef, genesis_outpoint)
+                self._add_colorproof(genesis_outpoint, colordef, colorproof)
 
         for genesis_scriptPubKey in colordef.genesis_scriptPubKeys:
             scriptPubKey_colordef_set = self.genesis_scriptPubKeys.setdefault(genesis_scriptPubKey, set())
@@ -77,6 +843,7 @@ class ColorProofDb:
             # times.
             assert colordef not in scriptPubKey_colordef_set
             scriptPubKey_colordef_set.add(colordef)
+            self._state_add(*self._genesis_scriptPubKey_state_elem(genesis_scriptPubKey, colordef))
 
     def addcolorproof(self, colorproof):
         """Add a color proof to the database"""
@@ -87,103 +854,565 @@ class ColorProofDb:
             for prevout_proof in colorproof.prevout_proofs.values():
                 self.addcolorproof(prevout_proof)
 
-        self.colored_outpoints \
-                .setdefault(colorproof.outpoint, {}) \
-                .setdefault(colorproof.colordef, set()) \
-                .add(colorproof)
+        self._add_colorproof(colorproof.outpoint, colorproof.colordef, colorproof)
 
     def addtx(self, tx):
         """Add a transaction to the database"""
+        self._connect_tx(tx, {}, frozenset(), None)
 
-        # FIXME: what should happen if you addtx() twice?
+    def addblock(self, block, height):
+        """Add all the transactions in a block to the database
 
-        colored_outpoints = {}
+        The block is added in a single batch. Outputs created and spent
+        within the block are looked up in memory rather than in the db, and
+        the height of every output proofs are created for is recorded in
+        outpoint_heights.
 
-        txid = tx.GetHash()
+        The block's hash and the changes it made are recorded so it can be
+        disconnected in a reorg. A block must not already have been added
+        at that height; disconnect it first.
+        """
+        height_bytes = struct.pack('<I', height)
+        if height_bytes in self.block_hashes:
+            raise ValueError('already have a block at height %d' % height)
 
-        # Create genesis scriptPubKey proofs for the txouts
-        for i, txout in enumerate(tx.vout):
-            outpoint = COutPoint(txid, i)
-            for colordef in self.genesis_scriptPubKeys.get(txout.scriptPubKey, set()):
-                colorproof = GenesisScriptPubKeyColorProof(colordef, outpoint, tx)
-                self.colored_outpoints \
-                    .setdefault(outpoint, {}) \
-                    .setdefault(colordef, set()) \
-                    .add(colorproof)
-
-        # Find colored inputs and sort the associated proofs by colordef
-        prevout_proof_sets_by_colordef = {}
-        for txin in tx.vin:
-            for colordef, colorproofs in self.colored_outpoints.get(txin.prevout, {}).items():
-                for colorproof in colorproofs:
-                    colordef_outpoints = prevout_proof_sets_by_colordef.setdefault(colorproof.colordef, {})
-                    outpoint_proofs = colordef_outpoints.setdefault(colorproof.outpoint, set())
+        # Outputs of earlier txs in the block: {COutPoint:{ColorDef:set(ColorProof)}}
+        block_colored_outpoints = {}
+        block_txids = frozenset(tx.GetHash() for tx in block.vtx)
 
-                    outpoint_proofs.add(colorproof)
+        with self.batch():
+            self._block_undo = []
+            try:
+                spent_outpoints = []
+                for i, tx in enumerate(block.vtx):
+                    self._connect_tx(tx, block_colored_outpoints, block_txids, height)
 
-        # With the prevout proofs sorted into colordef we can now apply the
-        # appropriate color kernel for each one.
-        for colordef, prevout_proof_sets_by_outpoint in prevout_proof_sets_by_colordef.items():
-            assert prevout_proof_sets_by_outpoint # should never be empty
-
-            # Create the color qty by txin prevout outpoint dict specific to
-            # this colordef that the apply_kernel() function needs.
-            color_qty_by_outpoint = {}
-
-            # We've stored *sets* of ColorProofs for each txin prevout
-            # outpoint; we want to pick just one proof out of each set. The
-            # reason why it's a set is because there may be more than one way
-            # to prove that a given outpoint is colored, for instance color may
-            # have been both validly transferred to it, and because it has been
-            # simultaneously declared as colored by the color definition.
-            #
-            # In addition the quantity of color proven may be different in each
-            # case. For now we'll just throw an assertion if that is detected,
-            # but in the future it may be desirable to change that behavior.
-
-            # The dict mapping txin prevout outpoint to ColorProof that we'll
-            # give to apply_kernel()
-            prevout_proofs = {}
-
-            for outpoint, prevout_proof_set in prevout_proof_sets_by_outpoint.items():
-                assert prevout_proof_set # should never be empty
-
-                # Sort the set of available proofs for this outpoint in priority order:
-                # genesis outpoints > scriptPubKey > transferred color > anything else
-                def proof_priority_key(proof):
-                    if isinstance(proof, GenesisOutPointColorProof):
-                        return 0
-                    elif isinstance(proof, GenesisScriptPubKeyColorProof):
-                        return 1
-                    elif isinstance(proof, TransferredColorProof):
-                        return 2
+                    if self.index_spends and not tx.is_coinbase():
+                        spend = self.SPEND.pack(tx.GetHash(), height, i)
+                        for txin in tx.vin:
+                            prevout_bytes = txin.prevout.serialize()
+                            self.spends[prevout_bytes] = spend
+                            spent_outpoints.append(prevout_bytes)
+
+                # Undone with a single entry, rather than one per input
+                if spent_outpoints:
+                    self._block_undo.append((self.UNDO_SPENDS, b''.join(spent_outpoints)))
+
+                block_undo = self._block_undo
+            finally:
+                self._block_undo = None
+
+            block_hash = block.GetHash()
+            self.block_hashes[height_bytes] = block_hash
+            self.block_undo[block_hash] = self._serialize_block_undo(block_undo)
+
+            if self.MAX_REORG_DEPTH is not None and height >= self.MAX_REORG_DEPTH:
+                old_height_bytes = struct.pack('<I', height - self.MAX_REORG_DEPTH)
+                old_block_hash = self.block_hashes.pop(old_height_bytes, None)
+                if old_block_hash is not None:
+                    self.block_undo.pop(old_block_hash, None)
+
+    def get_spend(self, outpoint):
+        """Return how an outpoint was spent
+
+        Returns (spending txid, height, index of the tx in its block), or None
+        if the spend isn't in the spends index.
+        """
+        spend = self.spends.get(outpoint.serialize())
+        if spend is None:
+            return None
+        return self.SPEND.unpack(spend)
+
+    def trace_colordef(self, colordef, get_tx):
+        """Trace a colordef added after the blocks spending it were scanned
+
+        Starting at the genesis outpoints, spends are followed through the
+        spends index with a ColorTracer, so only the transactions moving the
+        color are looked at; get_tx(txid, height, index) must return them.
+
+        Only complete if index_spends was set while every block spending the
+        color was scanned. Color issued to genesis scriptPubKeys by
+        transactions that don't spend it can't be found this way, and needs
+        a rescan.
+
+        Changes made to blocks that can still be disconnected are added to
+        their undo data.
+
+        Returns the tracer's ColorTraceStats.
+        """
+        self.addcolordef(colordef)
+
+        tracer = ColorTracer(colordef, self.get_spend, get_tx)
+        with self.batch():
+            # Transactions are traced in the order they were mined, so the undo
+            # data of each block is rewritten once, after its last traced
+            # transaction.
+            undo_block_hash = None
+            block_undo = []
+            def write_block_undo():
+                if block_undo:
+                    # Appended in place of the UNDO_END entry
+                    old_block_undo = self.block_undo[undo_block_hash]
+                    assert old_block_undo.endswith(bytes([self.UNDO_END]))
+                    self.block_undo[undo_block_hash] = old_block_undo[:-1] + self._serialize_block_undo(block_undo)
+
+            for tx, height, index, prevout_proofs, colorproofs in tracer.iter_txs():
+                block_hash = self.get_block_hash(height)
+                if block_hash != undo_block_hash:
+                    write_block_undo()
+                    undo_block_hash = block_hash
+                    block_undo = []
+
+                self._block_undo = block_undo if block_hash is not None else None
+                try:
+                    self._connect_tx(tx, {}, frozenset(), height, colordefs={colordef},
+                                     traced=(prevout_proofs, colorproofs))
+                finally:
+                    self._block_undo = None
+
+            write_block_undo()
+
+        return tracer.stats
+
+    def get_block_hash(self, height):
+        """Return the hash of the block added at height, or None"""
+        return self.block_hashes.get(struct.pack('<I', height))
+
+    def disconnect_block(self, height):
+        """Undo the changes made by the block added at height
+
+        The block must be the most recent one added, and its undo data must
+        not have been discarded as older than MAX_REORG_DEPTH.
+
+        Returns the hash of the disconnected block.
+        """
+        height_bytes = struct.pack('<I', height)
+        block_hash = self.block_hashes.get(height_bytes)
+        if block_hash is None:
+            raise KeyError('no block at height %d' % height)
+        if struct.pack('<I', height + 1) in self.block_hashes:
+            raise ValueError('block at height %d is not the tip' % height)
+
+        block_undo = self._deserialize_block_undo(self.block_undo[block_hash])
+
+        with self.batch():
+            for entry_type, *entry in reversed(block_undo):
+                if entry_type == self.UNDO_ADDED_COLORPROOF:
+                    outpoint, colordef_hash, colorproof_hash = entry
+                    for colordef, colorproofs in list(self.colored_outpoints.get(outpoint, {}).items()):
+                        if colordef.hash == colordef_hash:
+                            for colorproof in list(colorproofs):
+                                if colorproof.hash == colorproof_hash:
+                                    self._remove_colorproof(outpoint, colordef, colorproof)
+
+                elif entry_type == self.UNDO_REMOVED_COLORPROOF:
+                    outpoint, colorproof = entry
+                    self._add_colorproof(outpoint, colorproof.colordef, colorproof)
+
+                elif entry_type == self.UNDO_SPENDS:
+                    (spent_outpoints,) = entry
+                    for i in range(0, len(spent_outpoints), 36):
+                        self.spends.pop(spent_outpoints[i:i+36], None)
+
+                else:
+                    index_name, key, value = entry
+                    if value is None:
+                        getattr(self, index_name).pop(key, None)
                     else:
-                        return 3
+                        getattr(self, index_name)[key] = value
+
+            del self.block_undo[block_hash]
+            del self.block_hashes[height_bytes]
+
+        return block_hash
+
+    # Undo entries, recorded while a block is added. Removed proofs are
+    # stored in full as nothing else may refer to them.
+    UNDO_END = 0
+    UNDO_ADDED_COLORPROOF = 1   # outpoint, colordef hash, colorproof hash
+    UNDO_REMOVED_COLORPROOF = 2 # outpoint, colorproof
+    UNDO_INDEX = 3              # index name, key, previous value if any
+    UNDO_SPENDS = 4             # serialized outpoints whose spends entries were
+                                # added; as an outpoint can only be spent
+                                # once there's no previous value
+
+    @classmethod
+    def _serialize_block_undo(cls, block_undo):
+        ctx = proofmarshal.BytesSerializationContext()
+        for entry_type, *entry in block_undo:
+            ctx.write_varuint('entry_type', entry_type)
+
+            if entry_type == cls.UNDO_ADDED_COLORPROOF:
+                outpoint, colordef, colorproof = entry
+                ctx.write_bytes('outpoint', outpoint.serialize(), 36)
+                ctx.write_bytes('colordef_hash', colordef.hash, 32)
+                ctx.write_bytes('colorproof_hash', colorproof.hash, 32)
+
+            elif entry_type == cls.UNDO_REMOVED_COLORPROOF:
+                outpoint, colordef, colorproof = entry
+                ctx.write_bytes('outpoint', outpoint.serialize(), 36)
+                ctx.write_obj('colorproof', colorproof)
+
+            elif entry_type == cls.UNDO_SPENDS:
+                (spent_outpoints,) = entry
+                ctx.write_bytes('outpoints', spent_outpoints)
+
+            else:
+                index_name, key, value = entry
+                ctx.write_bytes('index_name', index_name.encode('utf8'))
+                ctx.write_bytes('key', key)
+                ctx.write_varuint('has_value', int(value is not None))
+                if value is not None:
+                    ctx.write_bytes('value', value)
+
+        ctx.write_varuint('entry_type', cls.UNDO_END)
+        return ctx.getbytes()
+
+    @classmethod
+    def _deserialize_block_undo(cls, buf):
+        ctx = proofmarshal.BytesDeserializationContext(buf)
+        block_undo = []
+        while True:
+            entry_type = ctx.read_varuint('entry_type')
+
+            if entry_type == cls.UNDO_END:
+                return block_undo
+
+            elif entry_type == cls.UNDO_ADDED_COLORPROOF:
+                block_undo.append((entry_type,
+                                   COutPoint.deserialize(ctx.read_bytes('outpoint', 36)),
+                                   ctx.read_bytes('colordef_hash', 32),
+                                   ctx.read_bytes('colorproof_hash', 32)))
+
+            elif entry_type == cls.UNDO_REMOVED_COLORPROOF:
+                block_undo.append((entry_type,
+                                   COutPoint.deserialize(ctx.read_bytes('outpoint', 36)),
+                                   ctx.read_obj('colorproof', ColorProof)))
+
+            elif entry_type == cls.UNDO_SPENDS:
+                block_undo.append((entry_type, ctx.read_bytes('outpoints')))
+
+            elif entry_type == cls.UNDO_INDEX:
+                index_name = ctx.read_bytes('index_name').decode('utf8')
+                key = ctx.read_bytes('key')
+                value = ctx.read_bytes('value') if ctx.read_varuint('has_value') else None
+                block_undo.append((entry_type, index_name, key, value))
 
-                best_proof = next(iter(sorted(prevout_proof_set, key=proof_priority_key)))
+            else:
+                raise proofmarshal.DeserializationError('unknown undo entry type %d' % entry_type)
 
-                # Make sure that the color quantities proven by all proofs are
-                # identical. (for now)
-                assert all(prevout_proof.qty == best_proof.qty for prevout_proof in prevout_proof_set)
+    def get_height(self, outpoint):
+        """Return the height of the block that created a colored outpoint
 
-                prevout_proofs[outpoint] = best_proof
+        Returns None if unknown; only outpoints added by addblock() have
+        heights.
+        """
+        height_bytes = self.outpoint_heights.get(outpoint.serialize())
+        if height_bytes is None:
+            return None
+        return struct.unpack('<I', height_bytes)[0]
+
+    def _connect_tx(self, tx, block_colored_outpoints, block_txids, height, *, colordefs=None, traced=None):
+        """Add a transaction, possibly as part of a block
+
+        Prevouts whose txids are in block_txids were created earlier in the
+        same block, and their proofs are looked up in
+        block_colored_outpoints, which the proofs created for tx are added
+        to. If height isn't None it's recorded for the outpoints of those
+        proofs.
+
+        If colordefs isn't None only the color of those colordefs is moved.
+        traced is the (prevout_proofs, colorproofs) a ColorTracer yielded for
+        tx, if any; the tracer's proofs are then used as-is, rather than
+        looking up the prevout proofs and applying the kernel again.
+        """
+
+        # FIXME: what should happen if you addtx() twice?
+
+        txid = tx.GetHash()
+        traced_prevout_proofs, colorproofs = traced if traced is not None else (None, None)
+
+        def in_block(outpoint):
+            # Genesis outpoint proofs are only ever in the db
+            return outpoint.hash in block_txids and outpoint not in self.genesis_outpoints
+
+        def get_colorproofs_by_colordef(outpoint):
+            if in_block(outpoint):
+                return block_colored_outpoints.get(outpoint, {})
+            return self.colored_outpoints.get(outpoint, {})
+
+        def get_best_colorproofs(outpoint):
+            if traced_prevout_proofs is not None:
+                colorproof = traced_prevout_proofs.get(outpoint)
+                return {colorproof.colordef:colorproof} if colorproof is not None else {}
+
+            if in_block(outpoint):
+                best_colorproofs = {colordef:min(colorproofs, key=self._best_colorproof_key)
+                                        for colordef, colorproofs in block_colored_outpoints.get(outpoint, {}).items()}
+            else:
+                best_colorproofs = self.get_best_colorproofs(outpoint)
+
+            if colordefs is not None:
+                best_colorproofs = {colordef:colorproof for colordef, colorproof in best_colorproofs.items()
+                                        if colordef in colordefs}
+            return best_colorproofs
+
+        def add_colorproof(outpoint, colordef, colorproof):
+            self._add_colorproof(outpoint, colordef, colorproof)
+            if block_txids:
+                block_colored_outpoints.setdefault(outpoint, {}).setdefault(colordef, set()).add(colorproof)
+            if height is not None:
+                self._set_index('outpoint_heights', outpoint.serialize(), struct.pack('<I', height))
+
+        # Create genesis scriptPubKey proofs for the txouts
+        if colorproofs is None:
+            for i, txout in enumerate(tx.vout):
+                outpoint = COutPoint(txid, i)
+                for colordef in self.genesis_scriptPubKeys.get(txout.scriptPubKey, set()):
+                    if colordefs is not None and colordef not in colordefs:
+                        continue
+                    colorproof = GenesisScriptPubKeyColorProof(colordef, outpoint, tx)
+                    add_colorproof(outpoint, colordef, colorproof)
+
+        else:
+            for colorproof in colorproofs:
+                if isinstance(colorproof, GenesisScriptPubKeyColorProof):
+                    add_colorproof(colorproof.outpoint, colorproof.colordef, colorproof)
+
+        # There may be more than one way to prove that a given outpoint is
+        # colored, for instance color may have been both validly transferred
+        # to it, and because it has been simultaneously declared as colored by
+        # the color definition. The best of those proofs was picked when they
+        # were added, which also checked that they all prove the same
+        # quantity of color, so only it is needed.
+        best_colorproofs_by_prevout = {}
+        prevout_proofs_by_colordef = {}
+        for txin in tx.vin:
+            best_colorproofs = get_best_colorproofs(txin.prevout)
+            best_colorproofs_by_prevout[txin.prevout] = best_colorproofs
+            for colordef, colorproof in best_colorproofs.items():
+                prevout_proofs_by_colordef.setdefault(colordef, {})[txin.prevout] = colorproof
+
+        # With the prevout proofs sorted into colordef we can now apply the
+        # appropriate color kernel for each one.
+        for colordef, prevout_proofs in prevout_proofs_by_colordef.items():
+            assert prevout_proofs # should never be empty
 
             # Now we can finally apply the kernel and start creating proofs for
             # the color movement for each colored output
             color_qty_by_outpoint = {outpoint:colorproof.qty for outpoint, colorproof in prevout_proofs.items()}
-            for i, qty in enumerate(colordef.apply_kernel(tx, color_qty_by_outpoint)):
+            if colorproofs is None:
+                transferred_colorproofs = []
+                for i, qty in enumerate(colordef.apply_kernel(tx, color_qty_by_outpoint)):
 
-                if qty is None:
-                    continue # Output isn't colored!
+                    if qty is None:
+                        continue # Output isn't colored!
 
-                outpoint = COutPoint(txid, i)
-                colorproof = TransferredColorProof(colordef, outpoint, tx, prevout_proofs)
-                assert colorproof.qty == qty
-                self.colored_outpoints \
-                    .setdefault(outpoint, {}) \
-                    .setdefault(colordef, set()) \
-                    .add(colorproof)
+                    colorproof = TransferredColorProof(colordef, COutPoint(txid, i), tx, prevout_proofs)
+                    assert colorproof.qty == qty
+                    transferred_colorproofs.append(colorproof)
+
+            else:
+                transferred_colorproofs = [colorproof for colorproof in colorproofs
+                                               if isinstance(colorproof, TransferredColorProof) and colorproof.colordef == colordef]
+
+            # Whatever the kernel didn't send to an output is destroyed
+            self._update_colordef_stats(colordef,
+                    destroyed=sum(color_qty_by_outpoint.values()) - sum(colorproof.qty for colorproof in transferred_colorproofs))
+
+            for colorproof in transferred_colorproofs:
+                outpoint = colorproof.outpoint
+
+                if self.prune_proofs:
+                    # Prevout proofs created by earlier addtx() calls are
+                    # already pruned; proofs added by addcolorproof() are
+                    # used as-is.
+                    colorproof = colorproof.prune(recursive=False)
+
+                add_colorproof(outpoint, colordef, colorproof)
+
+        # Finally the colored prevouts are spent
+        for txin in tx.vin:
+            best_colorproofs = best_colorproofs_by_prevout[txin.prevout]
+            if not best_colorproofs:
+                continue
+
+            if self.utxo_only:
+                for colordef, colorproofs in list(get_colorproofs_by_colordef(txin.prevout).items()):
+                    if colordef not in best_colorproofs:
+                        continue
+                    for colorproof in list(colorproofs):
+                        self._remove_colorproof(txin.prevout, colordef, colorproof)
+                block_colored_outpoints.pop(txin.prevout, None)
+
+            elif not self.is_spent(txin.prevout):
+                self._set_index('spent_outpoints', txin.prevout.serialize(), txid)
+
+                for colordef, best_colorproof in best_colorproofs.items():
+                    self._update_colordef_stats(colordef, unspent=-best_colorproof.qty)
+
+                    # Genesis outpoint proofs don't say what the scriptPubKey
+                    # is, but any other proofs of the outpoint will.
+                    if not self._update_scriptPubKey_utxos(best_colorproof):
+                        for colorproof in get_colorproofs_by_colordef(txin.prevout)[colordef]:
+                            if self._update_scriptPubKey_utxos(colorproof):
+                                break
+
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Group a series of changes to the database
+
+        Backends that support it commit everything done within the batch
+        atomically, and amortize the cost of committing over the whole batch.
+        Batches may be nested; only the outermost one commits.
+
+        A no-op for the in-memory db.
+        """
+        yield self
+
+    @contextlib.contextmanager
+    def snapshot(self):
+        """Read from a consistent snapshot of the db
+
+        Backends that may be written to by other processes make sure
+        everything read within the with block comes from the same version of
+        the db, raising ColorProofDbConcurrentWriteError if that's not
+        possible.
+        """
+        yield self
+
+    def snapshot_read(self, func, *, max_attempts=10):
+        """Call func(self) within snapshot(), retrying on concurrent writes
+
+        Returns the return value of func.
+        """
+        for attempt in range(max_attempts):
+            try:
+                with self.snapshot():
+                    return func(self)
+            except ColorProofDbConcurrentWriteError:
+                if attempt == max_attempts - 1:
+                    raise
+
+    def iter_superseded_colorproofs(self):
+        """Iterate over proofs for which a better proof of the same outpoint exists
+
+        Yields (outpoint, colordef, colorproof) tuples.
+        """
+        for outpoint, colorproofs_by_colordef in self.colored_outpoints.items():
+            for colordef, colorproof_set in colorproofs_by_colordef.items():
+                colorproofs = sorted(colorproof_set, key=self._best_colorproof_key)
+                for colorproof in colorproofs[1:]:
+                    yield (outpoint, colordef, colorproof)
+
+    def iter_spent_colorproofs(self):
+        """Iterate over proofs for outpoints known to be spent
+
+        Spends are recorded by addtx(); until spent_outpoints has been
+        reindexed, dbs created before that have spends inferred from the
+        transactions of the stored proofs, which means reading them all. The
+        spent proofs remain part of the proofs of any outputs color moved to.
+
+        Yields (outpoint, colordef, colorproof) tuples.
+        """
+        spent_outpoints = {COutPoint.deserialize(outpoint_bytes) for outpoint_bytes in self.spent_outpoints.keys()
+                                if outpoint_bytes != self.SPENT_OUTPOINTS_COMPLETE_KEY}
+
+        if not self.spent_outpoints_complete:
+            spent_outpoints.update(outpoint for outpoint, txid in self._iter_inferred_spends())
+
+        for outpoint in spent_outpoints:
+            for colordef, colorproof_set in self.colored_outpoints.get(outpoint, {}).items():
+                for colorproof in colorproof_set:
+                    yield (outpoint, colordef, colorproof)
+
+    def gc(self, *, superseded=True, spent=False):
+        """Remove proofs that are no longer needed
+
+        superseded - remove proofs for which a better proof of the same
+                     outpoint exists
+        spent      - remove proofs of outpoints known to be spent
+
+        Returns the number of proofs removed.
+        """
+        doomed = set()
+        if superseded:
+            doomed.update(self.iter_superseded_colorproofs())
+        if spent:
+            doomed.update(self.iter_spent_colorproofs())
+
+        n = 0
+        with self.batch():
+            for outpoint, colordef, colorproof in doomed:
+                n += self._remove_colorproof(outpoint, colordef, colorproof)
+        return n
+
+    def compact(self):
+        """Reclaim space left behind by removed data
+
+        Returns a dict of backend-specific statistics.
+        """
+        return {}
+
+    def close(self):
+        """Release any resources held by the database"""
+        pass
+
+    def iter_state_elems(self):
+        """Iterate over all (key, elem) pairs committed to by the state commitment"""
+        for colordef in self.colordefs:
+            yield self._colordef_state_elem(colordef)
+
+        for outpoint, colordef_set in self.genesis_outpoints.items():
+            for colordef in colordef_set:
+                yield self._genesis_outpoint_state_elem(outpoint, colordef)
+
+        for scriptPubKey, colordef_set in self.genesis_scriptPubKeys.items():
+            for colordef in colordef_set:
+                yield self._genesis_scriptPubKey_state_elem(scriptPubKey, colordef)
+
+        for outpoint, colorproof_sets_by_colordef in self.colored_outpoints.items():
+            for colordef, colorproof_set in colorproof_sets_by_colordef.items():
+                for colorproof in colorproof_set:
+                    yield self._colorproof_state_elem(outpoint, colordef, colorproof)
+
+    def calc_state_commitment(self):
+        """Calculate the state commitment from scratch
+
+        Returns a StateTree that should equal state_commitment.
+        """
+        state_commitment = StateTree(depth=self.state_commitment.depth)
+        for key, elem in self.iter_state_elems():
+            state_commitment.add(key, elem)
+        return state_commitment
+
+    def diff_state(self, other):
+        """Find the differences between the state of this db and another
+
+        Only the elements in buckets of the state commitment that differ are
+        read, so unless either db's state_elems index is incomplete the work
+        done is proportional to the number of differences.
+
+        Returns (only_in_self, only_in_other), sets of state elements. See
+        the STATE_ELEM_* constants for their format.
+        """
+        differing_buckets = self.state_commitment.diff(other.state_commitment)
+        if not differing_buckets:
+            return (set(), set())
+
+        def get_elems(db):
+            if not db.state_elems_complete:
+                # Better one pass over the db than one per bucket
+                return {elem for key, elem in db.iter_state_elems()
+                                if db.state_commitment.key_prefix(key) in differing_buckets}
+
+            return {elem for prefix in differing_buckets
+                            for elem in db.iter_bucket_state_elems(prefix)}
 
+        self_elems = get_elems(self)
+        other_elems = get_elems(other)
+        return (self_elems - other_elems, other_elems - self_elems)
 
     def calc_state_hash(self):
         """Calculate a hash representing the state of the database"""
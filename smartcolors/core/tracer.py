@@ -0,0 +1,140 @@
+# Copyright (C) 2014 Peter Todd <pete@petertodd.org>
+#
+# This file is part of python-smartcolors.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of python-smartcolors, including this file, may be copied, modified,
+# propagated, or distributed except according to the terms contained in the
+# LICENSE file.
+
+import heapq
+
+from bitcoin.core import COutPoint
+
+from smartcolors.core import (
+        GenesisOutPointColorProof,
+        GenesisScriptPubKeyColorProof,
+        TransferredColorProof
+)
+
+class ColorTraceStats:
+    """Statistics of a ColorTracer traversal
+
+    txs                 - number of transactions traced
+    colorproofs         - number of proofs created for reached outputs
+    spend_lookups       - number of times the spends index was consulted
+    kernel_applications - number of times the color kernel is applied
+    max_frontier        - largest number of spends waiting to be traced
+    """
+
+    def __init__(self):
+        self.txs = 0
+        self.colorproofs = 0
+        self.spend_lookups = 0
+        self.kernel_applications = 0
+        self.max_frontier = 0
+
+    def __repr__(self):
+        return 'ColorTraceStats(txs=%d, colorproofs=%d, spend_lookups=%d, kernel_applications=%d, max_frontier=%d)' % \
+                (self.txs, self.colorproofs, self.spend_lookups, self.kernel_applications, self.max_frontier)
+
+class ColorTracer:
+    """Trace a color forward from its genesis outpoints through spends
+
+    Rather than scanning every transaction, only the transactions spending
+    colored outputs are looked at.
+
+    get_spend(outpoint)        - returns (spending txid, height, index of the
+                                 tx in its block), or None if unspent;
+                                 ColorProofDb.get_spend() for instance
+    get_tx(txid, height, index) - returns the spending transaction
+
+    The frontier of spends waiting to be traced is ordered by where they were
+    mined, rather than first-in first-out, so a transaction spending more than
+    one colored output is only traced once all of them have been reached.
+
+    colored_outpoints - outputs reached and not spent: {COutPoint:ColorProof};
+                        once traced, every output currently colored
+    stats             - ColorTraceStats of the traversal so far
+
+    Color issued to genesis scriptPubKeys by transactions that don't spend the
+    color isn't found.
+    """
+
+    def __init__(self, colordef, get_spend, get_tx):
+        self.colordef = colordef
+        self.get_spend = get_spend
+        self.get_tx = get_tx
+
+        self.colored_outpoints = {}
+        self.stats = ColorTraceStats()
+
+    def iter_txs(self):
+        """Trace the color, yielding each transaction spending it
+
+        Yields (tx, height, index, prevout_proofs, colorproofs) tuples in the
+        order the transactions were mined, where prevout_proofs are the
+        {prevout:colorproof} proofs of the color tx spends, and colorproofs
+        are the proofs created for the outputs of tx. Those with more than one
+        proof are in colored_outpoints as the one ColorProofDb would consider
+        best.
+        """
+        frontier = [] # (height, index, txid)
+        traced_txids = set()
+
+        def add_spend(outpoint):
+            self.stats.spend_lookups += 1
+            spend = self.get_spend(outpoint)
+            if spend is not None and spend[0] not in traced_txids:
+                txid, height, index = spend
+                traced_txids.add(txid)
+                heapq.heappush(frontier, (height, index, txid))
+                self.stats.max_frontier = max(self.stats.max_frontier, len(frontier))
+
+        for outpoint in self.colordef.genesis_outpoints:
+            self.colored_outpoints[outpoint] = GenesisOutPointColorProof(self.colordef, outpoint)
+            add_spend(outpoint)
+
+        while frontier:
+            height, index, txid = heapq.heappop(frontier)
+            tx = self.get_tx(txid, height, index)
+            assert tx.GetHash() == txid
+            self.stats.txs += 1
+
+            prevout_proofs = {txin.prevout:self.colored_outpoints.pop(txin.prevout)
+                                for txin in tx.vin if txin.prevout in self.colored_outpoints}
+            assert prevout_proofs # only spends of colored outputs are traced
+
+            color_qtys_out = self.colordef.apply_kernel(tx, {outpoint:colorproof.qty
+                                                                for outpoint, colorproof in prevout_proofs.items()})
+            self.stats.kernel_applications += 1
+
+            colorproofs = []
+            for i, (txout, qty) in enumerate(zip(tx.vout, color_qtys_out)):
+                outpoint = COutPoint(txid, i)
+
+                # Added in order of increasing priority
+                outpoint_colorproofs = []
+                if qty is not None:
+                    colorproof = TransferredColorProof(self.colordef, outpoint, tx, prevout_proofs)
+
+                    # The kernel was just applied to the same prevout proofs
+                    object.__setattr__(colorproof, '_cached_qty', qty)
+                    outpoint_colorproofs.append(colorproof)
+                if txout.scriptPubKey in self.colordef.genesis_scriptPubKeys:
+                    outpoint_colorproofs.append(GenesisScriptPubKeyColorProof(self.colordef, outpoint, tx))
+
+                if outpoint_colorproofs:
+                    self.colored_outpoints[outpoint] = outpoint_colorproofs[-1]
+                    colorproofs.extend(outpoint_colorproofs)
+                    add_spend(outpoint)
+
+            self.stats.colorproofs += len(colorproofs)
+            yield tx, height, index, prevout_proofs, colorproofs
+
+    def trace(self):
+        """Trace the color, yielding the proofs created for every reached output"""
+        for tx, height, index, prevout_proofs, colorproofs in self.iter_txs():
+            yield from colorproofs
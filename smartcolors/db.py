@@ -9,8 +9,21 @@
 # propagated, or distributed except according to the terms contained in the
 # LICENSE file.
 
+import collections
+import collections.abc
+import contextlib
+import fcntl
+import hashlib
+import io
+import json
+import logging
 import os
+import pickle
+import sqlite3
+import struct
 import tempfile
+import time
+import zlib
 
 from bitcoin.core import b2x, b2lx, lx, x
 import bitcoin.core
@@ -19,16 +32,465 @@ import bitcoin.core.script
 import smartcolors.core.db
 import smartcolors.io
 
-class PersistentSet:
-    """File-backed set"""
+class ColorProofDbLockedError(Exception):
+    """Another process has the db open for writing"""
+    pass
 
-    def __init__(self, *, root_dir_path):
+class ColorProofDbWriterLock:
+    """Lock held by the one process allowed to write to a db
+
+    A POSIX record lock on a file in the db directory, so it's released
+    automatically if the writer dies, and only excludes other processes.
+    """
+
+    FILENAME = 'lock'
+
+    def __init__(self, root_dir_path):
+        self.path = os.path.join(root_dir_path, self.FILENAME)
+        self.fd = None
+
+    def acquire(self):
+        """Acquire the lock, raising ColorProofDbLockedError if held"""
+        assert self.fd is None
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        fd = open(self.path, 'ab')
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            fd.close()
+            raise ColorProofDbLockedError('%s is locked by another writer' % os.path.dirname(self.path))
+        self.fd = fd
+
+    def release(self):
+        if self.fd is not None:
+            self.fd.close()
+            self.fd = None
+
+class PersistentWriteBuffer:
+    """Writes buffered by PersistentColorProofDb.batch()
+
+    While a batch is active new and removed files are held in memory, and
+    are visible to readers going through the buffer. On commit new files are
+    written out as temporary files, a journal listing every change is
+    written, and then the changes are applied. If interrupted, the journal
+    is replayed the next time the db is opened, so either all or none of the
+    batch is applied.
+
+    fsync - if true commits are synced to disk; rather than syncing every
+            file and directory touched, which costs a sync per proof, the
+            filesystem is synced once before the journal is published and
+            once after it has been applied, and only the journal itself is
+            fsynced individually
+
+    The generation file is a counter incremented before and after changes
+    are applied, so it's odd while the db is being changed. Readers in
+    other processes compare the generation before and after reading to
+    detect that they may have seen a partially applied change.
+    """
+
+    JOURNAL_FILENAME = 'batch-journal'
+    GENERATION_FILENAME = 'generation'
+
+    # Modes of pending changes
+    MODE_NEW = 'new'          # new file, which must not already exist
+    MODE_REPLACE = 'replace'  # file replacing any existing file
+    MODE_LINK = 'link'        # hardlink to another, possibly pending, file
+    MODE_UNLINK = 'unlink'    # file removed
+    MODE_RMDIR = 'rmdir'      # directory removed if empty
+
+    def __init__(self, *, root_dir_path, fsync=True):
+        self.root_dir_path = os.path.abspath(root_dir_path)
+        self.fsync = fsync
+
+        self.depth = 0
+        self.pending = collections.OrderedDict() # {abspath:(data or link target, elem, mode)}
+        self.pending_children = {} # {dir abspath:set(names)}
+
+    @property
+    def active(self):
+        return self.depth > 0
+
+    def add_file(self, abspath, data, elem=None, *, replace=False):
+        """Add a file to be written on commit
+
+        If replace is true the file replaces any existing file; otherwise the
+        file must not exist already.
+        """
+        self._add_pending(abspath, data, elem, self.MODE_REPLACE if replace else self.MODE_NEW)
+
+    def add_link(self, abspath, target_abspath, elem=None):
+        """Add a hardlink to be created on commit
+
+        The target may itself be pending.
+        """
+        self._add_pending(abspath, target_abspath, elem, self.MODE_LINK)
+
+    def _add_pending(self, abspath, data, elem, mode):
+        self.pending[abspath] = (data, elem, mode)
+        self.pending.move_to_end(abspath)
+
+        # Make the new file, and any directories it creates, visible to
+        # listdir()
+        while abspath != self.root_dir_path:
+            dir_path, name = os.path.split(abspath)
+            self.pending_children.setdefault(dir_path, set()).add(name)
+
+            # Directories can't be both created and removed
+            if self.pending.get(dir_path, (None, None, None))[2] == self.MODE_RMDIR:
+                del self.pending[dir_path]
+
+            abspath = dir_path
+
+    def _forget_child(self, abspath):
+        dir_path, name = os.path.split(abspath)
+        self.pending_children.get(dir_path, set()).discard(name)
+
+    def unlink(self, abspath):
+        """Remove a file on commit"""
+        mode = self.pending.get(abspath, (None, None, None))[2]
+        if mode in (self.MODE_NEW, self.MODE_LINK):
+            del self.pending[abspath]
+            self._forget_child(abspath)
+
+            if not os.path.exists(abspath):
+                return # never written, so nothing to remove
+
+        self.pending[abspath] = (None, None, self.MODE_UNLINK)
+        self.pending.move_to_end(abspath)
+
+    def rmdir(self, abspath):
+        """Remove a directory on commit, if it's empty by then"""
+        self.pending_children.pop(abspath, None)
+        self._forget_child(abspath)
+        self.pending[abspath] = (None, None, self.MODE_RMDIR)
+        self.pending.move_to_end(abspath)
+
+    def exists(self, abspath):
+        """Whether a path exists, taking into account pending changes
+
+        Returns None if unknown to the buffer.
+        """
+        try:
+            mode = self.pending[abspath][2]
+        except KeyError:
+            if abspath in self.pending_children:
+                return True
+            return None
+        else:
+            return mode not in (self.MODE_UNLINK, self.MODE_RMDIR)
+
+    def listdir(self, dir_path):
+        try:
+            names = set(os.listdir(dir_path))
+        except FileNotFoundError:
+            names = set()
+        names.update(self.pending_children.get(dir_path, ()))
+
+        if self.pending:
+            names = {name for name in names
+                        if self.exists(os.path.join(dir_path, name)) is not False}
+        return names
+
+    def get_pending_elem(self, abspath):
+        """Return the element for a pending file, or None"""
+        try:
+            return self.pending[abspath][1]
+        except KeyError:
+            return None
+
+    def discard(self):
+        self.pending = collections.OrderedDict()
+        self.pending_children = {}
+
+    def read_generation(self):
+        try:
+            with open(os.path.join(self.root_dir_path, self.GENERATION_FILENAME), 'r') as fd:
+                return int(fd.read())
+        except FileNotFoundError:
+            return 0
+
+    def _write_generation(self, generation):
+        # Only used to detect concurrent changes, so never synced.
+        with tempfile.NamedTemporaryFile('w', dir=self.root_dir_path,
+                                         prefix=self.GENERATION_FILENAME + '-tmp-', delete=False) as fd:
+            fd.write(str(generation))
+        os.replace(fd.name, os.path.join(self.root_dir_path, self.GENERATION_FILENAME))
+
+    def begin_update(self):
+        """Mark the db as being changed; a no-op if already marked"""
+        generation = self.read_generation()
+        if not generation % 2:
+            self._write_generation(generation + 1)
+
+    def end_update(self):
+        """Mark the db as no longer being changed"""
+        generation = self.read_generation()
+        if generation % 2:
+            self._write_generation(generation + 1)
+
+    def _fsync_dir(self, dir_path):
+        fd = os.open(dir_path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def commit(self):
+        if not self.pending:
+            return
+
+        journal = []
+        rmdirs = []
+        for abspath, (data, elem, mode) in self.pending.items():
+            relpath = os.path.relpath(abspath, self.root_dir_path)
+
+            if mode == self.MODE_RMDIR:
+                rmdirs.append((None, relpath, mode))
+                continue
+
+            elif mode == self.MODE_UNLINK:
+                journal.append((None, relpath, mode))
+                continue
+
+            dir_path, name = os.path.split(abspath)
+            os.makedirs(dir_path, exist_ok=True)
+
+            if mode == self.MODE_LINK:
+                journal.append((os.path.relpath(data, self.root_dir_path), relpath, mode))
+                continue
+
+            with tempfile.NamedTemporaryFile(dir=dir_path, prefix=name + '-tmp-', delete=False) as fd:
+                fd.write(data)
+
+            journal.append((os.path.relpath(fd.name, self.root_dir_path), relpath, mode))
+
+        # Directories are removed last, deepest first, after their contents
+        journal.extend(sorted(rmdirs, key=lambda entry: entry[1].count(os.sep), reverse=True))
+
+        # The temporary files must be on disk before the journal that refers
+        # to them is published.
+        if self.fsync:
+            os.sync()
+
+        # Writing the journal is the commit point
+        with tempfile.NamedTemporaryFile('w', dir=self.root_dir_path,
+                                         prefix=self.JOURNAL_FILENAME + '-tmp-', delete=False) as fd:
+            json.dump(journal, fd)
+            if self.fsync:
+                fd.flush()
+                os.fsync(fd.fileno())
+        os.replace(fd.name, os.path.join(self.root_dir_path, self.JOURNAL_FILENAME))
+        if self.fsync:
+            self._fsync_dir(self.root_dir_path)
+
+        self.begin_update()
+        self._apply_journal(journal)
+        self.end_update()
+        self.discard()
+
+    def _apply_journal(self, journal):
+        # Entries are applied in order, so links to new files come after the
+        # files themselves.
+        for src_relpath, relpath, mode in journal:
+            abspath = os.path.join(self.root_dir_path, relpath)
+
+            try:
+                if mode == self.MODE_UNLINK:
+                    os.unlink(abspath)
+
+                elif mode == self.MODE_RMDIR:
+                    try:
+                        os.rmdir(abspath)
+                    except OSError:
+                        pass # not empty
+
+                elif mode == self.MODE_REPLACE:
+                    os.replace(os.path.join(self.root_dir_path, src_relpath), abspath)
+
+                else:
+                    src_abspath = os.path.join(self.root_dir_path, src_relpath)
+                    try:
+                        os.link(src_abspath, abspath)
+                    except FileExistsError:
+                        pass
+
+                    if mode == self.MODE_NEW:
+                        os.unlink(src_abspath)
+
+            except FileNotFoundError:
+                pass # already applied
+
+        # The applied changes must be on disk before the journal is removed.
+        if self.fsync:
+            os.sync()
+
+        os.unlink(os.path.join(self.root_dir_path, self.JOURNAL_FILENAME))
+
+    def recover(self):
+        """Finish applying a batch whose commit was interrupted
+
+        The generation is left odd; call end_update() once the db is
+        consistent again.
+        """
+        try:
+            with open(os.path.join(self.root_dir_path, self.JOURNAL_FILENAME), 'r') as fd:
+                journal = json.load(fd)
+        except FileNotFoundError:
+            return
+
+        logging.warning('Replaying interrupted batch commit of %d changes' % len(journal))
+        self.begin_update()
+        self._apply_journal(journal)
+
+class PersistentObjectCache:
+    """Cache for file-backed sets and dicts
+
+    Holds the most recently used deserialized objects, keyed by hash. As
+    files are named after the hash of their contents, and never modified,
+    objects never need to be invalidated.
+
+    Paths found not to exist are also cached, as most lookups of outpoints
+    are for outpoints that aren't colored. Paths are removed from the
+    negative cache when written; the cache is thus only correct if nothing
+    else is writing to the db.
+
+    max_objs          - maximum number of objects cached
+    max_missing_paths - maximum number of missing paths cached
+    """
+
+    DEFAULT_MAX_OBJS = 10000
+    DEFAULT_MAX_MISSING_PATHS = 100000
+
+    def __init__(self, *, max_objs=DEFAULT_MAX_OBJS, max_missing_paths=DEFAULT_MAX_MISSING_PATHS):
+        self.max_objs = max_objs
+        self.max_missing_paths = max_missing_paths
+
+        self.objs = collections.OrderedDict()
+        self.missing_paths = collections.OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.missing_path_hits = 0
+        self.missing_path_misses = 0
+
+    def get(self, obj_hash):
+        """Get a cached object, or None"""
+        try:
+            obj = self.objs[obj_hash]
+        except KeyError:
+            self.misses += 1
+            return None
+
+        self.objs.move_to_end(obj_hash)
+        self.hits += 1
+        return obj
+
+    def put(self, obj_hash, obj):
+        self.objs[obj_hash] = obj
+        self.objs.move_to_end(obj_hash)
+        while len(self.objs) > self.max_objs:
+            self.objs.popitem(last=False)
+
+    def path_exists(self, abspath):
+        if abspath in self.missing_paths:
+            self.missing_paths.move_to_end(abspath)
+            self.missing_path_hits += 1
+            return False
+
+        self.missing_path_misses += 1
+        if os.path.exists(abspath):
+            return True
+
+        self.missing_paths[abspath] = True
+        while len(self.missing_paths) > self.max_missing_paths:
+            self.missing_paths.popitem(last=False)
+        return False
+
+    def path_created(self, abspath):
+        """Invalidate a path, and its parent directories"""
+        while True:
+            self.missing_paths.pop(abspath, None)
+
+            parent_abspath = os.path.dirname(abspath)
+            if parent_abspath == abspath:
+                break
+            abspath = parent_abspath
+
+    def clear_missing_paths(self):
+        self.missing_paths.clear()
+
+    @staticmethod
+    def _ratio(hits, misses):
+        return hits / (hits + misses) if hits + misses else 0.0
+
+    @property
+    def hit_ratio(self):
+        return self._ratio(self.hits, self.misses)
+
+    @property
+    def missing_path_hit_ratio(self):
+        return self._ratio(self.missing_path_hits, self.missing_path_misses)
+
+    def __str__(self):
+        return ('objects: %d cached, %d hits, %d misses (%.1f%%); '
+                'missing paths: %d cached, %d hits, %d misses (%.1f%%)') % \
+                    (len(self.objs), self.hits, self.misses, self.hit_ratio * 100,
+                     len(self.missing_paths), self.missing_path_hits, self.missing_path_misses,
+                     self.missing_path_hit_ratio * 100)
+
+class PersistentNode:
+    """Common base of PersistentSet and PersistentDict
+
+    write_buffer - optional PersistentWriteBuffer that writes go through
+    cache        - optional PersistentObjectCache
+    """
+
+    def __init__(self, *, root_dir_path, write_buffer=None, cache=None):
         self.root_dir_path = os.path.abspath(root_dir_path)
+        self.write_buffer = write_buffer
+        self.cache = cache
 
+    def _child_kwargs(self):
+        """Keyword arguments to create child sets and dicts with"""
+        return dict(write_buffer=self.write_buffer, cache=self.cache)
+
+    def _exists(self, abspath):
+        if self.write_buffer is not None:
+            exists = self.write_buffer.exists(abspath)
+            if exists is not None:
+                return exists
+
+        if self.cache is not None:
+            return self.cache.path_exists(abspath)
+        else:
+            return os.path.exists(abspath)
+
+    def _listdir(self, dir_path):
+        if self.write_buffer is not None:
+            return self.write_buffer.listdir(dir_path)
+        else:
+            try:
+                return os.listdir(dir_path)
+            except FileNotFoundError as exp:
+                return ()
+
+    def _path_created(self, abspath):
+        if self.cache is not None:
+            self.cache.path_created(abspath)
+
+class PersistentSet(PersistentNode):
+    """File-backed set
+
+    Elements are stored one per file, named after the element's hash.
+    """
 
     def _get_elem_filename(self, elem):
         raise NotImplementedError
 
+    def _elem_filename_to_hash(self, elem_filename):
+        raise NotImplementedError
+
     def _serialize_elem(self, elem):
         raise NotImplementedError
 
@@ -42,6 +504,16 @@ class PersistentSet:
             return
 
         elem_filename = self._get_elem_filename(elem)
+        self._path_created(os.path.join(self.root_dir_path, elem_filename))
+
+        if self.write_buffer is not None and self.write_buffer.active:
+            fd = io.BytesIO()
+            self._serialize_elem(elem, fd)
+            self.write_buffer.add_file(os.path.join(self.root_dir_path, elem_filename), fd.getvalue(), elem)
+
+            if self.cache is not None:
+                self.cache.put(elem.hash, elem)
+            return
 
         os.makedirs(self.root_dir_path, exist_ok=True)
 
@@ -60,26 +532,75 @@ class PersistentSet:
                 # FIXME: actually handle this!
                 raise exp
 
+        if self.cache is not None:
+            self.cache.put(elem.hash, elem)
 
     def __iter__(self):
-        try:
-            elem_filenames = os.listdir(self.root_dir_path)
-        except FileNotFoundError as exp:
-            return
+        for elem_filename in self._listdir(self.root_dir_path):
+            if '-tmp-' in elem_filename:
+                continue # not yet published
+
+            elem_abspath = os.path.join(self.root_dir_path, elem_filename)
+
+            if self.write_buffer is not None:
+                elem = self.write_buffer.get_pending_elem(elem_abspath)
+                if elem is not None:
+                    yield elem
+                    continue
+
+            if self.cache is not None:
+                elem_hash = self._elem_filename_to_hash(elem_filename)
+                elem = self.cache.get(elem_hash)
+                if elem is not None:
+                    yield elem
+                    continue
 
-        for elem_filename in elem_filenames:
-            with open(os.path.join(self.root_dir_path, elem_filename), 'rb') as fd:
-                yield self._deserialize_elem(fd)
+            try:
+                with open(elem_abspath, 'rb') as fd:
+                    elem = self._deserialize_elem(fd)
+            except FileNotFoundError:
+                continue # removed while we were iterating
+
+            if self.cache is not None:
+                self.cache.put(elem_hash, elem)
+
+            yield elem
 
     def __contains__(self, elem):
-        elem_filename = self._get_elem_filename(elem)
-        return os.path.exists(os.path.join(self.root_dir_path, elem_filename))
+        return self._exists(os.path.join(self.root_dir_path, self._get_elem_filename(elem)))
 
-class PersistentDict:
-    """File-backed set"""
+    def __len__(self):
+        return sum(1 for elem_filename in self._listdir(self.root_dir_path)
+                        if '-tmp-' not in elem_filename)
 
-    def __init__(self, *, root_dir_path):
-        self.root_dir_path = os.path.abspath(root_dir_path)
+    def remove(self, elem):
+        elem_abspath = os.path.join(self.root_dir_path, self._get_elem_filename(elem))
+        if not self._exists(elem_abspath):
+            raise KeyError(elem)
+
+        if self.write_buffer is not None and self.write_buffer.active:
+            self.write_buffer.unlink(elem_abspath)
+        else:
+            os.unlink(elem_abspath)
+
+    def discard(self, elem):
+        try:
+            self.remove(elem)
+        except KeyError:
+            pass
+
+class PersistentDict(PersistentNode):
+    """File-backed dict
+
+    Each key is a directory under root_dir_path. If fanout is non-zero the
+    key directories are spread across that many levels of subdirectories,
+    named after successive bytes of the hash of the key's filename, so that
+    no one directory gets too large.
+    """
+
+    def __init__(self, *, fanout=0, **kwargs):
+        super().__init__(**kwargs)
+        self.fanout = fanout
 
 
     def _key_to_filename(self, key):
@@ -92,15 +613,20 @@ class PersistentDict:
         raise NotImplementedError
 
 
+    def _filename_to_abspath(self, key_filename):
+        key_filename_hash = hashlib.sha256(key_filename.encode('utf8')).hexdigest()
+        shard_dirnames = [key_filename_hash[i*2:i*2+2] for i in range(self.fanout)]
+        return os.path.join(self.root_dir_path, *shard_dirnames, key_filename)
+
     def _key_to_abspath(self, key):
-        return os.path.join(self.root_dir_path, self._key_to_filename(key))
+        return self._filename_to_abspath(self._key_to_filename(key))
 
     def __contains__(self, key):
-        return os.path.exists(self._key_to_abspath(key))
+        return self._exists(self._key_to_abspath(key))
 
     def __getitem__(self, key):
         key_abspath = self._key_to_abspath(key)
-        if not os.path.exists(key_abspath):
+        if not self._exists(key_abspath):
             raise KeyError(key)
         else:
             return self._get_item(key_abspath)
@@ -114,6 +640,20 @@ class PersistentDict:
     def __setitem__(self, key, value):
         raise NotImplementedError
 
+    def __delitem__(self, key):
+        """Remove a key, whose value must already be empty"""
+        key_abspath = self._key_to_abspath(key)
+        if not self._exists(key_abspath):
+            raise KeyError(key)
+
+        if self.write_buffer is not None and self.write_buffer.active:
+            self.write_buffer.rmdir(key_abspath)
+        else:
+            os.rmdir(key_abspath)
+
+    def __len__(self):
+        return sum(1 for key_filename in self._iter_key_filenames())
+
     def setdefault(self, key, default_value=None):
         try:
             return self[key]
@@ -122,15 +662,50 @@ class PersistentDict:
 
         return default_value
 
-    def __iter__(self):
-        try:
-            key_filenames = os.listdir(self.root_dir_path)
-        except FileNotFoundError as exp:
-            return
+    def _iter_key_filenames(self, dir_path=None, level=0):
+        """Iterate over the filenames of all keys"""
+        if dir_path is None:
+            dir_path = self.root_dir_path
 
-        for key_filename in key_filenames:
+        filenames = self._listdir(dir_path)
+
+        if level < self.fanout:
+            for shard_dirname in filenames:
+                yield from self._iter_key_filenames(os.path.join(dir_path, shard_dirname), level + 1)
+        else:
+            yield from filenames
+
+    def __iter__(self):
+        for key_filename in self._iter_key_filenames():
             yield self._filename_to_key(key_filename)
 
+    def migrate(self, fanout):
+        """Move every key to the layout for a new fanout
+
+        Keys are moved to a new tree alongside the existing one, which then
+        replaces it. Each key is moved atomically, and if interrupted calling
+        migrate() again with the same fanout picks up where it left off.
+        """
+        new_dict = self.__class__.__new__(self.__class__)
+        new_dict.__dict__.update(self.__dict__)
+        new_dict.root_dir_path = self.root_dir_path + '-migrate'
+        new_dict.fanout = fanout
+
+        if os.path.exists(self.root_dir_path):
+            for key_filename in self._iter_key_filenames():
+                new_key_abspath = new_dict._filename_to_abspath(key_filename)
+                os.makedirs(os.path.dirname(new_key_abspath), exist_ok=True)
+                os.rename(self._filename_to_abspath(key_filename), new_key_abspath)
+
+            # Only empty shard directories remain
+            for dir_path, dirnames, filenames in os.walk(self.root_dir_path, topdown=False):
+                os.rmdir(dir_path)
+
+        if os.path.exists(new_dict.root_dir_path):
+            os.rename(new_dict.root_dir_path, self.root_dir_path)
+
+        self.fanout = fanout
+
     def keys(self):
         yield from self.__iter__()
 
@@ -139,28 +714,370 @@ class PersistentDict:
 
     def items(self):
         for key in self:
-            yield (key, self[key])
+            try:
+                yield (key, self[key])
+            except KeyError:
+                continue # removed while we were iterating
+
+
+class PersistentIndex(PersistentDict):
+    """File-backed index of bytes to bytes
+
+    Each key is a file, named after the key in hex, holding the value.
+    """
+
+    def _key_to_filename(self, key):
+        return b2x(key)
+
+    def _filename_to_key(self, filename):
+        return x(filename)
+
+    def _get_item(self, key_abspath):
+        if self.write_buffer is not None:
+            value = self.write_buffer.get_pending_elem(key_abspath)
+            if value is not None:
+                return value
+
+        try:
+            with open(key_abspath, 'rb') as fd:
+                return fd.read()
+        except FileNotFoundError:
+            raise KeyError(self._filename_to_key(os.path.basename(key_abspath)))
+
+    def __setitem__(self, key, value):
+        key_abspath = self._key_to_abspath(key)
+        self._path_created(key_abspath)
+
+        if self.write_buffer is not None and self.write_buffer.active:
+            self.write_buffer.add_file(key_abspath, value, value, replace=True)
+            return
+
+        dir_path, key_filename = os.path.split(key_abspath)
+        os.makedirs(dir_path, exist_ok=True)
+
+        with tempfile.NamedTemporaryFile(dir=dir_path, prefix=key_filename + '-tmp-', delete=False) as fd:
+            fd.write(value)
+        os.replace(fd.name, key_abspath)
+
+    def __delitem__(self, key):
+        key_abspath = self._key_to_abspath(key)
+        if not self._exists(key_abspath):
+            raise KeyError(key)
+
+        if self.write_buffer is not None and self.write_buffer.active:
+            self.write_buffer.unlink(key_abspath)
+        else:
+            os.unlink(key_abspath)
+
+    def pop(self, key, *default_value):
+        try:
+            value = self[key]
+        except KeyError:
+            if default_value:
+                return default_value[0]
+            raise
+
+        del self[key]
+        return value
+
+    def setdefault(self, key, default_value=None):
+        try:
+            return self[key]
+        except KeyError:
+            self[key] = default_value
+            return default_value
+
+    def _iter_key_filenames(self, dir_path=None, level=0):
+        for key_filename in super()._iter_key_filenames(dir_path, level):
+            if '-tmp-' not in key_filename:
+                yield key_filename
+
+class PersistentPrefixIndex(PersistentIndex):
+    """PersistentIndex whose keys can be listed by prefix
+
+    Keys are grouped in a directory per prefix of their first prefix_length
+    bytes, laid out like the keys of a PersistentIndex. Each key is a file
+    in its prefix's directory named after the rest of the key in hex, so
+    keys must be longer than prefix_length. Empty prefix directories are
+    left for compact() to remove.
+    """
+
+    def __init__(self, *, prefix_length, **kwargs):
+        super().__init__(**kwargs)
+        self.prefix_length = prefix_length
+
+    def _key_to_abspath(self, key):
+        assert len(key) > self.prefix_length
+        return os.path.join(self._filename_to_abspath(b2x(key[0:self.prefix_length])),
+                            b2x(key[self.prefix_length:]))
+
+    def _iter_prefix_keys(self, prefix_filename):
+        prefix = x(prefix_filename)
+        for key_filename in self._listdir(self._filename_to_abspath(prefix_filename)):
+            if '-tmp-' not in key_filename:
+                yield prefix + x(key_filename)
 
+    def __iter__(self):
+        # _iter_key_filenames() iterates over the prefix directories, so
+        # migrate() moves whole directories.
+        for prefix_filename in self._iter_key_filenames():
+            yield from self._iter_prefix_keys(prefix_filename)
+
+    def __len__(self):
+        return sum(1 for key in self)
+
+    def iter_prefix(self, prefix):
+        """Iterate over the (key, value) pairs whose keys start with prefix
+
+        prefix must be prefix_length bytes long.
+        """
+        assert len(prefix) == self.prefix_length
+        for key in tuple(self._iter_prefix_keys(b2x(prefix))):
+            try:
+                yield (key, self[key])
+            except KeyError:
+                continue # removed while we were iterating
 
 class PersistentColorDefSet(PersistentSet):
     def _get_elem_filename(self, colordef):
         return b2x(colordef.hash) + '.scdef'
 
+    def _elem_filename_to_hash(self, elem_filename):
+        return x(elem_filename[:-len('.scdef')])
+
     def _serialize_elem(self, colordef, fd):
         smartcolors.io.ColorDefFileSerializer.stream_serialize(colordef, fd)
 
     def _deserialize_elem(self, fd):
-        return smartcolors.io.ColorDefFileSerializer.stream_deserialize(fd)
+        # Like everything else in the db, written by us so trusted
+        return smartcolors.io.ColorDefFileSerializer.file_deserialize(fd, limits=None)
+
+    def get_by_hash(self, colordef_hash):
+        """Get a ColorDef by hash
+
+        Raises KeyError if not present.
+        """
+        if self.cache is not None:
+            colordef = self.cache.get(colordef_hash)
+            if colordef is not None:
+                return colordef
+
+        colordef_abspath = os.path.join(self.root_dir_path, b2x(colordef_hash) + '.scdef')
+
+        colordef = None
+        if self.write_buffer is not None:
+            colordef = self.write_buffer.get_pending_elem(colordef_abspath)
+
+        if colordef is None:
+            try:
+                with open(colordef_abspath, 'rb') as fd:
+                    colordef = self._deserialize_elem(fd)
+            except FileNotFoundError:
+                raise KeyError(colordef_hash)
+
+        if self.cache is not None:
+            self.cache.put(colordef_hash, colordef)
+        return colordef
+
+class PersistentObjectStore(PersistentNode):
+    """Content-addressed store of ColorProofs
+
+    Each unique proof is stored once, as a ColorProofRecord named after its
+    hash, with its colordef and prevout proofs referenced by hash. Storing a
+    proof stores any of its prevout proofs not already present, so the
+    history shared by proofs is stored only once.
+
+    colordefs - PersistentColorDefSet the colordefs are stored in
+    """
+
+    def __init__(self, *, colordefs, **kwargs):
+        super().__init__(**kwargs)
+        self.colordefs = colordefs
+
+    def _get_abspath(self, colorproof_hash):
+        hex_hash = b2x(colorproof_hash)
+        return os.path.join(self.root_dir_path, hex_hash[0:2], hex_hash + '.scobj')
+
+    def __contains__(self, colorproof):
+        return self._exists(self._get_abspath(colorproof.hash))
+
+    def _write_record(self, colorproof):
+        record = smartcolors.io.ColorProofRecord.from_colorproof(colorproof)
+        abspath = self._get_abspath(colorproof.hash)
+        self._path_created(abspath)
+
+        fd = io.BytesIO()
+        smartcolors.io.ColorProofRecordSerializer.stream_serialize(record, fd)
+
+        if self.write_buffer is not None and self.write_buffer.active:
+            self.write_buffer.add_file(abspath, fd.getvalue(), colorproof)
+
+        else:
+            dir_path, name = os.path.split(abspath)
+            os.makedirs(dir_path, exist_ok=True)
+            with tempfile.NamedTemporaryFile(dir=dir_path, prefix=name + '-tmp-') as tmp_fd:
+                tmp_fd.write(fd.getvalue())
+                tmp_fd.flush()
+                try:
+                    os.link(tmp_fd.name, abspath)
+                except FileExistsError:
+                    pass
+
+        if self.cache is not None:
+            self.cache.put(colorproof.hash, colorproof)
+
+    def put(self, colorproof):
+        """Store a proof, and any of its prevout proofs not already stored
+
+        Returns the path of the stored proof.
+        """
+        # Prevout proofs are stored before the proofs that depend on them, so
+        # every record in the store is complete. Done iteratively as
+        # histories can be long.
+        remaining_proofs = [colorproof]
+        while remaining_proofs:
+            proof = remaining_proofs[-1]
+            if proof in self:
+                remaining_proofs.pop()
+                continue
+
+            missing_prevout_proofs = [prevout_proof for prevout_proof in proof._get_prevout_proofs().values()
+                                        if prevout_proof not in self]
+            if missing_prevout_proofs:
+                remaining_proofs.extend(missing_prevout_proofs)
+
+            else:
+                remaining_proofs.pop()
+                self.colordefs.add(proof.colordef)
+                self._write_record(proof)
+
+        return self._get_abspath(colorproof.hash)
+
+    def _read_record(self, colorproof_hash):
+        try:
+            with open(self._get_abspath(colorproof_hash), 'rb') as fd:
+                return smartcolors.io.ColorProofRecordSerializer.file_deserialize(fd)
+        except FileNotFoundError:
+            raise KeyError(colorproof_hash)
+
+    def _get_loaded(self, colorproof_hash):
+        """Get a proof that doesn't need to be reassembled, or None"""
+        if self.write_buffer is not None:
+            colorproof = self.write_buffer.get_pending_elem(self._get_abspath(colorproof_hash))
+            if colorproof is not None:
+                return colorproof
+
+        if self.cache is not None:
+            return self.cache.get(colorproof_hash)
+
+        return None
+
+    def get(self, colorproof_hash):
+        """Get a proof by hash, reassembling it from its record
+
+        Raises KeyError if not present.
+        """
+        colorproof = self._get_loaded(colorproof_hash)
+        if colorproof is None:
+            colorproof = self.reassemble(self._read_record(colorproof_hash))
+        return colorproof
+
+    def reassemble(self, record):
+        """Reassemble a proof from a record, loading prevout proofs as needed"""
+        loaded_proofs = {}
+        records = {record.hash: record}
+
+        remaining_hashes = [record.hash]
+        while remaining_hashes:
+            colorproof_hash = remaining_hashes[-1]
+            if colorproof_hash in loaded_proofs:
+                remaining_hashes.pop()
+                continue
+
+            colorproof = self._get_loaded(colorproof_hash)
+            if colorproof is not None:
+                loaded_proofs[colorproof_hash] = colorproof
+                remaining_hashes.pop()
+                continue
+
+            try:
+                colorproof_record = records[colorproof_hash]
+            except KeyError:
+                colorproof_record = records[colorproof_hash] = self._read_record(colorproof_hash)
+
+            missing_prevout_hashes = [prevout_hash for prevout_hash in colorproof_record.prevout_hashes.values()
+                                        if prevout_hash not in loaded_proofs]
+            if missing_prevout_hashes:
+                remaining_hashes.extend(missing_prevout_hashes)
+                continue
+
+            remaining_hashes.pop()
+            prevout_proofs = {prevout:loaded_proofs[prevout_hash]
+                                for prevout, prevout_hash in colorproof_record.prevout_hashes.items()}
+            colorproof = colorproof_record.to_colorproof(self.colordefs.get_by_hash(colorproof_record.colordef_hash),
+                                                         prevout_proofs)
+            loaded_proofs[colorproof_hash] = colorproof
+            if self.cache is not None:
+                self.cache.put(colorproof_hash, colorproof)
+
+        return loaded_proofs[record.hash]
 
 class PersistentColorProofSet(PersistentSet):
+    """Set of ColorProofs
+
+    If object_store is set proofs are stored in it, and the elements of the
+    set are hardlinks to the stored proofs. Sets written without an object
+    store hold complete serialized proofs; either kind of file can be read.
+    """
+
+    def __init__(self, *, object_store=None, **kwargs):
+        super().__init__(**kwargs)
+        self.object_store = object_store
+
     def _get_elem_filename(self, colorproof):
         return b2x(colorproof.hash) + '.scproof'
 
+    def _elem_filename_to_hash(self, elem_filename):
+        return x(elem_filename[:-len('.scproof')])
+
     def _serialize_elem(self, colorproof, fd):
         smartcolors.io.ColorProofFileSerializer.stream_serialize(colorproof, fd)
 
     def _deserialize_elem(self, fd):
-        return smartcolors.io.ColorProofFileSerializer.stream_deserialize(fd)
+        magic = fd.read(len(smartcolors.io.ColorProofRecordSerializer.MAGIC))
+        fd.seek(0)
+
+        if magic == smartcolors.io.ColorProofRecordSerializer.MAGIC:
+            if self.object_store is None:
+                raise ValueError('object store needed to read proof records')
+            record = smartcolors.io.ColorProofRecordSerializer.file_deserialize(fd)
+            return self.object_store.reassemble(record)
+
+        else:
+            return smartcolors.io.ColorProofFileSerializer.file_deserialize(fd, limits=None)
+
+    def add(self, colorproof):
+        if self.object_store is None:
+            return super().add(colorproof)
+
+        # No effect if element is already present
+        if colorproof in self:
+            return
+
+        object_abspath = self.object_store.put(colorproof)
+
+        elem_abspath = os.path.join(self.root_dir_path, self._get_elem_filename(colorproof))
+        self._path_created(elem_abspath)
+
+        if self.write_buffer is not None and self.write_buffer.active:
+            self.write_buffer.add_link(elem_abspath, object_abspath, colorproof)
+
+        else:
+            os.makedirs(self.root_dir_path, exist_ok=True)
+            try:
+                os.link(object_abspath, elem_abspath)
+            except FileExistsError:
+                pass
 
 class PersistentGenesisOutPointsDict(PersistentDict):
     def _key_to_filename(self, outpoint):
@@ -171,12 +1088,12 @@ class PersistentGenesisOutPointsDict(PersistentDict):
         return bitcoin.core.COutPoint(lx(hex_hash), int(str_n))
 
     def _get_item(self, key_abspath):
-        return PersistentColorDefSet(root_dir_path=key_abspath)
+        return PersistentColorDefSet(root_dir_path=key_abspath, **self._child_kwargs())
 
     def setdefault(self, key, default_value=None):
         assert default_value == set()
 
-        default_value = PersistentColorDefSet(root_dir_path=self._key_to_abspath(key))
+        default_value = PersistentColorDefSet(root_dir_path=self._key_to_abspath(key), **self._child_kwargs())
         return super().setdefault(key, default_value=default_value)
 
 class PersistentGenesisScriptPubKeysDict(PersistentDict):
@@ -194,34 +1111,57 @@ class PersistentGenesisScriptPubKeysDict(PersistentDict):
             return bitcoin.core.script.CScript(x(filename))
 
     def _get_item(self, key_abspath):
-        return PersistentColorDefSet(root_dir_path=key_abspath)
+        return PersistentColorDefSet(root_dir_path=key_abspath, **self._child_kwargs())
 
     def setdefault(self, key, default_value=None):
         assert default_value == set()
 
-        default_value = PersistentColorDefSet(root_dir_path=self._key_to_abspath(key))
+        default_value = PersistentColorDefSet(root_dir_path=self._key_to_abspath(key), **self._child_kwargs())
         return super().setdefault(key, default_value=default_value)
 
 class PersistentColorProofsByColorDefDict(PersistentDict):
+    def __init__(self, *, colordefs_dir_path, object_store=None, **kwargs):
+        super().__init__(**kwargs)
+        self.colordefs_dir_path = colordefs_dir_path
+        self.object_store = object_store
+
     def _key_to_filename(self, colordef):
         return b2x(colordef.hash)
 
     def _filename_to_key(self, filename):
-        # Bit of a hack to say the least...
-        colordef_filename = os.path.join(self.root_dir_path, '..', '..', 'colordefs', filename + '.scdef')
+        colordef_hash = x(filename)
+        if self.cache is not None:
+            colordef = self.cache.get(colordef_hash)
+            if colordef is not None:
+                return colordef
+
+        colordef_filename = os.path.join(self.colordefs_dir_path, filename + '.scdef')
         with open(colordef_filename, 'rb') as fd:
-            return smartcolors.io.ColorDefFileSerializer.stream_deserialize(fd)
+            colordef = smartcolors.io.ColorDefFileSerializer.file_deserialize(fd, limits=None)
+
+        if self.cache is not None:
+            self.cache.put(colordef_hash, colordef)
+        return colordef
 
     def _get_item(self, key_abspath):
-        return PersistentColorProofSet(root_dir_path=key_abspath)
+        return PersistentColorProofSet(root_dir_path=key_abspath,
+                                       object_store=self.object_store,
+                                       **self._child_kwargs())
 
     def setdefault(self, key, default_value=None):
         assert default_value == set()
 
-        default_value = PersistentColorProofSet(root_dir_path=self._key_to_abspath(key))
+        default_value = PersistentColorProofSet(root_dir_path=self._key_to_abspath(key),
+                                                object_store=self.object_store,
+                                                **self._child_kwargs())
         return super().setdefault(key, default_value=default_value)
 
 class PersistentColoredOutPointsDict(PersistentDict):
+    def __init__(self, *, colordefs_dir_path, object_store=None, **kwargs):
+        super().__init__(**kwargs)
+        self.colordefs_dir_path = colordefs_dir_path
+        self.object_store = object_store
+
     def _key_to_filename(self, outpoint):
         return '%s:%d' % (b2lx(outpoint.hash), outpoint.n)
 
@@ -230,18 +1170,1623 @@ class PersistentColoredOutPointsDict(PersistentDict):
         return bitcoin.core.COutPoint(lx(hex_hash), int(str_n))
 
     def _get_item(self, key_abspath):
-        return PersistentColorProofsByColorDefDict(root_dir_path=key_abspath)
+        return PersistentColorProofsByColorDefDict(root_dir_path=key_abspath,
+                                                   colordefs_dir_path=self.colordefs_dir_path,
+                                                   object_store=self.object_store,
+                                                   **self._child_kwargs())
 
     def setdefault(self, key, default_value=None):
         assert default_value == {}
 
-        default_value = PersistentColorProofsByColorDefDict(root_dir_path=self._key_to_abspath(key))
+        default_value = PersistentColorProofsByColorDefDict(root_dir_path=self._key_to_abspath(key),
+                                                            colordefs_dir_path=self.colordefs_dir_path,
+                                                            object_store=self.object_store,
+                                                            **self._child_kwargs())
         return super().setdefault(key, default_value=default_value)
 
+class PersistentStateTree(smartcolors.core.db.StateTree):
+    """File-backed StateTree
+
+    Each bucket is stored in its own file, named after its prefix, and saved
+    atomically every time it changes, or when the batch commits if there is
+    one.
+    """
+
+    def __init__(self, *, root_dir_path, depth=smartcolors.core.db.StateTree.DEFAULT_DEPTH, write_buffer=None):
+        super().__init__(depth=depth)
+        self.root_dir_path = os.path.abspath(root_dir_path)
+        self.write_buffer = write_buffer
+
+        try:
+            bucket_filenames = os.listdir(self.root_dir_path)
+        except FileNotFoundError:
+            bucket_filenames = ()
+
+        for bucket_filename in bucket_filenames:
+            if len(bucket_filename) != self.depth:
+                continue # temporary files
+
+            with open(os.path.join(self.root_dir_path, bucket_filename), 'rb') as fd:
+                self.buckets[bucket_filename] = smartcolors.core.db.MultisetHash.deserialize(fd.read())
+
+    def save_bucket(self, prefix):
+        if self.write_buffer is not None and self.write_buffer.active:
+            self.write_buffer.add_file(os.path.join(self.root_dir_path, prefix),
+                                       self._get_bucket(prefix).serialize(),
+                                       replace=True)
+            return
+
+        os.makedirs(self.root_dir_path, exist_ok=True)
+
+        with tempfile.NamedTemporaryFile(dir=self.root_dir_path, prefix=prefix + '-tmp-', delete=False) as fd:
+            fd.write(self._get_bucket(prefix).serialize())
+        os.replace(fd.name, os.path.join(self.root_dir_path, prefix))
+
+    def save(self):
+        for prefix in self.buckets:
+            self.save_bucket(prefix)
+
+    def add(self, key, elem):
+        super().add(key, elem)
+        self.save_bucket(self.key_prefix(key))
+
+    def remove(self, key, elem):
+        super().remove(key, elem)
+        self.save_bucket(self.key_prefix(key))
+
 class PersistentColorProofDb(smartcolors.core.db.ColorProofDb):
-    def __init__(self, root_dir_path):
+    """ColorProofDb stored as a tree of files
+
+    The on-disk layout is recorded in the 'layout' file in the db directory.
+    fanout is the number of levels of hash-prefix subdirectories the
+    outpoint, scriptPubKey and index directories are spread across; dbs created
+    before the layout file existed have a fanout of zero. Use
+    migrate_layout() to change the fanout of an existing db.
+
+    Changes made within a batch() are buffered in memory and published
+    atomically when the outermost batch commits. fsync controls whether
+    commits are synced to disk. Adding colordefs, proofs and transactions
+    always happens in a batch.
+
+    Only one process may open the db for writing; any number of others may
+    open it with readonly set, and use snapshot() to read a consistent
+    version of the db without blocking the writer.
+    """
+
+    DEFAULT_FANOUT = 2
+
+    # How long snapshot() waits for the writer to finish applying a commit
+    SNAPSHOT_WAIT_TIMEOUT = 60
+
+    def __init__(self, root_dir_path, *, fsync=True, cache=True, readonly=False, **kwargs):
+        super().__init__(**kwargs)
+
         self.root_dir_path = os.path.abspath(root_dir_path)
-        self.colordefs = PersistentColorDefSet(root_dir_path=os.path.join(self.root_dir_path, 'colordefs'))
-        self.genesis_outpoints = PersistentGenesisOutPointsDict(root_dir_path=os.path.join(self.root_dir_path, 'genesis_outpoints'))
-        self.genesis_scriptPubKeys = PersistentGenesisScriptPubKeysDict(root_dir_path=os.path.join(self.root_dir_path, 'genesis_scriptPubKeys'))
-        self.colored_outpoints = PersistentColoredOutPointsDict(root_dir_path=os.path.join(self.root_dir_path, 'colored_outpoints'))
+        self.readonly = readonly
+        db_existed = os.path.exists(self.root_dir_path)
+
+        # Caching can be disabled if other processes may write to the db
+        self.cache = PersistentObjectCache() if cache else None
+
+        self.write_buffer = PersistentWriteBuffer(root_dir_path=self.root_dir_path, fsync=fsync)
+
+        # New dbs are always created by a writer
+        self.writer_lock = ColorProofDbWriterLock(self.root_dir_path)
+        if not self.readonly or not db_existed:
+            self.writer_lock.acquire()
+
+        if db_existed and not self.readonly:
+            self.write_buffer.recover()
+
+        layout = self._load_layout()
+        if layout is None:
+            if db_existed:
+                layout = {'fanout': 0}
+            else:
+                layout = {'fanout': self.DEFAULT_FANOUT}
+                self._save_layout(layout)
+
+        colordefs_dir_path = os.path.join(self.root_dir_path, 'colordefs')
+        self.colordefs = PersistentColorDefSet(root_dir_path=colordefs_dir_path,
+                                               **self._child_kwargs())
+        self.genesis_outpoints = PersistentGenesisOutPointsDict(root_dir_path=os.path.join(self.root_dir_path, 'genesis_outpoints'),
+                                                                fanout=layout['fanout'],
+                                                                **self._child_kwargs())
+        self.genesis_scriptPubKeys = PersistentGenesisScriptPubKeysDict(root_dir_path=os.path.join(self.root_dir_path, 'genesis_scriptPubKeys'),
+                                                                        fanout=layout['fanout'],
+                                                                        **self._child_kwargs())
+        self.object_store = PersistentObjectStore(root_dir_path=os.path.join(self.root_dir_path, 'objects'),
+                                                  colordefs=self.colordefs,
+                                                  **self._child_kwargs())
+        self.colored_outpoints = PersistentColoredOutPointsDict(root_dir_path=os.path.join(self.root_dir_path, 'colored_outpoints'),
+                                                                colordefs_dir_path=colordefs_dir_path,
+                                                                object_store=self.object_store,
+                                                                fanout=layout['fanout'],
+                                                                **self._child_kwargs())
+        self._init_indexes()
+
+        if 'migrating_to' in layout:
+            # Dicts that finished migrating are already in the new layout
+            for persistent_dict in self._iter_fanout_dicts():
+                if self._fanout_dict_name(persistent_dict) in layout['migrated']:
+                    persistent_dict.fanout = layout['migrating_to']
+
+            if self.readonly:
+                raise ColorProofDbLockedError('%s is being migrated to a new layout' % self.root_dir_path)
+
+            logging.warning('Resuming interrupted migration of %s to fanout %d' % \
+                                (self.root_dir_path, layout['migrating_to']))
+            self.migrate_layout(layout['migrating_to'])
+
+        # Dbs created prior to the state commitment being maintained have it
+        # calculated from scratch.
+        self._new_db = not db_existed
+
+        if self.readonly:
+            self.writer_lock.release()
+            self._snapshot_generation = None
+            self._state_generation = None
+            self.snapshot_read(lambda colordb: None)
+
+        else:
+            self._load_state_commitment()
+            self.write_buffer.end_update()
+
+    def _load_state_commitment(self):
+        state_dir_path = os.path.join(self.root_dir_path, 'state')
+        if os.path.exists(state_dir_path) or self._new_db:
+            self.state_commitment = PersistentStateTree(root_dir_path=state_dir_path,
+                                                        write_buffer=self.write_buffer)
+
+        else:
+            # A db created prior to the state commitment being maintained, so
+            # calculate it from scratch. This is slow!
+            state_commitment = self.calc_state_commitment()
+            self.state_commitment = PersistentStateTree(root_dir_path=state_dir_path,
+                                                        depth=state_commitment.depth,
+                                                        write_buffer=self.write_buffer)
+            self.state_commitment.buckets = state_commitment.buckets
+
+            if not self.readonly:
+                self.state_commitment.save()
+
+                # Left behind by earlier versions that kept a single,
+                # unbucketed, commitment.
+                try:
+                    os.unlink(os.path.join(self.root_dir_path, 'state_commitment'))
+                except FileNotFoundError:
+                    pass
+
+    def close(self):
+        self.writer_lock.release()
+
+    def _wait_for_generation(self):
+        """Wait until the writer isn't in the middle of applying changes
+
+        Returns the generation.
+        """
+        deadline = time.time() + self.SNAPSHOT_WAIT_TIMEOUT
+        while True:
+            generation = self.write_buffer.read_generation()
+            if not generation % 2:
+                return generation
+
+            if time.time() > deadline:
+                raise smartcolors.core.db.ColorProofDbConcurrentWriteError(
+                        'timed out waiting for writer; if it crashed, open the db for writing to recover')
+            time.sleep(0.01)
+
+    @contextlib.contextmanager
+    def snapshot(self):
+        # The writer always sees a consistent db, as do nested snapshots
+        if not self.readonly or self._snapshot_generation is not None:
+            yield self
+            return
+
+        generation = self._wait_for_generation()
+        self._snapshot_generation = generation
+        try:
+            try:
+                if generation != self._state_generation:
+                    # Changed since we last looked
+                    self._state_generation = None
+                    if self.cache is not None:
+                        self.cache.clear_missing_paths()
+                    self._load_state_commitment()
+                    self._state_generation = generation
+
+                yield self
+
+            except Exception as exp:
+                if self.write_buffer.read_generation() != generation:
+                    raise smartcolors.core.db.ColorProofDbConcurrentWriteError(
+                            'db changed while reading') from exp
+                raise
+
+            if self.write_buffer.read_generation() != generation:
+                raise smartcolors.core.db.ColorProofDbConcurrentWriteError('db changed while reading')
+
+        finally:
+            self._snapshot_generation = None
+
+    @contextlib.contextmanager
+    def batch(self):
+        if self.readonly:
+            raise PermissionError('%s was opened read-only' % self.root_dir_path)
+
+        self.write_buffer.depth += 1
+        try:
+            yield self
+
+        except BaseException:
+            self.write_buffer.depth -= 1
+            if not self.write_buffer.active:
+                self.write_buffer.discard()
+
+                # Reload the state commitment without the discarded changes
+                self._load_state_commitment()
+            raise
+
+        else:
+            self.write_buffer.depth -= 1
+            if not self.write_buffer.active:
+                self.write_buffer.commit()
+
+    def addcolordef(self, colordef):
+        with self.batch():
+            super().addcolordef(colordef)
+
+    def addcolorproof(self, colorproof):
+        with self.batch():
+            super().addcolorproof(colorproof)
+
+    def addtx(self, tx):
+        with self.batch():
+            super().addtx(tx)
+
+    def _child_kwargs(self):
+        return dict(write_buffer=self.write_buffer, cache=self.cache)
+
+    # Temporary files older than this are assumed to have been left behind by
+    # crashed writers.
+    DEFAULT_TMP_MAX_AGE = 60*60
+
+    def _mark_reachable_objects(self):
+        """Find the hashes of every object reachable from colored_outpoints"""
+        reachable = set()
+
+        remaining_hashes = []
+        for dir_path, dirnames, filenames in os.walk(self.colored_outpoints.root_dir_path):
+            for filename in filenames:
+                if filename.endswith('.scproof'):
+                    remaining_hashes.append(x(filename[:-len('.scproof')]))
+
+        while remaining_hashes:
+            colorproof_hash = remaining_hashes.pop()
+            if colorproof_hash in reachable:
+                continue
+            reachable.add(colorproof_hash)
+
+            try:
+                record = self.object_store._read_record(colorproof_hash)
+            except KeyError:
+                continue # proof stored whole, by an earlier version
+
+            remaining_hashes.extend(record.prevout_hashes.values())
+
+        return reachable
+
+    def compact(self, *, tmp_max_age=DEFAULT_TMP_MAX_AGE):
+        """Reclaim space left behind by removed proofs and crashed writers
+
+        Removes temporary files older than tmp_max_age seconds, objects no
+        longer reachable from any colored outpoint, and empty directories.
+        Readers are unaffected, however objects and directories are only
+        removed if they predate the start of the compaction, so writers are
+        not expected to race with it.
+
+        Returns a dict of the number of each removed.
+        """
+        if self.readonly:
+            raise PermissionError('%s was opened read-only' % self.root_dir_path)
+        assert not self.write_buffer.active
+
+        start_time = time.time()
+        stats = {'tmp_files': 0, 'objects': 0, 'dirs': 0}
+
+        def older_than(abspath, max_time):
+            try:
+                return os.lstat(abspath).st_mtime < max_time
+            except FileNotFoundError:
+                return False
+
+        def unlink(abspath):
+            try:
+                os.unlink(abspath)
+                return 1
+            except FileNotFoundError:
+                return 0
+
+        for dir_path, dirnames, filenames in os.walk(self.root_dir_path):
+            for filename in filenames:
+                abspath = os.path.join(dir_path, filename)
+                if '-tmp-' in filename and older_than(abspath, start_time - tmp_max_age):
+                    stats['tmp_files'] += unlink(abspath)
+
+        reachable = self._mark_reachable_objects()
+        for dir_path, dirnames, filenames in os.walk(self.object_store.root_dir_path):
+            for filename in filenames:
+                abspath = os.path.join(dir_path, filename)
+                if filename.endswith('.scobj') \
+                        and x(filename[:-len('.scobj')]) not in reachable \
+                        and older_than(abspath, start_time):
+                    stats['objects'] += unlink(abspath)
+
+        # Shard directories, and the directories of removed keys
+        for persistent_node in tuple(self._iter_fanout_dicts()) + (self.object_store,):
+            for dir_path, dirnames, filenames in os.walk(persistent_node.root_dir_path, topdown=False):
+                if dir_path != persistent_node.root_dir_path and older_than(dir_path, start_time):
+                    try:
+                        os.rmdir(dir_path)
+                        stats['dirs'] += 1
+                    except OSError:
+                        pass # not empty
+
+        if self.cache is not None:
+            self.cache.clear_missing_paths()
+
+        return stats
+
+    def _load_layout(self):
+        try:
+            with open(os.path.join(self.root_dir_path, 'layout'), 'r') as fd:
+                return json.load(fd)
+        except FileNotFoundError:
+            return None
+
+    def _save_layout(self, layout):
+        with tempfile.NamedTemporaryFile('w', dir=self.root_dir_path, prefix='layout-tmp-', delete=False) as fd:
+            json.dump(layout, fd)
+        os.replace(fd.name, os.path.join(self.root_dir_path, 'layout'))
+
+    def _get_colorproof(self, outpoint, colordef_hash, colorproof_hash):
+        try:
+            return self.object_store.get(colorproof_hash)
+        except KeyError:
+            # Proofs stored whole by old versions aren't in the object store
+            return super()._get_colorproof(outpoint, colordef_hash, colorproof_hash)
+
+    def _make_index(self, name):
+        # Indexes share the layout of the other dicts
+        kwargs = dict(root_dir_path=os.path.join(self.root_dir_path, 'indexes', name),
+                      fanout=self.colored_outpoints.fanout,
+                      **self._child_kwargs())
+
+        prefix_length = self.INDEX_PREFIX_LENGTHS.get(name)
+        if prefix_length is None:
+            return PersistentIndex(**kwargs)
+        else:
+            return PersistentPrefixIndex(prefix_length=prefix_length, **kwargs)
+
+    def _iter_fanout_dicts(self):
+        yield self.genesis_outpoints
+        yield self.genesis_scriptPubKeys
+        yield self.colored_outpoints
+        for index_name in self.INDEX_NAMES:
+            yield getattr(self, index_name)
+
+    def _fanout_dict_name(self, persistent_dict):
+        return os.path.relpath(persistent_dict.root_dir_path, self.root_dir_path)
+
+    @property
+    def fanout(self):
+        return self.colored_outpoints.fanout
+
+    def migrate_layout(self, fanout):
+        """Migrate the db to a new fanout
+
+        Safe to interrupt; the migration is resumed when the db is next
+        opened.
+        """
+        if self.readonly:
+            raise PermissionError('%s was opened read-only' % self.root_dir_path)
+
+        # Readers can't make sense of the db until the migration is done
+        self.write_buffer.begin_update()
+
+        layout = self._load_layout() or {}
+        if layout.get('migrating_to') != fanout:
+            layout = {'fanout': self.fanout, 'migrating_to': fanout, 'migrated': []}
+            self._save_layout(layout)
+
+        if self.cache is not None:
+            self.cache.clear_missing_paths()
+
+        for persistent_dict in self._iter_fanout_dicts():
+            dirname = self._fanout_dict_name(persistent_dict)
+            if dirname in layout['migrated']:
+                continue
+
+            persistent_dict.migrate(fanout)
+
+            layout['migrated'].append(dirname)
+            self._save_layout(layout)
+
+        self._save_layout({'fanout': fanout})
+        self.write_buffer.end_update()
+
+
+def _serialize_to_bytes(serializer, obj):
+    fd = io.BytesIO()
+    serializer.stream_serialize(obj, fd)
+    return fd.getvalue()
+
+class ColorProofDbMappingView:
+    """Read-only dict-like view of part of an indexed ColorProofDb
+
+    Subclasses implement __iter__, __contains__ and _get_item(); keys that
+    aren't present yet can be given to setdefault() to get a view that
+    elements can be added to.
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    def _get_item(self, key):
+        raise NotImplementedError
+
+    def __getitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        return self._get_item(key)
+
+    def get(self, key, default_value=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default_value
+
+    def setdefault(self, key, default_value=None):
+        # default_value is ignored; the view returned is always empty until
+        # something is added to it.
+        return self._get_item(key)
+
+    def __delitem__(self, key):
+        # Keys exist only as long as there are elements for them, so there's
+        # nothing left to remove once they're empty.
+        pass
+
+    def __len__(self):
+        return sum(1 for key in self)
+
+    def keys(self):
+        yield from self.__iter__()
+
+    def values(self):
+        yield from [self[key] for key in self.keys()]
+
+    def items(self):
+        for key in self:
+            yield (key, self[key])
+
+class LogColorDefSet:
+    """All ColorDefs in a LogColorProofDb"""
+
+    def __init__(self, db):
+        self.db = db
+
+    def add(self, colordef):
+        if colordef in self:
+            return
+        self.db._append_record(self.db.RECORD_COLORDEF,
+                               _serialize_to_bytes(smartcolors.io.ColorDefFileSerializer, colordef))
+
+    def __contains__(self, colordef):
+        return colordef.hash in self.db._colordef_locations
+
+    def __iter__(self):
+        for colordef_hash in tuple(self.db._colordef_locations):
+            yield self.db._get_colordef(colordef_hash)
+
+class LogColorDefRefSet:
+    """Set of ColorDefs a genesis outpoint or scriptPubKey belongs to"""
+
+    def __init__(self, db, index, key_bytes, record_type):
+        self.db = db
+        self.index = index
+        self.key_bytes = key_bytes
+        self.record_type = record_type
+
+    def add(self, colordef):
+        if colordef in self:
+            return
+
+        if self.record_type == self.db.RECORD_GENESIS_OUTPOINT:
+            payload = self.key_bytes + colordef.hash
+        else:
+            payload = colordef.hash + self.key_bytes
+        self.db._append_record(self.record_type, payload)
+
+    def __contains__(self, colordef):
+        return colordef.hash in self.index.get(self.key_bytes, ())
+
+    def __iter__(self):
+        for colordef_hash in tuple(self.index.get(self.key_bytes, ())):
+            yield self.db._get_colordef(colordef_hash)
+
+class LogGenesisOutPointsDict(ColorProofDbMappingView):
+    def __iter__(self):
+        for outpoint_bytes in tuple(self.db._genesis_outpoints):
+            yield bitcoin.core.COutPoint.deserialize(outpoint_bytes)
+
+    def __contains__(self, outpoint):
+        return outpoint.serialize() in self.db._genesis_outpoints
+
+    def _get_item(self, outpoint):
+        return LogColorDefRefSet(self.db, self.db._genesis_outpoints, outpoint.serialize(),
+                                 self.db.RECORD_GENESIS_OUTPOINT)
+
+class LogGenesisScriptPubKeysDict(ColorProofDbMappingView):
+    def __iter__(self):
+        for scriptPubKey_bytes in tuple(self.db._genesis_scriptPubKeys):
+            yield bitcoin.core.script.CScript(scriptPubKey_bytes)
+
+    def __contains__(self, scriptPubKey):
+        return bytes(scriptPubKey) in self.db._genesis_scriptPubKeys
+
+    def _get_item(self, scriptPubKey):
+        return LogColorDefRefSet(self.db, self.db._genesis_scriptPubKeys, bytes(scriptPubKey),
+                                 self.db.RECORD_GENESIS_SCRIPTPUBKEY)
+
+class LogColorProofSet:
+    """ColorProofs for a specific outpoint and ColorDef"""
+
+    def __init__(self, db, outpoint_bytes, colordef):
+        self.db = db
+        self.outpoint_bytes = outpoint_bytes
+        self.colordef = colordef
+
+    def _get_locations(self):
+        return self.db._colorproofs.get(self.outpoint_bytes, {}).get(self.colordef.hash, {})
+
+    def add(self, colorproof):
+        if colorproof in self:
+            return
+        self.db._append_record(self.db.RECORD_COLORPROOF,
+                               self.outpoint_bytes + self.colordef.hash +
+                               _serialize_to_bytes(smartcolors.io.ColorProofFileSerializer, colorproof))
+
+    def remove(self, colorproof):
+        if colorproof not in self:
+            raise KeyError(colorproof)
+        self.db._append_record(self.db.RECORD_COLORPROOF_REMOVED,
+                               self.outpoint_bytes + self.colordef.hash + colorproof.hash)
+
+    def __contains__(self, colorproof):
+        return colorproof.hash in self._get_locations()
+
+    def __iter__(self):
+        for location in tuple(self._get_locations().values()):
+            record_type, payload = self.db._read_record(location)
+            yield smartcolors.io.ColorProofFileSerializer.buffer_deserialize(payload[36+32:], limits=None)
+
+    def __len__(self):
+        return len(self._get_locations())
+
+class LogColorProofsByColorDefDict(ColorProofDbMappingView):
+    def __init__(self, db, outpoint_bytes):
+        super().__init__(db)
+        self.outpoint_bytes = outpoint_bytes
+
+    def __iter__(self):
+        for colordef_hash in tuple(self.db._colorproofs.get(self.outpoint_bytes, {})):
+            yield self.db._get_colordef(colordef_hash)
+
+    def __contains__(self, colordef):
+        return colordef.hash in self.db._colorproofs.get(self.outpoint_bytes, {})
+
+    def _get_item(self, colordef):
+        return LogColorProofSet(self.db, self.outpoint_bytes, colordef)
+
+class LogColoredOutPointsDict(ColorProofDbMappingView):
+    def __iter__(self):
+        for outpoint_bytes in tuple(self.db._colorproofs):
+            yield bitcoin.core.COutPoint.deserialize(outpoint_bytes)
+
+    def __contains__(self, outpoint):
+        return outpoint.serialize() in self.db._colorproofs
+
+    def _get_item(self, outpoint):
+        return LogColorProofsByColorDefDict(self.db, outpoint.serialize())
+
+class LogIndex(collections.abc.MutableMapping):
+    """Index of bytes to bytes stored in the log of a LogColorProofDb"""
+
+    # lengths of the index name and key
+    PAYLOAD_HEADER = struct.Struct('<BH')
+
+    def __init__(self, db, name):
+        self.db = db
+        self.name = name
+
+    def _payload(self, key, value=b''):
+        name_bytes = self.name.encode('utf8')
+        return self.PAYLOAD_HEADER.pack(len(name_bytes), len(key)) + name_bytes + key + value
+
+    @classmethod
+    def parse_payload(cls, payload):
+        """Parse a record payload into (name, key, value)"""
+        name_len, key_len = cls.PAYLOAD_HEADER.unpack(payload[0:cls.PAYLOAD_HEADER.size])
+        payload = payload[cls.PAYLOAD_HEADER.size:]
+        return (payload[0:name_len].decode('utf8'),
+                payload[name_len:name_len+key_len],
+                payload[name_len+key_len:])
+
+    def __getitem__(self, key):
+        return self.db._indexes[self.name][key]
+
+    def __setitem__(self, key, value):
+        self.db._append_record(self.db.RECORD_INDEX_SET, self._payload(key, value))
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self.db._append_record(self.db.RECORD_INDEX_DELETE, self._payload(key))
+
+    def __contains__(self, key):
+        return key in self.db._indexes[self.name]
+
+    def __iter__(self):
+        yield from tuple(self.db._indexes[self.name])
+
+    def __len__(self):
+        return len(self.db._indexes[self.name])
+
+    def iter_prefix(self, prefix):
+        yield from self.db._indexes[self.name].iter_prefix(prefix)
+
+class LogColorProofDb(smartcolors.core.db.ColorProofDb):
+    """ColorProofDb stored in append-only log segments
+
+    Every addition to the db is appended as a record to the current segment
+    file; nothing is ever written in place. An in-memory index maps each
+    element to the location of the record holding it, so only ColorDefs and
+    the index itself are kept in memory, with proofs read from the log as
+    needed.
+
+    The index is checkpointed to disk periodically, and on open only the
+    records written since the last checkpoint are replayed. A partially
+    written record at the end of the log, left by a crash, is discarded.
+
+    Removing a proof appends a record saying so; the space used by removed
+    proofs is reclaimed by compact().
+
+    The records written within a batch() are preceded by a batch record and
+    followed by a commit record, and are only indexed on replay once the
+    commit record has been read; an uncommitted batch is discarded along
+    with any partially written record.
+
+    Only one process may open the db for writing. Opened with readonly set
+    the db is indexed as of when it was opened, up to the last complete
+    record, and never modified. Compaction deletes the segments a reader's
+    index refers to, so readers should read within snapshot_read(), which
+    reindexes the log when that happens.
+    """
+
+    RECORD_COLORDEF = 1
+    RECORD_GENESIS_OUTPOINT = 2
+    RECORD_GENESIS_SCRIPTPUBKEY = 3
+    RECORD_COLORPROOF = 4
+    RECORD_COLORPROOF_REMOVED = 5
+    RECORD_INDEX_SET = 6
+    RECORD_INDEX_DELETE = 7
+    RECORD_BATCH = 8
+    RECORD_BATCH_COMMIT = 9
+
+    # length, crc32 and type of the record payload
+    RECORD_HEADER = struct.Struct('<IIB')
+
+    SEGMENT_MAX_SIZE = 64*1024*1024
+
+    # Checkpoint the index after this many records have been appended
+    CHECKPOINT_INTERVAL = 10000
+
+    def __init__(self, root_dir_path, *, readonly=False, **kwargs):
+        super().__init__(**kwargs)
+
+        self.root_dir_path = os.path.abspath(root_dir_path)
+        self.readonly = readonly
+
+        self.writer_lock = ColorProofDbWriterLock(self.root_dir_path)
+        if not self.readonly:
+            self.writer_lock.acquire()
+        else:
+            os.makedirs(self.root_dir_path, exist_ok=True)
+
+        self.colordefs = LogColorDefSet(self)
+        self.genesis_outpoints = LogGenesisOutPointsDict(self)
+        self.genesis_scriptPubKeys = LogGenesisScriptPubKeysDict(self)
+        self.colored_outpoints = LogColoredOutPointsDict(self)
+        self._init_indexes()
+
+        self._read_fds = {}
+        self._in_snapshot = False
+
+        self._batch_depth = 0
+        self._batch_location = None # of the batch record, once written
+
+        if not self.readonly:
+            self._recover_compaction()
+
+        self._load_index()
+
+        self._append_fd = None
+        if not self.readonly:
+            self._append_fd = open(self._segment_path(self._segment_num), 'ab')
+
+    def _make_index(self, name):
+        return LogIndex(self, name)
+
+    def _load_index(self):
+        """(Re)build the index from the checkpoint and the log after it"""
+        self._colordef_locations = {}   # {colordef hash:location}
+        self._genesis_outpoints = {}    # {serialized outpoint:set(colordef hash)}
+        self._genesis_scriptPubKeys = {} # {scriptPubKey bytes:set(colordef hash)}
+        self._colorproofs = {}          # {serialized outpoint:{colordef hash:{colorproof hash:location}}}
+        self._indexes = {index_name:self._make_memory_index(index_name)
+                            for index_name in self.INDEX_NAMES} # {name:{key:value}}
+        self.state_commitment = smartcolors.core.db.StateTree()
+
+        self._colordefs_by_hash = {}
+        for fd in self._read_fds.values():
+            fd.close()
+        self._read_fds = {}
+        self._records_since_checkpoint = 0
+
+        # Position that the log has been indexed up to
+        self._segment_num = 0
+        self._segment_offset = 0
+
+        # Listed before the checkpoint is loaded, so that if this segment is
+        # deleted by a compaction the index may refer to deleted segments.
+        segment_nums = self._list_segment_nums()
+        self._first_segment_num = segment_nums[0] if segment_nums else None
+
+        if not self._load_checkpoint():
+            if segment_nums:
+                self._segment_num = segment_nums[0]
+
+        self._replay()
+
+    @contextlib.contextmanager
+    def batch(self):
+        if self.readonly:
+            raise PermissionError('%s was opened read-only' % self.root_dir_path)
+
+        self._batch_depth += 1
+        try:
+            yield self
+
+        except BaseException:
+            self._batch_depth -= 1
+            if not self._batch_depth and self._batch_location is not None:
+                # Truncate the uncommitted batch away, and reindex to forget
+                # it; no checkpoint is written during a batch.
+                segment_num, offset = self._batch_location
+                self._batch_location = None
+                self._append_fd.close()
+                os.truncate(self._segment_path(segment_num), offset)
+
+                self._load_index()
+                self._append_fd = open(self._segment_path(self._segment_num), 'ab')
+            raise
+
+        else:
+            self._batch_depth -= 1
+            if not self._batch_depth and self._batch_location is not None:
+                self._append_record(self.RECORD_BATCH_COMMIT, b'')
+                self._batch_location = None
+
+    def addcolordef(self, colordef):
+        with self.batch():
+            super().addcolordef(colordef)
+
+    def addcolorproof(self, colorproof):
+        with self.batch():
+            super().addcolorproof(colorproof)
+
+    def addtx(self, tx):
+        with self.batch():
+            super().addtx(tx)
+
+    @contextlib.contextmanager
+    def snapshot(self):
+        # Records are never modified in place, so the only thing that can
+        # change out from under a reader is compaction deleting the segments
+        # its index refers to. If that has happened the log is reindexed,
+        # bringing the reader up to date.
+        if not self.readonly or self._in_snapshot:
+            yield self
+            return
+
+        self._in_snapshot = True
+        try:
+            if self._first_segment_num is not None \
+                    and not os.path.exists(self._segment_path(self._first_segment_num)):
+                self._load_index()
+
+            try:
+                yield self
+            except FileNotFoundError as exp:
+                raise smartcolors.core.db.ColorProofDbConcurrentWriteError('db compacted while reading') from exp
+
+        finally:
+            self._in_snapshot = False
+
+    def _segment_path(self, segment_num):
+        return os.path.join(self.root_dir_path, '%08d.log' % segment_num)
+
+    def _checkpoint_path(self):
+        return os.path.join(self.root_dir_path, 'checkpoint')
+
+    def _list_segment_nums(self):
+        return sorted(int(filename[:-len('.log')]) for filename in os.listdir(self.root_dir_path)
+                        if filename.endswith('.log'))
+
+    def _load_checkpoint(self):
+        """Load the index from the checkpoint
+
+        Returns False if there is no checkpoint.
+        """
+        try:
+            with open(self._checkpoint_path(), 'rb') as fd:
+                checkpoint = pickle.load(fd)
+        except FileNotFoundError:
+            return False
+
+        (self._segment_num, self._segment_offset,
+         self._colordef_locations, self._genesis_outpoints, self._genesis_scriptPubKeys, self._colorproofs,
+         state_depth, state_buckets) = checkpoint[0:8]
+
+        # Checkpoints written before indexes existed end there
+        if len(checkpoint) > 8:
+            for index_name, index in checkpoint[8].items():
+                if type(index) is type(self._indexes.get(index_name, {})):
+                    self._indexes[index_name] = index
+                else:
+                    self._indexes[index_name].update(index)
+
+        self.state_commitment = smartcolors.core.db.StateTree(depth=state_depth)
+        for prefix, serialized_bucket in state_buckets.items():
+            self.state_commitment.buckets[prefix] = smartcolors.core.db.MultisetHash.deserialize(serialized_bucket)
+
+        return True
+
+    def _write_checkpoint(self, checkpoint_path):
+        state_buckets = {prefix:bucket.serialize() for prefix, bucket in self.state_commitment.buckets.items()}
+        checkpoint = (self._segment_num, self._segment_offset,
+                      self._colordef_locations, self._genesis_outpoints, self._genesis_scriptPubKeys, self._colorproofs,
+                      self.state_commitment.depth, state_buckets,
+                      self._indexes)
+
+        with tempfile.NamedTemporaryFile(dir=self.root_dir_path, prefix='checkpoint-tmp-', delete=False) as fd:
+            pickle.dump(checkpoint, fd, protocol=pickle.HIGHEST_PROTOCOL)
+            fd.flush()
+            os.fsync(fd.fileno())
+        os.replace(fd.name, checkpoint_path)
+
+    def checkpoint(self):
+        """Checkpoint the index to disk"""
+        if self.readonly:
+            raise PermissionError('%s was opened read-only' % self.root_dir_path)
+        self._append_fd.flush()
+        self._write_checkpoint(self._checkpoint_path())
+        self._records_since_checkpoint = 0
+
+    COMPACTION_SUFFIX = '.compact'
+
+    def _compaction_marker_path(self):
+        return os.path.join(self.root_dir_path, 'compacting')
+
+    def _recover_compaction(self):
+        """Finish or roll back an interrupted compaction"""
+        try:
+            with open(self._compaction_marker_path(), 'r') as fd:
+                first_segment_num = json.load(fd)
+        except FileNotFoundError:
+            # Never committed, so whatever was written is discarded
+            for filename in os.listdir(self.root_dir_path):
+                if filename.endswith(self.COMPACTION_SUFFIX):
+                    os.unlink(os.path.join(self.root_dir_path, filename))
+            return
+
+        for filename in os.listdir(self.root_dir_path):
+            if filename.endswith(self.COMPACTION_SUFFIX):
+                abspath = os.path.join(self.root_dir_path, filename)
+                os.replace(abspath, abspath[:-len(self.COMPACTION_SUFFIX)])
+
+        for segment_num in self._list_segment_nums():
+            if segment_num < first_segment_num:
+                os.unlink(self._segment_path(segment_num))
+
+        os.unlink(self._compaction_marker_path())
+
+    def compact(self):
+        """Rewrite the log without removed proofs
+
+        The live records are copied to new segments, which replace the
+        existing ones once complete. If interrupted the compaction is either
+        finished or discarded when the db is next opened.
+
+        Returns a dict of the size of the log before and after.
+        """
+        self.checkpoint()
+
+        stats = {'bytes_before': sum(os.path.getsize(self._segment_path(segment_num))
+                                        for segment_num in self._list_segment_nums())}
+
+        first_segment_num = self._segment_num + 1
+        segment_num = first_segment_num
+        segment_offset = 0
+        segment_fds = [open(self._segment_path(segment_num) + self.COMPACTION_SUFFIX, 'xb')]
+
+        def copy_record(record_type, payload):
+            nonlocal segment_num, segment_offset
+            if segment_offset >= self.SEGMENT_MAX_SIZE:
+                segment_num += 1
+                segment_offset = 0
+                segment_fds.append(open(self._segment_path(segment_num) + self.COMPACTION_SUFFIX, 'xb'))
+
+            location = (segment_num, segment_offset)
+            segment_fds[-1].write(self.RECORD_HEADER.pack(len(payload), zlib.crc32(payload), record_type))
+            segment_fds[-1].write(payload)
+            segment_offset += self.RECORD_HEADER.size + len(payload)
+            return location
+
+        try:
+            # Colordefs go first, as the other records refer to them
+            colordef_locations = {colordef_hash:copy_record(*self._read_record(location))
+                                    for colordef_hash, location in self._colordef_locations.items()}
+
+            for outpoint_bytes, colordef_hashes in self._genesis_outpoints.items():
+                for colordef_hash in colordef_hashes:
+                    copy_record(self.RECORD_GENESIS_OUTPOINT, outpoint_bytes + colordef_hash)
+
+            for scriptPubKey_bytes, colordef_hashes in self._genesis_scriptPubKeys.items():
+                for colordef_hash in colordef_hashes:
+                    copy_record(self.RECORD_GENESIS_SCRIPTPUBKEY, colordef_hash + scriptPubKey_bytes)
+
+            colorproofs = {}
+            for outpoint_bytes, colorproofs_by_colordef in self._colorproofs.items():
+                for colordef_hash, locations in colorproofs_by_colordef.items():
+                    for colorproof_hash, location in locations.items():
+                        colorproofs.setdefault(outpoint_bytes, {}) \
+                                   .setdefault(colordef_hash, {})[colorproof_hash] = copy_record(*self._read_record(location))
+
+            for index_name in self._indexes:
+                index = LogIndex(self, index_name)
+                for key, value in index.items():
+                    copy_record(self.RECORD_INDEX_SET, index._payload(key, value))
+
+            for fd in segment_fds:
+                fd.flush()
+                os.fsync(fd.fileno())
+
+        finally:
+            for fd in segment_fds:
+                fd.close()
+
+        # Switch over to the new segments
+        self._append_fd.close()
+        for fd in self._read_fds.values():
+            fd.close()
+        self._read_fds = {}
+
+        self._colordef_locations = colordef_locations
+        self._colorproofs = colorproofs
+        self._segment_num = segment_num
+        self._segment_offset = segment_offset
+
+        self._write_checkpoint(self._checkpoint_path() + self.COMPACTION_SUFFIX)
+
+        # The commit point
+        with tempfile.NamedTemporaryFile('w', dir=self.root_dir_path, prefix='compacting-tmp-', delete=False) as fd:
+            json.dump(first_segment_num, fd)
+            fd.flush()
+            os.fsync(fd.fileno())
+        os.replace(fd.name, self._compaction_marker_path())
+
+        self._recover_compaction()
+
+        self._append_fd = open(self._segment_path(self._segment_num), 'ab')
+        self._records_since_checkpoint = 0
+
+        stats['bytes_after'] = sum(os.path.getsize(self._segment_path(segment_num))
+                                        for segment_num in self._list_segment_nums())
+        return stats
+
+    def close(self):
+        """Checkpoint and close the db"""
+        if not self.readonly:
+            self.checkpoint()
+            self._append_fd.close()
+        for fd in self._read_fds.values():
+            fd.close()
+        self._read_fds = {}
+        self.writer_lock.release()
+
+    def _replay(self):
+        """Index all records after the current position"""
+        while True:
+            try:
+                fd = open(self._segment_path(self._segment_num), 'rb')
+            except FileNotFoundError:
+                break
+
+            with fd:
+                fd.seek(self._segment_offset)
+                batch_records = None # [(record_type, payload, location)] if in a batch
+                while True:
+                    location = (self._segment_num, fd.tell())
+                    record = self._read_record_from_fd(fd)
+                    if record is None:
+                        break
+
+                    record_type, payload = record
+                    if record_type == self.RECORD_BATCH:
+                        batch_records = []
+
+                    elif record_type == self.RECORD_BATCH_COMMIT:
+                        for batch_record in batch_records:
+                            self._index_record(*batch_record, replaying=True)
+                        batch_records = None
+
+                    elif batch_records is not None:
+                        batch_records.append((record_type, payload, location))
+
+                    else:
+                        self._index_record(record_type, payload, location, replaying=True)
+
+                    # Not past the start of an uncommitted batch
+                    if batch_records is None:
+                        self._segment_offset = fd.tell()
+
+                # Anything after the last good record was a partial write or
+                # uncommitted batch, or for readers, may still be being
+                # written.
+                fd.seek(0, os.SEEK_END)
+                if fd.tell() != self._segment_offset and not self.readonly:
+                    logging.warning('Truncating %d bytes of partially written records from %s' % \
+                                        (fd.tell() - self._segment_offset, self._segment_path(self._segment_num)))
+                    os.truncate(self._segment_path(self._segment_num), self._segment_offset)
+
+            if not os.path.exists(self._segment_path(self._segment_num + 1)):
+                break
+
+            self._segment_num += 1
+            self._segment_offset = 0
+
+    def _read_record_from_fd(self, fd):
+        """Read the record at the current position
+
+        Returns (record_type, payload) or None if there isn't a complete and
+        valid record there.
+        """
+        header = fd.read(self.RECORD_HEADER.size)
+        if len(header) != self.RECORD_HEADER.size:
+            return None
+
+        payload_len, payload_crc, record_type = self.RECORD_HEADER.unpack(header)
+        payload = fd.read(payload_len)
+        if len(payload) != payload_len or zlib.crc32(payload) != payload_crc:
+            return None
+
+        return (record_type, payload)
+
+    def _read_record(self, location):
+        segment_num, offset = location
+
+        if segment_num == self._segment_num and self._append_fd is not None:
+            self._append_fd.flush()
+
+        try:
+            fd = self._read_fds[segment_num]
+        except KeyError:
+            fd = self._read_fds[segment_num] = open(self._segment_path(segment_num), 'rb')
+
+        fd.seek(offset)
+        record = self._read_record_from_fd(fd)
+        if record is None:
+            raise IOError('corrupt record at %r' % (location,))
+        return record
+
+    def _append_record(self, record_type, payload):
+        if self.readonly:
+            raise PermissionError('%s was opened read-only' % self.root_dir_path)
+
+        # Batches are never split across segments
+        if self._segment_offset >= self.SEGMENT_MAX_SIZE and self._batch_location is None:
+            self._append_fd.close()
+            self._segment_num += 1
+            self._segment_offset = 0
+            self._append_fd = open(self._segment_path(self._segment_num), 'ab')
+
+        if self._batch_depth and self._batch_location is None:
+            self._batch_location = (self._segment_num, self._segment_offset)
+            self._append_record(self.RECORD_BATCH, b'')
+
+        location = (self._segment_num, self._segment_offset)
+
+        self._append_fd.write(self.RECORD_HEADER.pack(len(payload), zlib.crc32(payload), record_type))
+        self._append_fd.write(payload)
+        self._append_fd.flush()
+        self._segment_offset += self.RECORD_HEADER.size + len(payload)
+
+        self._index_record(record_type, payload, location, replaying=False)
+
+        self._records_since_checkpoint += 1
+        if self._records_since_checkpoint >= self.CHECKPOINT_INTERVAL and not self._batch_depth:
+            self.checkpoint()
+
+    def _index_record(self, record_type, payload, location, replaying):
+        """Add a record to the index
+
+        When replaying the state commitment is updated too; otherwise
+        ColorProofDb does that itself.
+        """
+        if record_type == self.RECORD_COLORDEF:
+            colordef = smartcolors.io.ColorDefFileSerializer.buffer_deserialize(payload, limits=None)
+            self._colordef_locations[colordef.hash] = location
+            self._colordefs_by_hash[colordef.hash] = colordef
+
+            if replaying:
+                self.state_commitment.add(*self._colordef_state_elem(colordef))
+
+        elif record_type == self.RECORD_GENESIS_OUTPOINT:
+            outpoint_bytes, colordef_hash = payload[0:36], payload[36:68]
+            self._genesis_outpoints.setdefault(outpoint_bytes, set()).add(colordef_hash)
+
+            if replaying:
+                self.state_commitment.add(*self._genesis_outpoint_state_elem(
+                        bitcoin.core.COutPoint.deserialize(outpoint_bytes),
+                        self._get_colordef(colordef_hash)))
+
+        elif record_type == self.RECORD_GENESIS_SCRIPTPUBKEY:
+            colordef_hash, scriptPubKey_bytes = payload[0:32], payload[32:]
+            self._genesis_scriptPubKeys.setdefault(scriptPubKey_bytes, set()).add(colordef_hash)
+
+            if replaying:
+                self.state_commitment.add(*self._genesis_scriptPubKey_state_elem(
+                        bitcoin.core.script.CScript(scriptPubKey_bytes),
+                        self._get_colordef(colordef_hash)))
+
+        elif record_type == self.RECORD_COLORPROOF:
+            outpoint_bytes, colordef_hash = payload[0:36], payload[36:68]
+
+            # The proof hash is stored at the end of the serialized proof, so
+            # the proof doesn't have to be deserialized to index it.
+            colorproof_hash = payload[-32:]
+
+            self._colorproofs \
+                    .setdefault(outpoint_bytes, {}) \
+                    .setdefault(colordef_hash, {})[colorproof_hash] = location
+
+            if replaying:
+                colorproof = smartcolors.io.ColorProofFileSerializer.buffer_deserialize(payload[68:], limits=None)
+                self.state_commitment.add(*self._colorproof_state_elem(
+                        bitcoin.core.COutPoint.deserialize(outpoint_bytes),
+                        self._get_colordef(colordef_hash),
+                        colorproof))
+
+        elif record_type == self.RECORD_COLORPROOF_REMOVED:
+            outpoint_bytes, colordef_hash, colorproof_hash = payload[0:36], payload[36:68], payload[68:100]
+
+            colorproofs_by_colordef = self._colorproofs[outpoint_bytes]
+            del colorproofs_by_colordef[colordef_hash][colorproof_hash]
+            if not colorproofs_by_colordef[colordef_hash]:
+                del colorproofs_by_colordef[colordef_hash]
+                if not colorproofs_by_colordef:
+                    del self._colorproofs[outpoint_bytes]
+
+            if replaying:
+                # The payload is the tail of the state element, so the proof
+                # itself isn't needed.
+                self.state_commitment.remove(outpoint_bytes,
+                                             bytes([self.STATE_ELEM_COLORPROOF]) + payload)
+
+        elif record_type == self.RECORD_INDEX_SET:
+            index_name, key, value = LogIndex.parse_payload(payload)
+            self._indexes.setdefault(index_name, {})[key] = value
+
+        elif record_type == self.RECORD_INDEX_DELETE:
+            index_name, key, value = LogIndex.parse_payload(payload)
+            del self._indexes[index_name][key]
+
+        elif record_type in (self.RECORD_BATCH, self.RECORD_BATCH_COMMIT):
+            pass
+
+        else:
+            raise ValueError('unknown record type %d' % record_type)
+
+    def _get_colordef(self, colordef_hash):
+        try:
+            return self._colordefs_by_hash[colordef_hash]
+        except KeyError:
+            record_type, payload = self._read_record(self._colordef_locations[colordef_hash])
+            colordef = smartcolors.io.ColorDefFileSerializer.buffer_deserialize(payload, limits=None)
+            self._colordefs_by_hash[colordef_hash] = colordef
+            return colordef
+
+    def _get_colorproof(self, outpoint, colordef_hash, colorproof_hash):
+        location = self._colorproofs[outpoint.serialize()][colordef_hash][colorproof_hash]
+        record_type, payload = self._read_record(location)
+        return smartcolors.io.ColorProofFileSerializer.buffer_deserialize(payload[36+32:], limits=None)
+
+class SqliteColorDefSet:
+    """All ColorDefs in a SqliteColorProofDb"""
+
+    def __init__(self, db):
+        self.db = db
+
+    def add(self, colordef):
+        self.db._conn.execute('INSERT OR IGNORE INTO colordefs (hash, colordef) VALUES (?, ?)',
+                              (colordef.hash, _serialize_to_bytes(smartcolors.io.ColorDefFileSerializer, colordef)))
+
+    def __contains__(self, colordef):
+        return self.db._conn.execute('SELECT 1 FROM colordefs WHERE hash = ?',
+                                     (colordef.hash,)).fetchone() is not None
+
+    def __iter__(self):
+        for (colordef_hash,) in self.db._conn.execute('SELECT hash FROM colordefs').fetchall():
+            yield self.db._get_colordef(colordef_hash)
+
+class SqliteColorDefRefSet:
+    """Set of ColorDefs a genesis outpoint or scriptPubKey belongs to"""
+
+    def __init__(self, db, table, key_bytes):
+        self.db = db
+        self.table = table
+        self.key_bytes = key_bytes
+
+    def add(self, colordef):
+        self.db._conn.execute('INSERT OR IGNORE INTO %s (key, colordef_hash) VALUES (?, ?)' % self.table,
+                              (self.key_bytes, colordef.hash))
+
+    def __contains__(self, colordef):
+        return self.db._conn.execute('SELECT 1 FROM %s WHERE key = ? AND colordef_hash = ?' % self.table,
+                                     (self.key_bytes, colordef.hash)).fetchone() is not None
+
+    def __iter__(self):
+        for (colordef_hash,) in self.db._conn.execute('SELECT colordef_hash FROM %s WHERE key = ?' % self.table,
+                                                      (self.key_bytes,)).fetchall():
+            yield self.db._get_colordef(colordef_hash)
+
+class SqliteGenesisOutPointsDict(ColorProofDbMappingView):
+    def __iter__(self):
+        for (outpoint_bytes,) in self.db._conn.execute('SELECT DISTINCT key FROM genesis_outpoints').fetchall():
+            yield bitcoin.core.COutPoint.deserialize(outpoint_bytes)
+
+    def __contains__(self, outpoint):
+        return self.db._conn.execute('SELECT 1 FROM genesis_outpoints WHERE key = ?',
+                                     (outpoint.serialize(),)).fetchone() is not None
+
+    def _get_item(self, outpoint):
+        return SqliteColorDefRefSet(self.db, 'genesis_outpoints', outpoint.serialize())
+
+class SqliteGenesisScriptPubKeysDict(ColorProofDbMappingView):
+    def __iter__(self):
+        for (scriptPubKey_bytes,) in self.db._conn.execute('SELECT DISTINCT key FROM genesis_scriptPubKeys').fetchall():
+            yield bitcoin.core.script.CScript(scriptPubKey_bytes)
+
+    def __contains__(self, scriptPubKey):
+        return self.db._conn.execute('SELECT 1 FROM genesis_scriptPubKeys WHERE key = ?',
+                                     (bytes(scriptPubKey),)).fetchone() is not None
+
+    def _get_item(self, scriptPubKey):
+        return SqliteColorDefRefSet(self.db, 'genesis_scriptPubKeys', bytes(scriptPubKey))
+
+class SqliteColorProofSet:
+    """ColorProofs for a specific outpoint and ColorDef"""
+
+    def __init__(self, db, outpoint_bytes, colordef):
+        self.db = db
+        self.outpoint_bytes = outpoint_bytes
+        self.colordef = colordef
+
+    def add(self, colorproof):
+        self.db._conn.execute('INSERT OR IGNORE INTO colorproofs (outpoint, colordef_hash, hash, colorproof) VALUES (?, ?, ?, ?)',
+                              (self.outpoint_bytes, self.colordef.hash, colorproof.hash,
+                               _serialize_to_bytes(smartcolors.io.ColorProofFileSerializer, colorproof)))
+
+    def remove(self, colorproof):
+        cursor = self.db._conn.execute('DELETE FROM colorproofs WHERE outpoint = ? AND colordef_hash = ? AND hash = ?',
+                                       (self.outpoint_bytes, self.colordef.hash, colorproof.hash))
+        if not cursor.rowcount:
+            raise KeyError(colorproof)
+
+    def __contains__(self, colorproof):
+        return self.db._conn.execute('SELECT 1 FROM colorproofs WHERE outpoint = ? AND colordef_hash = ? AND hash = ?',
+                                     (self.outpoint_bytes, self.colordef.hash, colorproof.hash)).fetchone() is not None
+
+    def __iter__(self):
+        for (serialized_colorproof,) in self.db._conn.execute('SELECT colorproof FROM colorproofs WHERE outpoint = ? AND colordef_hash = ?',
+                                                              (self.outpoint_bytes, self.colordef.hash)).fetchall():
+            yield smartcolors.io.ColorProofFileSerializer.buffer_deserialize(serialized_colorproof, limits=None)
+
+    def __len__(self):
+        (n,) = self.db._conn.execute('SELECT COUNT(*) FROM colorproofs WHERE outpoint = ? AND colordef_hash = ?',
+                                     (self.outpoint_bytes, self.colordef.hash)).fetchone()
+        return n
+
+class SqliteColorProofsByColorDefDict(ColorProofDbMappingView):
+    def __init__(self, db, outpoint_bytes):
+        super().__init__(db)
+        self.outpoint_bytes = outpoint_bytes
+
+    def __iter__(self):
+        for (colordef_hash,) in self.db._conn.execute('SELECT DISTINCT colordef_hash FROM colorproofs WHERE outpoint = ?',
+                                                      (self.outpoint_bytes,)).fetchall():
+            yield self.db._get_colordef(colordef_hash)
+
+    def __contains__(self, colordef):
+        return self.db._conn.execute('SELECT 1 FROM colorproofs WHERE outpoint = ? AND colordef_hash = ?',
+                                     (self.outpoint_bytes, colordef.hash)).fetchone() is not None
+
+    def _get_item(self, colordef):
+        return SqliteColorProofSet(self.db, self.outpoint_bytes, colordef)
+
+class SqliteColoredOutPointsDict(ColorProofDbMappingView):
+    def __iter__(self):
+        for (outpoint_bytes,) in self.db._conn.execute('SELECT DISTINCT outpoint FROM colorproofs').fetchall():
+            yield bitcoin.core.COutPoint.deserialize(outpoint_bytes)
+
+    def __contains__(self, outpoint):
+        return self.db._conn.execute('SELECT 1 FROM colorproofs WHERE outpoint = ?',
+                                     (outpoint.serialize(),)).fetchone() is not None
+
+    def _get_item(self, outpoint):
+        return SqliteColorProofsByColorDefDict(self.db, outpoint.serialize())
+
+class SqliteIndex(collections.abc.MutableMapping):
+    """Index of bytes to bytes stored in the indexes table"""
+
+    def __init__(self, db, name):
+        self.db = db
+        self.name = name
+
+    def __getitem__(self, key):
+        row = self.db._conn.execute('SELECT value FROM indexes WHERE name = ? AND key = ?',
+                                    (self.name, key)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return row[0]
+
+    def __setitem__(self, key, value):
+        self.db._conn.execute('INSERT OR REPLACE INTO indexes (name, key, value) VALUES (?, ?, ?)',
+                              (self.name, key, value))
+
+    def __delitem__(self, key):
+        cursor = self.db._conn.execute('DELETE FROM indexes WHERE name = ? AND key = ?',
+                                       (self.name, key))
+        if not cursor.rowcount:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return self.db._conn.execute('SELECT 1 FROM indexes WHERE name = ? AND key = ?',
+                                     (self.name, key)).fetchone() is not None
+
+    def __iter__(self):
+        for (key,) in self.db._conn.execute('SELECT key FROM indexes WHERE name = ?',
+                                            (self.name,)).fetchall():
+            yield key
+
+    def __len__(self):
+        (n,) = self.db._conn.execute('SELECT COUNT(*) FROM indexes WHERE name = ?',
+                                     (self.name,)).fetchone()
+        return n
+
+    def iter_prefix(self, prefix):
+        """Iterate over the (key, value) pairs whose keys start with prefix"""
+        # Keys sort bytewise, so the keys starting with prefix are those
+        # between it and the next prefix of the same length.
+        upper = prefix.rstrip(b'\xff')
+        if upper:
+            upper = upper[:-1] + bytes([upper[-1] + 1])
+            rows = self.db._conn.execute('SELECT key, value FROM indexes WHERE name = ? AND key >= ? AND key < ?',
+                                         (self.name, prefix, upper)).fetchall()
+        else:
+            rows = self.db._conn.execute('SELECT key, value FROM indexes WHERE name = ? AND key >= ?',
+                                         (self.name, prefix)).fetchall()
+        for key, value in rows:
+            if key.startswith(prefix):
+                yield (key, value)
+
+class SqliteStateTree(smartcolors.core.db.StateTree):
+    """StateTree whose buckets are stored in a SqliteColorProofDb"""
+
+    def __init__(self, *, conn, **kwargs):
+        super().__init__(**kwargs)
+        self.conn = conn
+
+        for prefix, serialized_bucket in conn.execute('SELECT prefix, bucket FROM state_buckets').fetchall():
+            if len(prefix) == self.depth:
+                self.buckets[prefix] = smartcolors.core.db.MultisetHash.deserialize(serialized_bucket)
+
+    def save_bucket(self, prefix):
+        self.conn.execute('INSERT OR REPLACE INTO state_buckets (prefix, bucket) VALUES (?, ?)',
+                          (prefix, self.buckets[prefix].serialize()))
+
+    def add(self, key, elem):
+        super().add(key, elem)
+        self.save_bucket(self.key_prefix(key))
+
+    def remove(self, key, elem):
+        super().remove(key, elem)
+        self.save_bucket(self.key_prefix(key))
+
+class SqliteColorProofDb(smartcolors.core.db.ColorProofDb):
+    """ColorProofDb stored in a SQLite database
+
+    The database is used in WAL mode. Every top-level call that modifies the
+    db runs in its own transaction; use batch() to group many of them, such
+    as all the transactions in a block, into a single commit.
+
+    Only one process may open the db for writing, as the state commitment
+    is cached in memory. Readers open it with readonly set, and read within
+    snapshot() to see a single version of the db.
+    """
+
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS colordefs (hash BLOB PRIMARY KEY, colordef BLOB NOT NULL)',
+        'CREATE TABLE IF NOT EXISTS genesis_outpoints (key BLOB NOT NULL, colordef_hash BLOB NOT NULL, PRIMARY KEY (key, colordef_hash))',
+        'CREATE TABLE IF NOT EXISTS genesis_scriptPubKeys (key BLOB NOT NULL, colordef_hash BLOB NOT NULL, PRIMARY KEY (key, colordef_hash))',
+        'CREATE TABLE IF NOT EXISTS colorproofs (outpoint BLOB NOT NULL, colordef_hash BLOB NOT NULL, hash BLOB NOT NULL, colorproof BLOB NOT NULL, PRIMARY KEY (outpoint, colordef_hash, hash))',
+        'CREATE TABLE IF NOT EXISTS state_buckets (prefix TEXT PRIMARY KEY, bucket BLOB NOT NULL)',
+        'CREATE TABLE IF NOT EXISTS indexes (name TEXT NOT NULL, key BLOB NOT NULL, value BLOB NOT NULL, PRIMARY KEY (name, key))',
+    )
+
+    def __init__(self, root_dir_path, *, readonly=False, **kwargs):
+        super().__init__(**kwargs)
+
+        self.root_dir_path = os.path.abspath(root_dir_path)
+        self.readonly = readonly
+
+        # New dbs are always created by a writer
+        db_existed = os.path.exists(os.path.join(self.root_dir_path, 'colordb.sqlite'))
+        self.writer_lock = ColorProofDbWriterLock(self.root_dir_path)
+        if not self.readonly or not db_existed:
+            self.writer_lock.acquire()
+
+        # Transactions are managed explicitly by batch()
+        self._conn = sqlite3.connect(os.path.join(self.root_dir_path, 'colordb.sqlite'),
+                                     isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+
+        self._batch_depth = 0
+        self._snapshot_depth = 0
+        if self.writer_lock.fd is not None:
+            with self.batch():
+                for statement in self.SCHEMA:
+                    self._conn.execute(statement)
+
+        if self.readonly:
+            self.writer_lock.release()
+            self._conn.execute('PRAGMA query_only=ON')
+
+        self.colordefs = SqliteColorDefSet(self)
+        self.genesis_outpoints = SqliteGenesisOutPointsDict(self)
+        self.genesis_scriptPubKeys = SqliteGenesisScriptPubKeysDict(self)
+        self.colored_outpoints = SqliteColoredOutPointsDict(self)
+        self._init_indexes()
+
+        self._colordefs_by_hash = {}
+        self.state_commitment = SqliteStateTree(conn=self._conn)
+
+    def _make_index(self, name):
+        return SqliteIndex(self, name)
+
+    @contextlib.contextmanager
+    def batch(self):
+        if self._batch_depth == 0:
+            self._conn.execute('BEGIN')
+        self._batch_depth += 1
+
+        try:
+            yield self
+
+        except BaseException:
+            self._batch_depth -= 1
+            if self._batch_depth == 0:
+                self._conn.execute('ROLLBACK')
+
+                # Cached state may include rolled back changes
+                self._colordefs_by_hash = {}
+                self.state_commitment = SqliteStateTree(conn=self._conn)
+            raise
+
+        else:
+            self._batch_depth -= 1
+            if self._batch_depth == 0:
+                self._conn.execute('COMMIT')
+
+    @contextlib.contextmanager
+    def snapshot(self):
+        # A read transaction sees a single version of the db, without
+        # blocking the writer.
+        if self._batch_depth or self._snapshot_depth:
+            yield self
+            return
+
+        self._conn.execute('BEGIN')
+        self._snapshot_depth += 1
+        try:
+            # Other processes may have changed the state since it was loaded
+            if self.readonly:
+                self.state_commitment = SqliteStateTree(conn=self._conn)
+            yield self
+        finally:
+            self._snapshot_depth -= 1
+            self._conn.execute('COMMIT')
+
+    def close(self):
+        self._conn.close()
+        self.writer_lock.release()
+
+    def addcolordef(self, colordef):
+        with self.batch():
+            super().addcolordef(colordef)
+
+    def addcolorproof(self, colorproof):
+        with self.batch():
+            super().addcolorproof(colorproof)
+
+    def addtx(self, tx):
+        with self.batch():
+            super().addtx(tx)
+
+    def _get_size(self):
+        size = 0
+        for suffix in ('', '-wal'):
+            try:
+                size += os.path.getsize(os.path.join(self.root_dir_path, 'colordb.sqlite' + suffix))
+            except FileNotFoundError:
+                pass
+        return size
+
+    def compact(self):
+        """Rebuild the database file without the free space left by removals
+
+        Readers of the WAL database are not blocked while this runs.
+
+        Returns a dict of the size of the db files before and after.
+        """
+        assert self._batch_depth == 0
+
+        stats = {'bytes_before': self._get_size()}
+        self._conn.execute('VACUUM')
+        self._conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        stats['bytes_after'] = self._get_size()
+        return stats
+
+    def _get_colordef(self, colordef_hash):
+        try:
+            return self._colordefs_by_hash[colordef_hash]
+        except KeyError:
+            (serialized_colordef,) = self._conn.execute('SELECT colordef FROM colordefs WHERE hash = ?',
+                                                        (colordef_hash,)).fetchone()
+            colordef = smartcolors.io.ColorDefFileSerializer.buffer_deserialize(serialized_colordef, limits=None)
+            self._colordefs_by_hash[colordef_hash] = colordef
+            return colordef
+
+    def _get_colorproof(self, outpoint, colordef_hash, colorproof_hash):
+        row = self._conn.execute('SELECT colorproof FROM colorproofs WHERE outpoint = ? AND colordef_hash = ? AND hash = ?',
+                                 (outpoint.serialize(), colordef_hash, colorproof_hash)).fetchone()
+        if row is None:
+            raise KeyError(colorproof_hash)
+        return smartcolors.io.ColorProofFileSerializer.buffer_deserialize(row[0], limits=None)
+
+# Storage backends selectable by name
+COLORDB_BACKENDS = {'files':  PersistentColorProofDb,
+                    'log':    LogColorProofDb,
+                    'sqlite': SqliteColorProofDb}
@@ -9,12 +9,50 @@
 # propagated, or distributed except according to the terms contained in the
 # LICENSE file.
 
+import collections
+import contextlib
+import hashlib
+import io
 import logging
+import mmap
 
 import bitcoin.core
+import proofmarshal
 import proofmarshal.memoize
 import smartcolors.core
 
+@contextlib.contextmanager
+def mmap_file(fd):
+    """Map a file read-only into memory
+
+    Yields the mmap, or None if the file can't be mmapped, for instance
+    because it's a pipe or empty.
+    """
+    try:
+        buf = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError, io.UnsupportedOperation):
+        yield None
+    else:
+        with buf:
+            yield buf
+
+# Proof and colordef files may come from anywhere, so are deserialized with
+# these limits unless told otherwise.
+DEFAULT_FILE_LIMITS = proofmarshal.DeserializationLimits(
+        max_total_bytes=100*1000*1000,
+        max_bytes_length=4*1000*1000, # large enough for any transaction
+        max_varuint_bytes=10,         # enough for 64 bits
+        max_depth=10000,
+        max_objs=1000*1000)
+
+# Snapshots are as large as the db they came from, so only the size of
+# individual fields is limited. Index values such as block undo data can
+# be large.
+DEFAULT_SNAPSHOT_LIMITS = proofmarshal.DeserializationLimits(
+        max_bytes_length=64*1000*1000,
+        max_varuint_bytes=10,
+        max_depth=100)
+
 class FileSerializer:
     """Memoized proofmarshal file format
 
@@ -38,18 +76,20 @@ class FileSerializer:
         fd.write(obj.hash)
 
     @classmethod
-    def stream_deserialize(cls, fd, check_hash=True):
+    def _ctx_deserialize(cls, ctx, check_hash):
         assert len(cls.MAGIC) == 32
-        actual_magic = fd.read(len(cls.MAGIC))
-        assert cls.MAGIC == actual_magic # FIXME: raise an exception here...
 
-        version = fd.read(1)
-        assert version == b'\x00'
+        actual_magic = ctx.fd_read(len(cls.MAGIC))
+        if cls.MAGIC != actual_magic:
+            raise proofmarshal.DeserializationError('bad magic bytes')
+
+        version = ctx.fd_read(1)
+        if version != b'\x00':
+            raise proofmarshal.DeserializationError('unknown file version %r' % version)
 
-        ctx = proofmarshal.memoize.MemoizedStreamDeserializationContext(fd)
         obj = ctx.read_obj(None, cls.OBJ_CLASS)
 
-        expected_hash = fd.read(32)
+        expected_hash = ctx.fd_read(32)
         if obj.hash != expected_hash:
             # FIXME: probably better ways to do this...
             msg = 'deserialized obj hash != expected hash: %s != %s' % \
@@ -62,6 +102,36 @@ class FileSerializer:
 
         return obj
 
+    @classmethod
+    def stream_deserialize(cls, fd, check_hash=True, limits=DEFAULT_FILE_LIMITS):
+        """Deserialize from a stream
+
+        limits - proofmarshal.DeserializationLimits to enforce while
+                 deserializing; None for no limits, which is only safe if
+                 the data is trusted
+        """
+        ctx = proofmarshal.memoize.MemoizedStreamDeserializationContext(fd, limits=limits)
+        return cls._ctx_deserialize(ctx, check_hash)
+
+    @classmethod
+    def buffer_deserialize(cls, buf, check_hash=True, limits=DEFAULT_FILE_LIMITS):
+        """Deserialize from a buffer, such as bytes or an mmap"""
+        ctx = proofmarshal.memoize.MemoizedBufferDeserializationContext(buf, limits=limits)
+        return cls._ctx_deserialize(ctx, check_hash)
+
+    @classmethod
+    def file_deserialize(cls, fd, check_hash=True, limits=DEFAULT_FILE_LIMITS):
+        """Deserialize from a file
+
+        The file is mmapped if possible, falling back to reading it as a
+        stream otherwise, e.g. for pipes.
+        """
+        with mmap_file(fd) as buf:
+            if buf is None:
+                return cls.stream_deserialize(fd, check_hash=check_hash, limits=limits)
+            else:
+                return cls.buffer_deserialize(buf, check_hash=check_hash, limits=limits)
+
 class ColorDefFileSerializer(FileSerializer):
     MAGIC = (b'\x00Smartcolors\x00\xfc\xbe\x88' +
              b'\x00Colordef\x00\xa8\xed\xdd\xf2\x14\x01')
@@ -73,3 +143,416 @@ class ColorProofFileSerializer(FileSerializer):
              b'\x00Colorproof\x00\xcb\x93\xf2\xc5')
 
     OBJ_CLASS = smartcolors.core.ColorProof
+
+class ColorProofRecord:
+    """A ColorProof with its colordef and prevout proofs referenced by hash
+
+    Used by the object store to store each unique proof exactly once.
+
+    colorproof_type - type of the proof
+    colordef_hash   - hash of the ColorDef
+    outpoint        - the colored outpoint, for genesis outpoint proofs
+    n, tx           - the colored output, for all other proofs
+    prevout_hashes  - hashes of the prevout proofs: {COutPoint:hash}
+    qty             - color qty proven
+    hash            - hash of the proof
+    """
+
+    def __init__(self, colorproof_type, colordef_hash, *, outpoint=None, n=None, tx=None,
+                 prevout_hashes=None, qty, hash):
+        self.colorproof_type = colorproof_type
+        self.colordef_hash = colordef_hash
+        self.outpoint = outpoint
+        self.n = n
+        self.tx = tx
+        self.prevout_hashes = prevout_hashes if prevout_hashes is not None else {}
+        self.qty = qty
+        self.hash = hash
+
+    @classmethod
+    def from_colorproof(cls, colorproof):
+        if isinstance(colorproof, smartcolors.core.GenesisOutPointColorProof):
+            return cls(colorproof.COLORPROOF_TYPE, colorproof.colordef.hash,
+                       outpoint=colorproof.outpoint, qty=colorproof.qty, hash=colorproof.hash)
+
+        elif isinstance(colorproof, smartcolors.core.GenesisScriptPubKeyColorProof):
+            return cls(colorproof.COLORPROOF_TYPE, colorproof.colordef.hash,
+                       n=colorproof.n, tx=colorproof.tx, qty=colorproof.qty, hash=colorproof.hash)
+
+        elif isinstance(colorproof, smartcolors.core.TransferredColorProof):
+            prevout_hashes = {prevout:prevout_proof.hash
+                                for prevout, prevout_proof in colorproof.prevout_proofs.items()}
+            return cls(colorproof.COLORPROOF_TYPE, colorproof.colordef.hash,
+                       n=colorproof.n, tx=colorproof.tx, prevout_hashes=prevout_hashes,
+                       qty=colorproof.qty, hash=colorproof.hash)
+
+        else:
+            raise TypeError('unknown ColorProof class %r' % colorproof.__class__)
+
+    def to_colorproof(self, colordef, prevout_proofs, *, trusted=True):
+        """Reassemble the ColorProof
+
+        prevout_proofs - {COutPoint:ColorProof} for every prevout hash
+
+        If trusted the hash and qty are taken from the record rather than
+        recalculated.
+        """
+        assert colordef.hash == self.colordef_hash
+
+        if self.colorproof_type == smartcolors.core.GenesisOutPointColorProof.COLORPROOF_TYPE:
+            colorproof = smartcolors.core.GenesisOutPointColorProof(colordef, self.outpoint)
+
+        elif self.colorproof_type == smartcolors.core.GenesisScriptPubKeyColorProof.COLORPROOF_TYPE:
+            colorproof = smartcolors.core.GenesisScriptPubKeyColorProof(colordef,
+                                                                         bitcoin.core.COutPoint(self.tx.GetHash(), self.n),
+                                                                         self.tx)
+
+        elif self.colorproof_type == smartcolors.core.TransferredColorProof.COLORPROOF_TYPE:
+            assert set(prevout_proofs) == set(self.prevout_hashes)
+            colorproof = smartcolors.core.TransferredColorProof(colordef,
+                                                                 bitcoin.core.COutPoint(self.tx.GetHash(), self.n),
+                                                                 self.tx, prevout_proofs)
+            if trusted:
+                object.__setattr__(colorproof, '_cached_qty', self.qty)
+
+        else:
+            raise proofmarshal.DeserializationError('unknown colorproof type %d' % self.colorproof_type)
+
+        if trusted:
+            object.__setattr__(colorproof, '_cached_hash', self.hash)
+        return colorproof
+
+class ColorProofRecordSerializer:
+    """File format for ColorProofRecords
+
+    Like FileSerializer, with magic bytes at the start and the hash of the
+    proof at the end.
+    """
+
+    MAGIC = (b'\x00Smartcolors\x00\xf4\x9a\x1e' +
+             b'\x00Proofrecord\x00\x5c\x27\xd0')
+
+    @classmethod
+    def stream_serialize(cls, record, fd):
+        assert len(cls.MAGIC) == 32
+        fd.write(cls.MAGIC)
+        fd.write(b'\x00') # version byte
+
+        cls.ctx_serialize_record(record, proofmarshal.StreamSerializationContext(fd))
+
+    @classmethod
+    def ctx_serialize_record(cls, record, ctx):
+        """Serialize a record, without the magic bytes and version"""
+        ctx.write_varuint('colorproof_type', record.colorproof_type)
+        ctx.write_bytes('colordef_hash', record.colordef_hash, 32)
+        ctx.write_varuint('qty', record.qty)
+
+        if record.colorproof_type == smartcolors.core.GenesisOutPointColorProof.COLORPROOF_TYPE:
+            ctx.write_obj('outpoint', record.outpoint, smartcolors.core.COutPointSerializer)
+
+        else:
+            ctx.write_varuint('n', record.n)
+            ctx.write_obj('tx', record.tx, smartcolors.core.CTransactionSerializer)
+
+            ctx.write_varuint('num_prevouts', len(record.prevout_hashes))
+            for prevout, prevout_hash in sorted(record.prevout_hashes.items(),
+                                                key=lambda item: item[0].serialize()):
+                ctx.write_obj('prevout', prevout, smartcolors.core.COutPointSerializer)
+                ctx.write_bytes('prevout_hash', prevout_hash, 32)
+
+        ctx.write_bytes('hash', record.hash, 32)
+
+    @classmethod
+    def stream_deserialize(cls, fd, limits=None):
+        return cls._ctx_deserialize(proofmarshal.StreamDeserializationContext(fd, limits=limits))
+
+    @classmethod
+    def buffer_deserialize(cls, buf, limits=None):
+        return cls._ctx_deserialize(proofmarshal.BufferDeserializationContext(buf, limits=limits))
+
+    @classmethod
+    def file_deserialize(cls, fd, limits=None):
+        with mmap_file(fd) as buf:
+            if buf is None:
+                return cls.stream_deserialize(fd, limits=limits)
+            else:
+                return cls.buffer_deserialize(buf, limits=limits)
+
+    @classmethod
+    def _ctx_deserialize(cls, ctx):
+
+        actual_magic = ctx.fd_read(len(cls.MAGIC))
+        if cls.MAGIC != actual_magic:
+            raise proofmarshal.DeserializationError('bad magic bytes')
+
+        version = ctx.fd_read(1)
+        if version != b'\x00':
+            raise proofmarshal.DeserializationError('unknown file version %r' % version)
+
+        return cls.ctx_deserialize_record(ctx)
+
+    @classmethod
+    def ctx_deserialize_record(cls, ctx):
+        """Deserialize a record serialized by ctx_serialize_record()"""
+        colorproof_type = ctx.read_varuint('colorproof_type')
+        colordef_hash = ctx.read_bytes('colordef_hash', 32)
+        qty = ctx.read_varuint('qty')
+
+        kwargs = {}
+        if colorproof_type == smartcolors.core.GenesisOutPointColorProof.COLORPROOF_TYPE:
+            kwargs['outpoint'] = ctx.read_obj('outpoint', smartcolors.core.COutPointSerializer)
+
+        else:
+            kwargs['n'] = ctx.read_varuint('n')
+            kwargs['tx'] = ctx.read_obj('tx', smartcolors.core.CTransactionSerializer)
+
+            prevout_hashes = {}
+            for i in range(ctx.read_varuint('num_prevouts')):
+                prevout = ctx.read_obj('prevout', smartcolors.core.COutPointSerializer)
+                prevout_hashes[prevout] = ctx.read_bytes('prevout_hash', 32)
+            kwargs['prevout_hashes'] = prevout_hashes
+
+        record_hash = ctx.read_bytes('hash', 32)
+
+        return ColorProofRecord(colorproof_type, colordef_hash, qty=qty, hash=record_hash, **kwargs)
+
+class _HashingFile:
+    """File wrapper hashing everything read or written"""
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.hasher = hashlib.sha256()
+
+    def read(self, n):
+        r = self.fd.read(n)
+        self.hasher.update(r)
+        return r
+
+    def write(self, b):
+        self.hasher.update(b)
+        return self.fd.write(b)
+
+class ColorProofDbSnapshotSerializer:
+    """Snapshot of the contents of a ColorProofDb
+
+    Used to bootstrap a new db far faster than rescanning the blockchain.
+    After the magic bytes and version the snapshot consists of the state
+    hash of the db, followed by a stream of entries:
+
+    colordef         - every colordef, first; the genesis indexes are
+                       recreated from them
+    colorproof       - a ColorProofRecord, after its prevout proofs; proofs
+                       are stored once, unless referred to again more than
+                       PROOF_WINDOW proofs later
+    colored outpoint - an (outpoint, colordef hash, proof hash) entry of
+                       colored_outpoints
+    index            - a (name, key, value) entry of one of the db's indexes,
+                       after every proof; on import these replace the
+                       indexes built while adding the proofs, as those
+                       can't know which outpoints were spent
+
+    The stream ends with an end entry and the SHA256 of everything
+    preceding it.
+    """
+
+    MAGIC = (b'\x00Smartcolors\x00\x8d\x31\x6b' +
+             b'\x00Dbsnapshot\x00\xe2\x05\x9a\x47')
+
+    ENTRY_END = 0
+    ENTRY_COLORDEF = 1
+    ENTRY_COLORPROOF = 2
+    ENTRY_COLORED_OUTPOINT = 3
+    ENTRY_INDEX = 4
+
+    # Number of entries imported per db batch
+    IMPORT_BATCH_SIZE = 10000
+
+    # Entries only refer to the proofs among the last PROOF_WINDOW written,
+    # so importing only needs to keep that many proofs in memory. Older
+    # proofs are written again when needed.
+    PROOF_WINDOW = 100000
+
+    @classmethod
+    def stream_serialize(cls, colordb, fd):
+        """Write a snapshot of colordb to fd
+
+        Returns the number of distinct proofs written.
+        """
+        assert len(cls.MAGIC) == 32
+        hashing_fd = _HashingFile(fd)
+        hashing_fd.write(cls.MAGIC)
+        hashing_fd.write(b'\x00') # version byte
+
+        ctx = proofmarshal.StreamSerializationContext(hashing_fd)
+        ctx.write_bytes('state_hash', colordb.state_hash, 32)
+
+        for colordef in colordb.colordefs:
+            ctx.write_varuint('entry_type', cls.ENTRY_COLORDEF)
+            ctx.write_obj('colordef', colordef)
+
+        written_hashes = {} # {proof hash:number of proofs written before it}
+        num_written = 0
+        def in_window(proof):
+            i = written_hashes.get(proof.hash)
+            return i is not None and i >= num_written - cls.PROOF_WINDOW
+
+        for outpoint, colorproofs_by_colordef in colordb.colored_outpoints.items():
+            for colordef, colorproof_set in colorproofs_by_colordef.items():
+                for colorproof in colorproof_set:
+                    # Prevout proofs first, iteratively as histories can be
+                    # long.
+                    remaining_proofs = [colorproof]
+                    while remaining_proofs:
+                        proof = remaining_proofs[-1]
+                        if in_window(proof):
+                            remaining_proofs.pop()
+                            continue
+
+                        missing_prevout_proofs = [prevout_proof for prevout_proof in proof._get_prevout_proofs().values()
+                                                    if not in_window(prevout_proof)]
+                        if missing_prevout_proofs:
+                            remaining_proofs.extend(missing_prevout_proofs)
+                            continue
+
+                        remaining_proofs.pop()
+                        ctx.write_varuint('entry_type', cls.ENTRY_COLORPROOF)
+                        ColorProofRecordSerializer.ctx_serialize_record(ColorProofRecord.from_colorproof(proof), ctx)
+                        written_hashes[proof.hash] = num_written
+                        num_written += 1
+
+                    ctx.write_varuint('entry_type', cls.ENTRY_COLORED_OUTPOINT)
+                    ctx.write_obj('outpoint', outpoint, smartcolors.core.COutPointSerializer)
+                    ctx.write_bytes('colordef_hash', colordef.hash, 32)
+                    ctx.write_bytes('colorproof_hash', colorproof.hash, 32)
+
+        for index_name in colordb.INDEX_NAMES:
+            for key, value in getattr(colordb, index_name).items():
+                ctx.write_varuint('entry_type', cls.ENTRY_INDEX)
+                ctx.write_bytes('index_name', index_name.encode('utf8'))
+                ctx.write_bytes('key', key)
+                ctx.write_bytes('value', value)
+
+        ctx.write_varuint('entry_type', cls.ENTRY_END)
+        fd.write(hashing_fd.hasher.digest())
+
+        return len(written_hashes)
+
+    @classmethod
+    def stream_deserialize(cls, fd, colordb, limits=DEFAULT_SNAPSHOT_LIMITS):
+        """Import a snapshot from fd into colordb, which should be empty
+
+        Any existing index entries of colordb are replaced by the snapshot's.
+        Proof hashes are recalculated, and the state hash of colordb checked
+        against the snapshot's once the checksum has been verified. As proof
+        hashes commit to quantities the record's qty isn't trusted either, so
+        the kernel is applied once per transferred proof; nothing else is
+        revalidated, and no transactions are fetched.
+
+        Index entries aren't covered by the state hash, and are imported
+        as-is without being checked against the proofs, so a snapshot from
+        an untrusted source can have bogus spends, balances, stats and undo
+        data. Only the proofs themselves are verified.
+
+        Entries are committed as they're read, so on failure colordb is left
+        partially imported with possibly corrupt data; import into a new db,
+        and only use it once this returns.
+
+        limits - proofmarshal.DeserializationLimits to enforce while
+                 deserializing; None for no limits
+
+        Returns colordb.
+        """
+        hashing_fd = _HashingFile(fd)
+        ctx = proofmarshal.StreamDeserializationContext(hashing_fd, limits=limits)
+
+        if ctx.fd_read(len(cls.MAGIC)) != cls.MAGIC:
+            raise proofmarshal.DeserializationError('bad magic bytes')
+
+        version = ctx.fd_read(1)
+        if version != b'\x00':
+            raise proofmarshal.DeserializationError('unknown snapshot version %r' % version)
+
+        expected_state_hash = ctx.read_bytes('state_hash', 32)
+
+        colordefs = {}
+        colorproofs = collections.OrderedDict() # the last PROOF_WINDOW proofs read
+
+        indexes_replaced = False
+        def replace_indexes():
+            nonlocal indexes_replaced
+            if not indexes_replaced:
+                for index_name in colordb.INDEX_NAMES:
+                    index = getattr(colordb, index_name)
+                    for key in list(index.keys()):
+                        del index[key]
+                indexes_replaced = True
+
+        done = False
+        while not done:
+            with colordb.batch():
+                for i in range(cls.IMPORT_BATCH_SIZE):
+                    entry_type = ctx.read_varuint('entry_type')
+
+                    if entry_type == cls.ENTRY_END:
+                        replace_indexes()
+                        done = True
+                        break
+
+                    elif indexes_replaced and entry_type != cls.ENTRY_INDEX:
+                        raise proofmarshal.DeserializationError('snapshot entry type %d after index entries' % entry_type)
+
+                    elif entry_type == cls.ENTRY_COLORDEF:
+                        colordef = ctx.read_obj('colordef', smartcolors.core.ColorDef)
+                        colordefs[colordef.hash] = colordef
+                        colordb._addcolordef(colordef, genesis_proofs=False)
+
+                    elif entry_type == cls.ENTRY_COLORPROOF:
+                        record = ColorProofRecordSerializer.ctx_deserialize_record(ctx)
+                        try:
+                            prevout_proofs = {prevout:colorproofs[prevout_hash]
+                                                for prevout, prevout_hash in record.prevout_hashes.items()}
+                            colordef = colordefs[record.colordef_hash]
+                        except KeyError as exp:
+                            raise proofmarshal.DeserializationError('colorproof %s refers to unknown hash %s' % \
+                                    (bitcoin.core.b2x(record.hash), bitcoin.core.b2x(exp.args[0])))
+
+                        colorproof = record.to_colorproof(colordef, prevout_proofs, trusted=False)
+                        if colorproof.hash != record.hash:
+                            raise proofmarshal.DeserializationError('colorproof hash mismatch: %s != %s' % \
+                                    (bitcoin.core.b2x(colorproof.hash), bitcoin.core.b2x(record.hash)))
+                        colorproofs[colorproof.hash] = colorproof
+                        colorproofs.move_to_end(colorproof.hash)
+                        if len(colorproofs) > cls.PROOF_WINDOW:
+                            colorproofs.popitem(last=False)
+
+                    elif entry_type == cls.ENTRY_COLORED_OUTPOINT:
+                        outpoint = ctx.read_obj('outpoint', smartcolors.core.COutPointSerializer)
+                        colordef_hash = ctx.read_bytes('colordef_hash', 32)
+                        colorproof_hash = ctx.read_bytes('colorproof_hash', 32)
+                        try:
+                            colordb._add_colorproof(outpoint, colordefs[colordef_hash], colorproofs[colorproof_hash])
+                        except KeyError as exp:
+                            raise proofmarshal.DeserializationError('colored outpoint refers to unknown hash %s' % \
+                                    bitcoin.core.b2x(exp.args[0]))
+
+                    elif entry_type == cls.ENTRY_INDEX:
+                        index_name = ctx.read_bytes('index_name').decode('utf8', 'replace')
+                        key = ctx.read_bytes('key')
+                        value = ctx.read_bytes('value')
+                        if index_name not in colordb.INDEX_NAMES:
+                            raise proofmarshal.DeserializationError('unknown index %r' % index_name)
+                        replace_indexes()
+                        getattr(colordb, index_name)[key] = value
+
+                    else:
+                        raise proofmarshal.DeserializationError('unknown snapshot entry type %d' % entry_type)
+
+        expected_checksum = hashing_fd.hasher.digest()
+        if fd.read(32) != expected_checksum:
+            raise proofmarshal.DeserializationError('snapshot checksum mismatch')
+
+        if colordb.state_hash != expected_state_hash:
+            raise proofmarshal.DeserializationError('state hash mismatch: %s != %s' % \
+                    (bitcoin.core.b2x(colordb.state_hash), bitcoin.core.b2x(expected_state_hash)))
+
+        return colordb
@@ -0,0 +1,88 @@
+# Copyright (C) 2014 Peter Todd <pete@petertodd.org>
+#
+# This file is part of python-smartcolors.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of python-smartcolors, including this file, may be copied, modified,
+# propagated, or distributed except according to the terms contained in the
+# LICENSE file.
+
+import unittest
+
+from bitcoin.core import *
+from smartcolors.core import *
+from smartcolors.core.bundle import *
+
+class Test_ColorProofBundle(unittest.TestCase):
+    def make_proofs(self):
+        """Make a genesis proof and two transferred proofs spending it"""
+        outpoint = COutPoint(b'\xaa'*32, n=0)
+        cdef = ColorDef(genesis_outpoints={outpoint:42})
+        genesis_cproof = GenesisOutPointColorProof(cdef, outpoint)
+
+        tx = CTransaction([CTxIn(genesis_cproof.outpoint,
+                                 nSequence=(0xFE | (0xFFFFFF00 & (0x00030000 ^ cdef.nSequence_pad(genesis_cproof.outpoint)))))],
+                          [CTxOut(21 << 1), CTxOut(21 << 1)])
+        return [TransferredColorProof(cdef, COutPoint(tx.GetHash(), i), tx,
+                                      {genesis_cproof.outpoint:genesis_cproof})
+                for i in range(2)]
+
+    def test_shared_history_stored_once(self):
+        # Proofs that were deserialized independently share nothing
+        cproofs = [TransferredColorProof.deserialize(cproof.serialize()) for cproof in self.make_proofs()]
+        self.assertIsNot(cproofs[0].tx, cproofs[1].tx)
+        self.assertIsNot(cproofs[0].colordef, cproofs[1].colordef)
+
+        bundle = ColorProofBundle(cproofs)
+        self.assertEqual(len(bundle), 2)
+        self.assertEqual(len(bundle.proofs_by_hash), 3)
+        self.assertEqual(len(bundle.colordefs), 1)
+        self.assertEqual(len(bundle.txs), 1)
+
+        cproof0, cproof1 = sorted(bundle, key=lambda cproof: cproof.n)
+        self.assertEqual(cproof0, cproofs[0])
+        self.assertEqual(cproof1, cproofs[1])
+        self.assertIs(cproof0.tx, cproof1.tx)
+        self.assertIs(cproof0.colordef, cproof1.colordef)
+
+        genesis_outpoint = COutPoint(b'\xaa'*32, n=0)
+        self.assertIs(cproof0.prevout_proofs[genesis_outpoint],
+                      cproof1.prevout_proofs[genesis_outpoint])
+        self.assertIs(cproof0.prevout_proofs[genesis_outpoint].colordef, cproof0.colordef)
+
+        # Adding an equal proof again returns the existing one
+        self.assertIs(bundle.add(cproofs[0]), cproof0)
+
+    def test_validate(self):
+        cproofs = self.make_proofs()
+        bundle = ColorProofBundle(cproofs)
+
+        # The genesis proof is only validated once
+        steps = bundle.validate()
+        self.assertLess(steps, sum(cproof.validate() for cproof in cproofs))
+
+        with self.assertRaises(ColorProofBudgetExceededError):
+            bundle.validate(budget=steps-1)
+
+    def test_long_history(self):
+        """Each kernel in a long history is applied once, without recursing"""
+        import unittest.mock
+
+        outpoint = COutPoint(b'\xaa'*32, n=0)
+        cdef = ColorDef(genesis_outpoints={outpoint:42})
+        cproof = GenesisOutPointColorProof(cdef, outpoint)
+        for i in range(2000):
+            tx = CTransaction([CTxIn(cproof.outpoint,
+                                     nSequence=(0xFE | (0xFFFFFF00 & (0xFFFF0000 ^ cdef.nSequence_pad(cproof.outpoint)))))],
+                              [CTxOut(42 << 1)])
+            cproof = TransferredColorProof(cdef, COutPoint(tx.GetHash(), 0), tx, {cproof.outpoint:cproof})
+
+        with unittest.mock.patch.object(ColorDef, 'apply_kernel', autospec=True,
+                                        side_effect=ColorDef.apply_kernel) as apply_kernel:
+            bundle = ColorProofBundle([cproof])
+            self.assertEqual(apply_kernel.call_count, 2000)
+
+        self.assertEqual(len(bundle.proofs_by_hash), 2001)
+        self.assertEqual(bundle.add(cproof).qty, 42)
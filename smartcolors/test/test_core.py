@@ -499,3 +499,139 @@ class Test_TransferredColorProof(unittest.TestCase):
 
         # FIXME: need invalid tests too
 
+
+    def test_pickle(self):
+        """Pickling carries the cached hash and qty"""
+        import pickle
+
+        outpoint = COutPoint(b'\xaa'*32, n=0)
+        cdef = ColorDef(genesis_outpoints={outpoint:42})
+        genesis_cproof = GenesisOutPointColorProof(cdef, outpoint)
+
+        tx = CTransaction([CTxIn(genesis_cproof.outpoint,
+                                 nSequence=(0xFE | (0xFFFFFF00 & (0xFFFF0000 ^ cdef.nSequence_pad(genesis_cproof.outpoint)))))],
+                          [CTxOut(42 << 1)])
+        tx_cproof = TransferredColorProof(cdef, COutPoint(tx.GetHash(), 0), tx,
+                                          {genesis_cproof.outpoint:genesis_cproof})
+        tx_cproof.validate()
+
+        tx_cproof2 = pickle.loads(pickle.dumps(tx_cproof))
+        self.assertIsInstance(tx_cproof2, TransferredColorProof)
+        self.assertEqual(tx_cproof2._cached_hash, tx_cproof.hash)
+        self.assertEqual(tx_cproof2._cached_qty, 42)
+        self.assertEqual(tx_cproof2.calc_hash(), tx_cproof.hash)
+        tx_cproof2.validate()
+
+        cdef2 = pickle.loads(pickle.dumps(cdef))
+        self.assertEqual(cdef2, cdef)
+        self.assertEqual(dict(cdef2.genesis_outpoints), {outpoint:42})
+
+    def test_validation_cost(self):
+        """Validation cost estimation and metering"""
+        outpoint = COutPoint(b'\xaa'*32, n=0)
+        cdef = ColorDef(genesis_outpoints={outpoint:42})
+        genesis_cproof = GenesisOutPointColorProof(cdef, outpoint)
+
+        # Two outputs, both colored, sharing the same genesis proof
+        tx = CTransaction([CTxIn(genesis_cproof.outpoint,
+                                 nSequence=(0xFE | (0xFFFFFF00 & (0x00030000 ^ cdef.nSequence_pad(genesis_cproof.outpoint)))))],
+                          [CTxOut(21 << 1), CTxOut(21 << 1)])
+        tx_cproofs = [TransferredColorProof(cdef, COutPoint(tx.GetHash(), i), tx,
+                                            {genesis_cproof.outpoint:genesis_cproof})
+                      for i in range(2)]
+
+        # Spend both outputs, merging the color back together
+        tx2 = CTransaction([CTxIn(tx_cproof.outpoint,
+                                  nSequence=(0xFE | (0xFFFFFF00 & (0x00010000 ^ cdef.nSequence_pad(tx_cproof.outpoint)))))
+                            for tx_cproof in tx_cproofs],
+                           [CTxOut(42 << 1)])
+        tx2_cproof = TransferredColorProof(cdef, COutPoint(tx2.GetHash(), 0), tx2,
+                                           {tx_cproof.outpoint:tx_cproof for tx_cproof in tx_cproofs})
+        self.assertEqual(tx2_cproof.qty, 42)
+
+        cost = tx2_cproof.calc_validation_cost()
+        self.assertEqual(cost.proofs, 4) # the genesis proof is only counted once
+        self.assertEqual(cost.txs, 2)
+        self.assertEqual(cost.kernel_applications, 3)
+        self.assertGreater(cost.hash_ops, cost.proofs)
+        self.assertGreater(cost.serialized_size, 0)
+
+        self.assertEqual(tx2_cproof.validate(), cost.steps)
+        self.assertEqual(tx2_cproof.validate(budget=cost.steps), cost.steps)
+        with self.assertRaises(ColorProofBudgetExceededError):
+            tx2_cproof.validate(budget=cost.steps-1)
+
+    def test_validation_cost_deserialized(self):
+        """Budget is checked before any kernel is applied to a deserialized proof"""
+        import unittest.mock
+
+        outpoint = COutPoint(b'\xaa'*32, n=0)
+        cdef = ColorDef(genesis_outpoints={outpoint:42})
+        cproof = GenesisOutPointColorProof(cdef, outpoint)
+        for i in range(50):
+            tx = CTransaction([CTxIn(cproof.outpoint,
+                                     nSequence=(0xFE | (0xFFFFFF00 & (0xFFFF0000 ^ cdef.nSequence_pad(cproof.outpoint)))))],
+                              [CTxOut(42 << 1)])
+            cproof = TransferredColorProof(cdef, COutPoint(tx.GetHash(), 0), tx, {cproof.outpoint:cproof})
+
+        serialized_cproof = cproof.serialize()
+        expected_serialized_size = cproof.calc_validation_cost().serialized_size
+
+        with unittest.mock.patch.object(ColorDef, 'apply_kernel', autospec=True,
+                                        side_effect=ColorDef.apply_kernel) as apply_kernel:
+            cproof = ColorProof.deserialize(serialized_cproof)
+
+            cost = cproof.calc_validation_cost()
+            self.assertEqual(cost.kernel_applications, 50)
+            self.assertEqual(cost.serialized_size, expected_serialized_size)
+            self.assertEqual(apply_kernel.call_count, 0)
+
+            with self.assertRaises(ColorProofBudgetExceededError):
+                cproof.validate(budget=1)
+            self.assertEqual(apply_kernel.call_count, 0)
+
+            self.assertEqual(cproof.validate(), cost.steps)
+            self.assertEqual(apply_kernel.call_count, 50)
+            self.assertEqual(cproof.qty, 42)
+
+    def test_prune(self):
+        """Pruning irrelevant prevout proofs"""
+        outpoints = [COutPoint(b'\xaa'*32, n=i) for i in range(3)]
+        cdef = ColorDef(genesis_outpoints={outpoint:10 for outpoint in outpoints})
+        genesis_cproofs = [GenesisOutPointColorProof(cdef, outpoint) for outpoint in outpoints]
+
+        def make_txin(outpoint, colored_bitfield):
+            nSequence = (colored_bitfield << 16) ^ cdef.nSequence_pad(outpoint)
+            return CTxIn(outpoint, nSequence=(0xFE | (0xFFFFFF00 & nSequence)))
+
+        # vin[0] sends color to vout[1] only, vin[1] to vout[0] and vout[1],
+        # vin[2] to vout[2] only.
+        tx = CTransaction([make_txin(outpoints[0], 0b010),
+                           make_txin(outpoints[1], 0b011),
+                           make_txin(outpoints[2], 0b100)],
+                          [CTxOut(5 << 1), CTxOut(15 << 1), CTxOut(10 << 1)])
+        prevout_proofs = {cproof.outpoint:cproof for cproof in genesis_cproofs}
+
+        def T(n, expected_prevouts):
+            cproof = TransferredColorProof(cdef, COutPoint(tx.GetHash(), n), tx, prevout_proofs)
+            pruned_cproof = cproof.prune()
+
+            self.assertEqual(set(pruned_cproof.prevout_proofs.keys()),
+                             set(outpoints[i] for i in expected_prevouts))
+            self.assertEqual(pruned_cproof.qty, cproof.qty)
+            pruned_cproof.validate()
+
+            if len(expected_prevouts) < len(outpoints):
+                self.assertLess(len(pruned_cproof.serialize()), len(cproof.serialize()))
+                self.assertNotEqual(pruned_cproof.hash, cproof.hash)
+            else:
+                self.assertIs(pruned_cproof, cproof)
+
+        # vout[0] only gets color from vin[1]
+        T(0, [1])
+
+        # vout[1] gets color from vin[1], and vin[0] fills it first
+        T(1, [0, 1])
+
+        # vout[2] only gets color from vin[2]
+        T(2, [2])
@@ -9,16 +9,51 @@
 # propagated, or distributed except according to the terms contained in the
 # LICENSE file.
 
+import itertools
+import os
+import shutil
+import sqlite3
+import struct
+import subprocess
+import sys
+import tempfile
 import unittest
+import unittest.mock
 
 from bitcoin.core import *
 from smartcolors.core import *
 from smartcolors.core.db import *
+import smartcolors
+from smartcolors.db import (
+        ColorProofDbLockedError,
+        LogColorProofDb,
+        PersistentColorProofDb,
+        PersistentColorProofSet,
+        PersistentObjectCache,
+        SqliteColorProofDb
+)
 
 from smartcolors.test import test_data_path, load_test_vectors
 
-def run_proof_test(self, test_name):
-    colordb = ColorProofDb()
+def make_colordb_factory(self, colordb_class, **kwargs):
+    """Return a function opening a new colordb_class db each time it's called
+
+    Each db gets its own temporary directory, and is closed when the test
+    finishes.
+    """
+    tmpdir = tempfile.TemporaryDirectory()
+    self.addCleanup(tmpdir.cleanup)
+
+    paths = (os.path.join(tmpdir.name, str(n)) for n in itertools.count())
+    def make_colordb():
+        colordb = colordb_class(next(paths), **kwargs)
+        self.addCleanup(colordb.close)
+        return colordb
+    return make_colordb
+
+def run_proof_test(self, test_name, colordb=None):
+    if colordb is None:
+        colordb = ColorProofDb()
 
     def parse_str_outpoint(str_outpoint):
         """Parse txid:n into a COutPoint"""
@@ -105,6 +140,11 @@ def run_proof_test(self, test_name):
         self.assertEqual(expected_state_hash, b2x(actual_state_hash),
                 msg='%s: assert_state_hash(): mismatch' % test_name)
 
+        # The incrementally maintained state commitment must match one
+        # calculated from scratch.
+        self.assertEqual(b2x(colordb.state_hash), b2x(colordb.calc_state_commitment().digest()),
+                msg='%s: assert_state_hash(): state commitment mismatch' % test_name)
+
     @define_action
     def debug_outpoint_proofs(str_outpoint):
         """Drop into a debugger"""
@@ -144,3 +184,1341 @@ class Test_ColorProofDb(unittest.TestCase):
             if proof_test[0] == '.':
                 continue
             run_proof_test(self, 'colorproofdb/' + proof_test)
+
+def get_colored_outpoints_contents(colordb):
+    return {(outpoint, colordef.hash, colorproof.hash)
+                for outpoint, colorproofs_by_colordef in colordb.colored_outpoints.items()
+                    for colordef, colorproofs in colorproofs_by_colordef.items()
+                        for colorproof in colorproofs}
+
+def check_gc(self, colordb):
+    """Add superseded and spent proofs to colordb, and gc them"""
+    genesis_outpoint = COutPoint(b'\xaa'*32, n=0)
+    tx0 = CTransaction([CTxIn(COutPoint(b'\xbb'*32, n=0))], [CTxOut(1 << 1, CScript([1]))])
+    scriptPubKey_outpoint = COutPoint(tx0.GetHash(), 0)
+    colordef = ColorDef(genesis_outpoints={genesis_outpoint:42, scriptPubKey_outpoint:1},
+                        genesis_scriptPubKeys=[CScript([1])])
+
+    # scriptPubKey_outpoint is colored twice over
+    colordb.addcolordef(colordef)
+    scriptPubKey_proof = GenesisScriptPubKeyColorProof(colordef, scriptPubKey_outpoint, tx0)
+    colordb.addcolorproof(scriptPubKey_proof)
+
+    # genesis_outpoint is spent
+    tx = CTransaction([CTxIn(genesis_outpoint,
+                             nSequence=(0xFE | (0xFFFFFF00 & (0x00030000 ^ colordef.nSequence_pad(genesis_outpoint)))))],
+                      [CTxOut(21 << 1), CTxOut(21 << 1)])
+    colordb.addtx(tx)
+
+    contents = get_colored_outpoints_contents(colordb)
+    self.assertEqual(len(contents), 5)
+
+    self.assertEqual([colorproof for outpoint, colordef, colorproof in colordb.iter_superseded_colorproofs()],
+                     [scriptPubKey_proof])
+    self.assertEqual([outpoint for outpoint, colordef, colorproof in colordb.iter_spent_colorproofs()],
+                     [genesis_outpoint])
+
+    self.assertEqual(colordb.gc(), 1)
+    self.assertEqual(colordb.gc(), 0)
+    contents.remove((scriptPubKey_outpoint, colordef.hash, scriptPubKey_proof.hash))
+    self.assertEqual(get_colored_outpoints_contents(colordb), contents)
+    self.assertEqual(colordb.state_hash, colordb.calc_state_commitment().digest())
+
+    self.assertEqual(colordb.gc(spent=True), 1)
+    self.assertNotIn(genesis_outpoint, colordb.colored_outpoints)
+    self.assertEqual(len(get_colored_outpoints_contents(colordb)), 3)
+    self.assertEqual(colordb.state_hash, colordb.calc_state_commitment().digest())
+
+    # The proofs of the outputs of tx still include the spent proof
+    for colorproof in colordb.colored_outpoints[COutPoint(tx.GetHash(), 0)][colordef]:
+        self.assertIn(genesis_outpoint, colorproof.prevout_proofs)
+        self.assertEqual(colorproof.qty, 21)
+
+def check_spends(self, open_colordb):
+    """Record spends, then forget spent outpoints in utxo_only mode
+
+    open_colordb(utxo_only) must open the same db every time it's called.
+    """
+    genesis_outpoint = COutPoint(b'\xaa'*32, n=0)
+    colordef = ColorDef(genesis_outpoints={genesis_outpoint:42, COutPoint(b'\xbb'*32, n=1):2})
+
+    def make_tx(outpoint):
+        return CTransaction([CTxIn(outpoint,
+                                   nSequence=(0xFE | (0xFFFFFF00 & (0x00030000 ^ colordef.nSequence_pad(outpoint)))))],
+                            [CTxOut(21 << 1), CTxOut(21 << 1)])
+
+    colordb = open_colordb(utxo_only=False)
+    colordb.addcolordef(colordef)
+    tx1 = make_tx(genesis_outpoint)
+    colordb.addtx(tx1)
+    colordb.close()
+
+    # Spends are remembered
+    colordb = open_colordb(utxo_only=False)
+    self.assertTrue(colordb.is_spent(genesis_outpoint))
+    self.assertFalse(colordb.is_spent(COutPoint(tx1.GetHash(), 0)))
+    self.assertEqual(colordb.spent_outpoints[genesis_outpoint.serialize()], tx1.GetHash())
+    self.assertEqual(len(get_colored_outpoints_contents(colordb)), 4)
+    colordb.close()
+
+    # Spent outpoints are removed outright
+    colordb = open_colordb(utxo_only=True)
+    tx2 = make_tx(COutPoint(tx1.GetHash(), 0))
+    colordb.addtx(tx2)
+    self.assertNotIn(COutPoint(tx1.GetHash(), 0), colordb.colored_outpoints)
+    self.assertFalse(colordb.is_spent(COutPoint(tx1.GetHash(), 0)))
+    self.assertEqual(len(get_colored_outpoints_contents(colordb)), 4)
+    self.assertEqual(colordb.state_hash, colordb.calc_state_commitment().digest())
+
+    # ...but remain part of the history of the output of tx2
+    for colorproof in colordb.colored_outpoints[COutPoint(tx2.GetHash(), 0)][colordef]:
+        self.assertIn(COutPoint(tx1.GetHash(), 0), colorproof.prevout_proofs)
+        self.assertEqual(colorproof.qty, 21)
+
+    # Spends recorded earlier are forgotten along with the outpoint
+    self.assertEqual(colordb.gc(spent=True), 1)
+    self.assertNotIn(genesis_outpoint, colordb.colored_outpoints)
+    self.assertEqual(set(colordb.spent_outpoints.keys()), {ColorProofDb.SPENT_OUTPOINTS_COMPLETE_KEY})
+    colordb.close()
+
+def check_reindex_spent_outpoints(self, colordb):
+    """Spends are only inferred from the proofs until spent_outpoints is reindexed"""
+    genesis_outpoint = COutPoint(b'\xaa'*32, n=0)
+    colordef = ColorDef(genesis_outpoints={genesis_outpoint:42})
+
+    colordb.addcolordef(colordef)
+    tx = CTransaction([CTxIn(genesis_outpoint,
+                             nSequence=(0xFE | (0xFFFFFF00 & (0x00030000 ^ colordef.nSequence_pad(genesis_outpoint)))))],
+                      [CTxOut(21 << 1), CTxOut(21 << 1)])
+    colordb.addtx(tx)
+    self.assertTrue(colordb.spent_outpoints_complete)
+
+    def iter_inferred_spends():
+        raise AssertionError('proofs read')
+    with unittest.mock.patch.object(colordb, '_iter_inferred_spends', iter_inferred_spends):
+        self.assertEqual({outpoint for outpoint, colordef, colorproof in colordb.iter_spent_colorproofs()},
+                         {genesis_outpoint})
+
+    # Dbs from before spends were recorded
+    for key in list(colordb.spent_outpoints.keys()):
+        del colordb.spent_outpoints[key]
+    self.assertFalse(colordb.spent_outpoints_complete)
+    self.assertEqual({outpoint for outpoint, colordef, colorproof in colordb.iter_spent_colorproofs()},
+                     {genesis_outpoint})
+
+    colordb.reindex_spent_outpoints()
+    self.assertTrue(colordb.spent_outpoints_complete)
+    self.assertEqual(colordb.spent_outpoints[genesis_outpoint.serialize()], tx.GetHash())
+    with unittest.mock.patch.object(colordb, '_iter_inferred_spends', iter_inferred_spends):
+        self.assertEqual(colordb.gc(spent=True), 1)
+
+def check_addblock(self, colordb):
+    """Add a block whose txs spend each other's outputs"""
+    genesis_outpoint = COutPoint(b'\xaa'*32, n=0)
+    colordef = ColorDef(genesis_outpoints={genesis_outpoint:42},
+                        genesis_scriptPubKeys=[CScript([1])])
+
+    def make_tx(outpoint, scriptPubKey=CScript()):
+        return CTransaction([CTxIn(outpoint,
+                                   nSequence=(0xFE | (0xFFFFFF00 & (0x00030000 ^ colordef.nSequence_pad(outpoint)))))],
+                            [CTxOut(21 << 1, scriptPubKey), CTxOut(21 << 1)])
+
+    tx1 = make_tx(genesis_outpoint, CScript([1]))
+    tx2 = make_tx(COutPoint(tx1.GetHash(), 0))
+    tx3 = make_tx(COutPoint(tx2.GetHash(), 0))
+    block = CBlock(vtx=[tx1, tx2, tx3])
+
+    # Same result as adding the txs one by one
+    expected_colordb = ColorProofDb(utxo_only=colordb.utxo_only)
+    expected_colordb.addcolordef(colordef)
+    for tx in block.vtx:
+        expected_colordb.addtx(tx)
+
+    colordb.addcolordef(colordef)
+    colordb.addblock(block, 1000)
+    self.assertEqual(get_colored_outpoints_contents(colordb),
+                     get_colored_outpoints_contents(expected_colordb))
+    self.assertEqual(colordb.state_hash, expected_colordb.state_hash)
+    self.assertEqual(dict(colordb.spent_outpoints.items()), expected_colordb.spent_outpoints)
+
+    # Only outpoints created by the block have heights
+    self.assertEqual(colordb.get_height(COutPoint(tx3.GetHash(), 0)), 1000)
+    self.assertIsNone(colordb.get_height(COutPoint(tx3.GetHash(), 1)))
+    self.assertIsNone(colordb.get_height(genesis_outpoint))
+
+    # Heights are forgotten along with the outpoint
+    if not colordb.utxo_only:
+        self.assertEqual(colordb.get_height(COutPoint(tx1.GetHash(), 0)), 1000)
+        colordb.gc(spent=True)
+    self.assertIsNone(colordb.get_height(COutPoint(tx1.GetHash(), 0)))
+    self.assertEqual(colordb.get_height(COutPoint(tx3.GetHash(), 0)), 1000)
+
+def check_disconnect_block(self, colordb):
+    """Disconnect blocks, restoring the db to how it was before them"""
+    genesis_outpoint = COutPoint(b'\xaa'*32, n=0)
+    colordef = ColorDef(genesis_outpoints={genesis_outpoint:42},
+                        genesis_scriptPubKeys=[CScript([1])])
+
+    def make_tx(outpoint, scriptPubKey=CScript()):
+        return CTransaction([CTxIn(outpoint,
+                                   nSequence=(0xFE | (0xFFFFFF00 & (0x00030000 ^ colordef.nSequence_pad(outpoint)))))],
+                            [CTxOut(21 << 1, scriptPubKey), CTxOut(21 << 1)])
+
+    def get_state(colordb):
+        return (get_colored_outpoints_contents(colordb), colordb.state_hash,
+                {index_name:dict(getattr(colordb, index_name).items())
+                    for index_name in ('spent_outpoints', 'outpoint_heights', 'scriptPubKey_utxos')})
+
+    colordb.addcolordef(colordef)
+    state0 = get_state(colordb)
+
+    tx1 = make_tx(genesis_outpoint, CScript([1]))
+    block1 = CBlock(vtx=[tx1])
+    colordb.addblock(block1, 1)
+    state1 = get_state(colordb)
+    self.assertEqual(colordb.get_block_hash(1), block1.GetHash())
+
+    tx2 = make_tx(COutPoint(tx1.GetHash(), 0))
+    tx3 = make_tx(COutPoint(tx1.GetHash(), 1))
+    block2 = CBlock(hashPrevBlock=block1.GetHash(), vtx=[tx2, tx3])
+    colordb.addblock(block2, 2)
+    self.assertNotEqual(get_state(colordb), state1)
+
+    with self.assertRaises(ValueError):
+        colordb.addblock(block2, 2)
+    with self.assertRaises(ValueError):
+        colordb.disconnect_block(1)
+
+    self.assertEqual(colordb.disconnect_block(2), block2.GetHash())
+    self.assertEqual(get_state(colordb), state1)
+    self.assertIsNone(colordb.get_block_hash(2))
+
+    # A different block can take its place
+    block2b = CBlock(hashPrevBlock=block1.GetHash(), vtx=[tx3])
+    colordb.addblock(block2b, 2)
+    colordb.disconnect_block(2)
+
+    self.assertEqual(colordb.disconnect_block(1), block1.GetHash())
+    self.assertEqual(get_state(colordb), state0)
+    self.assertEqual(len(colordb.block_undo), 0)
+    self.assertEqual(colordb.state_hash, colordb.calc_state_commitment().digest())
+
+def check_balance(self, colordb):
+    """Colored UTXOs and balances by scriptPubKey"""
+    genesis_outpoint = COutPoint(b'\xaa'*32, n=0)
+    colordef = ColorDef(genesis_outpoints={genesis_outpoint:42})
+    scriptPubKey_a = CScript([1])
+    scriptPubKey_b = CScript([2])
+
+    def make_tx(outpoint, scriptPubKey0, scriptPubKey1):
+        return CTransaction([CTxIn(outpoint,
+                                   nSequence=(0xFE | (0xFFFFFF00 & (0x00030000 ^ colordef.nSequence_pad(outpoint)))))],
+                            [CTxOut(21 << 1, scriptPubKey0), CTxOut(21 << 1, scriptPubKey1)])
+
+    colordb.addcolordef(colordef)
+
+    # Genesis outpoints have no known scriptPubKey
+    self.assertEqual(colordb.get_balance(CScript()), {})
+
+    tx1 = make_tx(genesis_outpoint, scriptPubKey_a, scriptPubKey_b)
+    colordb.addtx(tx1)
+    self.assertEqual(colordb.get_balance(scriptPubKey_a), {colordef.hash:21})
+    self.assertEqual(colordb.get_colored_utxos(scriptPubKey_b),
+                     [(COutPoint(tx1.GetHash(), 1), colordef.hash, 21)])
+
+    # Spending moves the balance
+    tx2 = make_tx(COutPoint(tx1.GetHash(), 0), scriptPubKey_b, scriptPubKey_a)
+    colordb.addblock(CBlock(vtx=[tx2]), 1)
+    self.assertEqual(colordb.get_balance(scriptPubKey_a), {})
+    self.assertEqual(colordb.get_balance(scriptPubKey_b), {colordef.hash:42})
+    self.assertEqual(set(colordb.get_colored_utxos(scriptPubKey_b)),
+                     {(COutPoint(tx1.GetHash(), 1), colordef.hash, 21),
+                      (COutPoint(tx2.GetHash(), 0), colordef.hash, 21)})
+
+    # A scriptPubKey is one holder however many outpoints it holds
+    self.assertEqual(colordb.get_colordef_stats(colordef)['holders'], 1)
+
+    # ...and back again
+    colordb.disconnect_block(1)
+    self.assertEqual(colordb.get_balance(scriptPubKey_a), {colordef.hash:21})
+    self.assertEqual(colordb.get_balance(scriptPubKey_b), {colordef.hash:21})
+    self.assertEqual(colordb.get_colordef_stats(colordef)['holders'], 2)
+
+def check_colordef_stats(self, colordb):
+    """Per-colordef supply and holder statistics"""
+    genesis_outpoint = COutPoint(b'\xaa'*32, n=0)
+    colordef = ColorDef(genesis_outpoints={genesis_outpoint:42, COutPoint(b'\xbb'*32, n=1):2},
+                        genesis_scriptPubKeys=[CScript([3])])
+
+    def make_tx(outpoint, *txouts):
+        return CTransaction([CTxIn(outpoint,
+                                   nSequence=(0xFE | (0xFFFFFF00 & (0x00030000 ^ colordef.nSequence_pad(outpoint)))))],
+                            txouts)
+
+    def stats(issued, unspent, destroyed, holders):
+        return dict(issued=issued, unspent=unspent, destroyed=destroyed, holders=holders)
+
+    colordb.addcolordef(colordef)
+    self.assertEqual(colordb.get_colordef_stats(colordef), stats(44, 44, 0, 0))
+
+    tx1 = make_tx(genesis_outpoint, CTxOut(21 << 1, CScript([1])), CTxOut(21 << 1, CScript([2])))
+    colordb.addtx(tx1)
+    stats1 = colordb.get_colordef_stats(colordef)
+    self.assertEqual(stats1, stats(44, 44, 0, 2))
+
+    # Sending 21 to an output that can only hold 10 destroys the rest, and
+    # color sent to a genesis scriptPubKey is issued
+    tx2 = make_tx(COutPoint(tx1.GetHash(), 0), CTxOut(10 << 1, CScript([1])))
+    tx3 = make_tx(COutPoint(b'\xcc'*32, n=0), CTxOut(5 << 1, CScript([3])))
+    colordb.addblock(CBlock(vtx=[tx2, tx3]), 1)
+    self.assertEqual(colordb.get_colordef_stats(colordef), stats(49, 38, 11, 3))
+
+    colordb.disconnect_block(1)
+    self.assertEqual(colordb.get_colordef_stats(colordef), stats1)
+
+    # Unknown colordefs have no stats
+    self.assertIsNone(colordb.get_colordef_stats(ColorDef(genesis_outpoints={genesis_outpoint:1})))
+
+def check_best_colorproofs(self, colordb):
+    """Best proof index"""
+    genesis_outpoint = COutPoint(b'\xaa'*32, n=0)
+    colordef = ColorDef(genesis_outpoints={genesis_outpoint:42},
+                        genesis_scriptPubKeys=[CScript([3])])
+
+    def make_tx(outpoint, *txouts):
+        return CTransaction([CTxIn(outpoint,
+                                   nSequence=(0xFE | (0xFFFFFF00 & (0x00030000 ^ colordef.nSequence_pad(outpoint)))))],
+                            txouts)
+
+    colordb.addcolordef(colordef)
+    self.assertTrue(colordb.best_colorproofs_complete)
+
+    # Sending color to a genesis scriptPubKey proves the output is colored
+    # two different ways.
+    tx1 = make_tx(genesis_outpoint, CTxOut(21 << 1, CScript([3])), CTxOut(21 << 1, CScript([1])))
+    colordb.addtx(tx1)
+    outpoint = COutPoint(tx1.GetHash(), 0)
+    self.assertEqual(len(colordb.colored_outpoints[outpoint][colordef]), 2)
+
+    best_colorproofs = colordb.get_best_colorproofs(outpoint)
+    self.assertEqual(set(best_colorproofs), {colordef})
+    self.assertIsInstance(best_colorproofs[colordef], GenesisScriptPubKeyColorProof)
+    self.assertEqual(best_colorproofs[colordef].qty, 21)
+    self.assertEqual(colordb.get_best_colorproofs(COutPoint(b'\xbb'*32, n=0)), {})
+
+    # Superseded proofs aren't the best, so removing them changes nothing
+    colordb.gc(superseded=True)
+    self.assertEqual(colordb.get_best_colorproofs(outpoint), best_colorproofs)
+
+    tx2 = make_tx(outpoint, CTxOut(21 << 1, CScript([1])))
+    colordb.addtx(tx2)
+    self.assertEqual(colordb.get_best_colorproofs(COutPoint(tx2.GetHash(), 0))[colordef].qty, 21)
+
+    # Dbs from before the index existed fall back to searching all proofs
+    expected = {outpoint:colordb.get_best_colorproofs(outpoint) for outpoint in colordb.colored_outpoints}
+    for key in list(colordb.best_colorproofs.keys()):
+        del colordb.best_colorproofs[key]
+    self.assertFalse(colordb.best_colorproofs_complete)
+    self.assertEqual({outpoint:colordb.get_best_colorproofs(outpoint) for outpoint in colordb.colored_outpoints},
+                     expected)
+
+    colordb.reindex_best_colorproofs()
+    self.assertTrue(colordb.best_colorproofs_complete)
+    self.assertEqual({outpoint:colordb.get_best_colorproofs(outpoint) for outpoint in colordb.colored_outpoints},
+                     expected)
+
+def check_trace_colordef(self, make_colordb):
+    """Tracing a colordef added after its spends were scanned"""
+    genesis_outpoint = COutPoint(b'\xaa'*32, n=0)
+    colordef = ColorDef(genesis_outpoints={genesis_outpoint:42},
+                        genesis_scriptPubKeys=[CScript([3])])
+
+    def make_tx(outpoints, *txouts):
+        return CTransaction([CTxIn(outpoint,
+                                   nSequence=(0xFE | (0xFFFFFF00 & (0x00030000 ^ colordef.nSequence_pad(outpoint)))))
+                                for outpoint in outpoints],
+                            txouts)
+
+    tx1 = make_tx([genesis_outpoint], CTxOut(21 << 1, CScript([1])), CTxOut(21 << 1, CScript([3])))
+    block1 = CBlock(vtx=[tx1])
+
+    # tx3 is reached through tx1 before the tx2 output it also spends
+    tx2 = make_tx([COutPoint(tx1.GetHash(), 0)], CTxOut(21 << 1, CScript([2])))
+    tx3 = make_tx([COutPoint(tx2.GetHash(), 0), COutPoint(tx1.GetHash(), 1)], CTxOut(42 << 1, CScript([4])))
+    unrelated_tx = make_tx([COutPoint(b'\xcc'*32, n=0)], CTxOut(1 << 1, CScript([1])))
+    block2 = CBlock(hashPrevBlock=block1.GetHash(), vtx=[unrelated_tx, tx2, tx3])
+
+    def get_state(colordb):
+        return (get_colored_outpoints_contents(colordb), colordb.state_hash,
+                colordb.get_colordef_stats(colordef),
+                {index_name:dict(getattr(colordb, index_name).items())
+                    for index_name in ('spent_outpoints', 'outpoint_heights', 'scriptPubKey_utxos')})
+
+    expected_colordb = make_colordb()
+    expected_colordb.addcolordef(colordef)
+    expected_colordb.addblock(block1, 1)
+    expected_colordb.addblock(block2, 2)
+
+    colordb = make_colordb()
+    colordb.addblock(block1, 1)
+    colordb.addblock(block2, 2)
+    self.assertEqual(colordb.get_spend(COutPoint(tx1.GetHash(), 1)), (tx3.GetHash(), 2, 2))
+    self.assertIsNone(colordb.get_spend(COutPoint(tx3.GetHash(), 0)))
+
+    # Spends are undone with one entry per block, not one per input
+    block_undo = colordb._deserialize_block_undo(colordb.block_undo[block2.GetHash()])
+    self.assertEqual([entry for entry in block_undo if entry[0] == ColorProofDb.UNDO_INDEX and entry[1] == 'spends'], [])
+    self.assertEqual(sum(1 for entry in block_undo if entry[0] == ColorProofDb.UNDO_SPENDS), 1)
+
+    txs = {tx.GetHash():tx for tx in block1.vtx + block2.vtx}
+    def get_tx(txid, height, index):
+        self.assertNotEqual(txid, unrelated_tx.GetHash())
+        return txs[txid]
+
+    # The tracer's proofs are added as-is, without applying the kernel again,
+    # and each block's undo data is rewritten once.
+    with unittest.mock.patch.object(ColorDef, 'apply_kernel', autospec=True,
+                                    side_effect=ColorDef.apply_kernel) as apply_kernel, \
+         unittest.mock.patch.object(colordb, '_serialize_block_undo',
+                                    side_effect=colordb._serialize_block_undo) as serialize_block_undo:
+        stats = colordb.trace_colordef(colordef, get_tx)
+    self.assertEqual(stats.txs, 3)
+    self.assertEqual(apply_kernel.call_count, stats.kernel_applications)
+    self.assertEqual(serialize_block_undo.call_count, 2)
+    self.assertEqual(get_state(colordb), get_state(expected_colordb))
+    self.assertEqual(colordb.get_balance(CScript([4])), {colordef.hash:42})
+
+    # The traced changes are undone along with the blocks they were in
+    colordb.disconnect_block(2)
+    expected_colordb.disconnect_block(2)
+    self.assertEqual(get_state(colordb), get_state(expected_colordb))
+    self.assertIsNone(colordb.get_spend(COutPoint(tx1.GetHash(), 1)))
+    self.assertEqual(colordb.get_spend(genesis_outpoint), (tx1.GetHash(), 1, 0))
+
+def check_diff_state(self, make_colordb):
+    """Localize differences between two dbs"""
+    genesis_outpoints = {COutPoint(lx('%064x' % i), 0):1 for i in range(100)}
+    colordef = ColorDef(genesis_outpoints=genesis_outpoints)
+
+    db1 = make_colordb()
+    db1.addcolordef(colordef)
+
+    db2 = make_colordb()
+    db2.addcolordef(colordef)
+    self.assertEqual(db1.state_hash, db2.state_hash)
+    self.assertEqual(db1.diff_state(db2), (set(), set()))
+
+    # Add a scriptPubKey proof to db2 only
+    tx = CTransaction([CTxIn(COutPoint(b'\xff'*32, 0))], [CTxOut(1 << 1)])
+    colordef2 = ColorDef(genesis_scriptPubKeys=[CScript()])
+    colorproof = GenesisScriptPubKeyColorProof(colordef2, COutPoint(tx.GetHash(), 0), tx)
+    db2.addcolorproof(colorproof)
+    self.assertNotEqual(db1.state_hash, db2.state_hash)
+
+    # Only a few of the buckets differ
+    self.assertLessEqual(len(db1.state_commitment.diff(db2.state_commitment)), 3)
+
+    # Only the elements of those buckets are read
+    def iter_state_elems():
+        raise AssertionError('whole db read')
+    with unittest.mock.patch.object(db1, 'iter_state_elems', iter_state_elems), \
+         unittest.mock.patch.object(db2, 'iter_state_elems', iter_state_elems):
+        only_in_db1, only_in_db2 = db1.diff_state(db2)
+    self.assertEqual(only_in_db1, set())
+    self.assertEqual(len(only_in_db2), 3) # colordef, scriptPubKey, and proof
+    self.assertEqual(set(elem[0] for elem in only_in_db2),
+                     {ColorProofDb.STATE_ELEM_COLORDEF,
+                      ColorProofDb.STATE_ELEM_GENESIS_SCRIPTPUBKEY,
+                      ColorProofDb.STATE_ELEM_COLORPROOF})
+
+    # Removed proofs are removed from the index too
+    db1.addcolordef(colordef2)
+    db1.addcolorproof(colorproof)
+    db1._remove_colorproof(colorproof.outpoint, colordef2, colorproof)
+    only_in_db1, only_in_db2 = db1.diff_state(db2)
+    self.assertEqual(only_in_db1, set())
+    self.assertEqual(set(elem[0] for elem in only_in_db2), {ColorProofDb.STATE_ELEM_COLORPROOF})
+
+    # Dbs from before the index existed fall back to reading every element
+    for key in list(db2.state_elems.keys()):
+        del db2.state_elems[key]
+    self.assertFalse(db2.state_elems_complete)
+    self.assertEqual(db1.diff_state(db2), (only_in_db1, only_in_db2))
+
+    # ...and don't maintain the index until it's rebuilt
+    db2._remove_colorproof(colorproof.outpoint, colordef2, colorproof)
+    db2.addcolorproof(colorproof)
+    self.assertEqual(len(db2.state_elems), 0)
+
+    db2.reindex_state_elems()
+    self.assertTrue(db2.state_elems_complete)
+    with unittest.mock.patch.object(db2, 'iter_state_elems', iter_state_elems):
+        self.assertEqual(db1.diff_state(db2), (only_in_db1, only_in_db2))
+
+class Test_ColorProofDb_gc(unittest.TestCase):
+    def test_gc(self):
+        """Garbage collection of superseded and spent proofs"""
+        check_gc(self, ColorProofDb())
+
+    def test_addblock(self):
+        """Adding whole blocks"""
+        check_addblock(self, ColorProofDb())
+
+    def test_addblock_utxo_only(self):
+        """Outputs created and spent within a block are never stored"""
+        colordb = ColorProofDb(utxo_only=True)
+        check_addblock(self, colordb)
+        self.assertEqual(colordb.spent_outpoints, {ColorProofDb.SPENT_OUTPOINTS_COMPLETE_KEY:b''})
+
+    def test_balance(self):
+        """Colored UTXOs by scriptPubKey"""
+        check_balance(self, ColorProofDb())
+        check_balance(self, ColorProofDb(utxo_only=True))
+
+    def test_best_colorproofs(self):
+        """Best proof index"""
+        check_best_colorproofs(self, ColorProofDb())
+
+    def test_colordef_stats(self):
+        """Per-colordef statistics"""
+        check_colordef_stats(self, ColorProofDb())
+        check_colordef_stats(self, ColorProofDb(utxo_only=True))
+
+    def test_trace_colordef(self):
+        """Tracing colordefs through the spends index"""
+        check_trace_colordef(self, lambda: ColorProofDb(index_spends=True))
+        check_trace_colordef(self, lambda: ColorProofDb(index_spends=True, utxo_only=True))
+
+    def test_disconnect_block(self):
+        """Undoing blocks"""
+        check_disconnect_block(self, ColorProofDb())
+
+        # Removed proofs are restored
+        check_disconnect_block(self, ColorProofDb(utxo_only=True))
+
+    def test_max_reorg_depth(self):
+        """Undo data for old blocks is discarded"""
+        colordb = ColorProofDb()
+        colordb.MAX_REORG_DEPTH = 2
+        for height in range(5):
+            colordb.addblock(CBlock(nNonce=height), height)
+
+        self.assertEqual(set(colordb.block_hashes.keys()), {struct.pack('<I', 3), struct.pack('<I', 4)})
+        self.assertEqual(len(colordb.block_undo), 2)
+
+    def test_spends(self):
+        """Spend tracking and utxo_only mode"""
+        colordb = ColorProofDb()
+        def open_colordb(utxo_only):
+            colordb.utxo_only = utxo_only
+            return colordb
+        check_spends(self, open_colordb)
+
+    def test_reindex_spent_outpoints(self):
+        """Spent outpoint index"""
+        check_reindex_spent_outpoints(self, ColorProofDb())
+
+class Test_ColorProofDb_state(unittest.TestCase):
+    def test_diff_state(self):
+        """Localize differences between two dbs"""
+        check_diff_state(self, lambda: ColorProofDb())
+
+class Test_PersistentColorProofDb(unittest.TestCase):
+    def test(self):
+        """Data-driven tests"""
+        for proof_test in sorted(os.listdir(test_data_path('colorproofdb/'))):
+            if proof_test[0] == '.':
+                continue
+            with tempfile.TemporaryDirectory() as tmpdir:
+                run_proof_test(self, 'colorproofdb/' + proof_test,
+                               PersistentColorProofDb(tmpdir + '/colordb'))
+
+    def test_state_commitment_persisted(self):
+        """State commitment is saved with the db"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            colordb = PersistentColorProofDb(tmpdir)
+            empty_state_hash = colordb.state_hash
+
+            colordb.addcolordef(ColorDef(genesis_outpoints={COutPoint():1}))
+            self.assertNotEqual(colordb.state_hash, empty_state_hash)
+
+            colordb2 = PersistentColorProofDb(tmpdir)
+            self.assertEqual(colordb2.state_hash, colordb.state_hash)
+
+            # Dbs without a saved state commitment have it recalculated
+            shutil.rmtree(os.path.join(tmpdir, 'state'))
+            colordb3 = PersistentColorProofDb(tmpdir)
+            self.assertEqual(colordb3.state_hash, colordb.state_hash)
+
+    def test_migrate_layout(self):
+        """Migrating between directory layouts"""
+        def get_contents(colordb):
+            return ({(outpoint, colordef.hash, colorproof.hash)
+                        for outpoint, colorproofs_by_colordef in colordb.colored_outpoints.items()
+                            for colordef, colorproofs in colorproofs_by_colordef.items()
+                                for colorproof in colorproofs},
+                    {(outpoint, colordef.hash)
+                        for outpoint, colordefs in colordb.genesis_outpoints.items()
+                            for colordef in colordefs},
+                    {(scriptPubKey, colordef.hash)
+                        for scriptPubKey, colordefs in colordb.genesis_scriptPubKeys.items()
+                            for colordef in colordefs})
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            # Existing dbs without a layout file have no fanout
+            colordb = PersistentColorProofDb(tmpdir)
+            self.assertEqual(colordb.fanout, 0)
+
+            colordb.addcolordef(ColorDef(genesis_outpoints={COutPoint():1, COutPoint(n=1):2},
+                                         genesis_scriptPubKeys={CScript([1])}))
+            expected_contents = get_contents(colordb)
+            expected_state_hash = colordb.state_hash
+            self.assertIn('0000000000000000000000000000000000000000000000000000000000000000:1',
+                          os.listdir(os.path.join(tmpdir, 'colored_outpoints')))
+
+            colordb.migrate_layout(2)
+            self.assertEqual(colordb.fanout, 2)
+            self.assertEqual(get_contents(colordb), expected_contents)
+            self.assertTrue(all(len(dirname) == 2 for dirname in os.listdir(os.path.join(tmpdir, 'colored_outpoints'))))
+
+            colordb2 = PersistentColorProofDb(tmpdir)
+            self.assertEqual(colordb2.fanout, 2)
+            self.assertEqual(get_contents(colordb2), expected_contents)
+            self.assertEqual(colordb2.state_hash, expected_state_hash)
+
+            # Interrupted after the first dict was migrated back
+            colordb2.genesis_outpoints.migrate(1)
+            colordb2._save_layout({'fanout': 2, 'migrating_to': 1, 'migrated': ['genesis_outpoints']})
+
+            colordb3 = PersistentColorProofDb(tmpdir)
+            self.assertEqual(colordb3.fanout, 1)
+            self.assertEqual(get_contents(colordb3), expected_contents)
+
+    def test_new_db_fanout(self):
+        """New dbs use the default fanout"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            colordb = PersistentColorProofDb(tmpdir + '/colordb')
+            self.assertEqual(colordb.fanout, PersistentColorProofDb.DEFAULT_FANOUT)
+            self.assertEqual(PersistentColorProofDb(tmpdir + '/colordb').fanout,
+                             PersistentColorProofDb.DEFAULT_FANOUT)
+
+    def test_batch(self):
+        """Batched writes"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            colordb = PersistentColorProofDb(tmpdir + '/colordb')
+            empty_state_hash = colordb.state_hash
+
+            colordef = ColorDef(genesis_outpoints={COutPoint(n=1):1})
+            with colordb.batch():
+                colordb.addcolordef(colordef)
+
+                # Visible within the batch, but not written yet
+                self.assertIn(colordef, colordb.colordefs)
+                self.assertEqual(list(colordb.colored_outpoints), [COutPoint(n=1)])
+                self.assertEqual([proof.qty for proof in colordb.colored_outpoints[COutPoint(n=1)][colordef]], [1])
+                self.assertFalse(os.path.exists(os.path.join(tmpdir, 'colordb', 'colordefs')))
+
+            expected_state_hash = colordb.state_hash
+            colordb2 = PersistentColorProofDb(tmpdir + '/colordb')
+            self.assertIn(colordef, colordb2.colordefs)
+            self.assertEqual(list(colordb2.colored_outpoints), [COutPoint(n=1)])
+            self.assertEqual(colordb2.state_hash, expected_state_hash)
+
+            # Aborted batches are discarded
+            class Abort(Exception):
+                pass
+            colordef2 = ColorDef(genesis_outpoints={COutPoint(n=2):2})
+            with self.assertRaises(Abort):
+                with colordb.batch():
+                    colordb.addcolordef(colordef2)
+                    raise Abort
+            self.assertNotIn(colordef2, colordb.colordefs)
+            self.assertEqual(colordb.state_hash, expected_state_hash)
+
+    def test_batch_fsync(self):
+        """Commits are synced a fixed number of times, however many files they write"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for fsync, expected_syncs, expected_fsyncs in ((True, 2, 2), (False, 0, 0)):
+                colordb = PersistentColorProofDb(tmpdir + '/colordb-%r' % fsync, fsync=fsync)
+                self.addCleanup(colordb.close)
+
+                colordef = ColorDef(genesis_outpoints={COutPoint(n=i):i for i in range(1, 11)})
+                with unittest.mock.patch('os.sync') as sync, \
+                     unittest.mock.patch('os.fsync') as fsync_:
+                    colordb.addcolordef(colordef)
+
+                # Once before publishing the journal and once after applying
+                # it; only the journal and its directory are fsynced.
+                self.assertEqual(sync.call_count, expected_syncs)
+                self.assertEqual(fsync_.call_count, expected_fsyncs)
+                self.assertEqual(len(list(colordb.colored_outpoints)), 10)
+
+    def test_batch_recovery(self):
+        """Interrupted batch commits are completed on open"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            colordb = PersistentColorProofDb(tmpdir + '/colordb', fsync=False)
+
+            def crash(journal):
+                raise KeyboardInterrupt
+            colordb.write_buffer._apply_journal = crash
+
+            colordef = ColorDef(genesis_outpoints={COutPoint(n=1):1})
+            with self.assertRaises(KeyboardInterrupt):
+                with colordb.batch():
+                    colordb.addcolordef(colordef)
+
+            colordb2 = PersistentColorProofDb(tmpdir + '/colordb')
+            self.assertIn(colordef, colordb2.colordefs)
+            self.assertEqual(list(colordb2.colored_outpoints), [COutPoint(n=1)])
+            self.assertEqual(colordb2.state_hash, colordb2.calc_state_commitment().digest())
+
+    def test_cache(self):
+        """Object and missing path caching"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            colordb = PersistentColorProofDb(tmpdir + '/colordb')
+
+            self.assertNotIn(COutPoint(n=1), colordb.colored_outpoints)
+            self.assertNotIn(COutPoint(n=1), colordb.colored_outpoints)
+            self.assertEqual(colordb.cache.missing_path_hits, 1)
+
+            # Adding the outpoint invalidates the cached missing path
+            colordef = ColorDef(genesis_outpoints={COutPoint(n=1):1})
+            colordb.addcolordef(colordef)
+            self.assertIn(COutPoint(n=1), colordb.colored_outpoints)
+
+            # Deserialized objects are reused
+            proofs1 = list(colordb.colored_outpoints[COutPoint(n=1)][colordef])
+            proofs2 = list(colordb.colored_outpoints[COutPoint(n=1)][colordef])
+            self.assertEqual(len(proofs1), 1)
+            self.assertIs(proofs1[0], proofs2[0])
+            self.assertIs(next(iter(colordb.colored_outpoints[COutPoint(n=1)])), colordef)
+            self.assertGreater(colordb.cache.hit_ratio, 0)
+
+            # Objects are evicted in LRU order
+            cache = PersistentObjectCache(max_objs=2)
+            cache.put(b'a', 1)
+            cache.put(b'b', 2)
+            cache.get(b'a')
+            cache.put(b'c', 3)
+            self.assertEqual(cache.get(b'b'), None)
+            self.assertEqual(cache.get(b'a'), 1)
+
+    def test_object_store(self):
+        """Proofs are stored once, in the object store"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            colordb = PersistentColorProofDb(tmpdir + '/colordb')
+            run_proof_test(self, 'colorproofdb/03-single-genesis-txout-colordef.json', colordb)
+
+            colorproofs = set()
+            for outpoint, colorproofs_by_colordef in colordb.colored_outpoints.items():
+                for colordef, colorproof_set in colorproofs_by_colordef.items():
+                    for colorproof in colorproof_set:
+                        colorproofs.add(colorproof)
+
+                        # Set elements are links to the stored object
+                        elem_path = os.path.join(colordb.colored_outpoints[outpoint][colordef].root_dir_path,
+                                                 b2x(colorproof.hash) + '.scproof')
+                        self.assertTrue(os.path.samefile(elem_path, colordb.object_store._get_abspath(colorproof.hash)))
+            self.assertTrue(any(isinstance(colorproof, TransferredColorProof) for colorproof in colorproofs))
+
+            # Reassembled proofs are identical to the originals
+            colordb2 = PersistentColorProofDb(tmpdir + '/colordb', cache=False)
+            for colorproof in colorproofs:
+                colorproof2 = colordb2.object_store.get(colorproof.hash)
+                self.assertEqual(colorproof2.serialize(), colorproof.serialize())
+                self.assertEqual(colorproof2.calc_hash(), colorproof.hash)
+
+            # Proofs stored in full by earlier versions can still be read
+            colordef = ColorDef(genesis_outpoints={COutPoint(n=1):1})
+            colorproof = GenesisOutPointColorProof(colordef, COutPoint(n=1))
+            colordb2.colordefs.add(colordef)
+
+            legacy_set_path = os.path.join(tmpdir, 'legacy')
+            PersistentColorProofSet(root_dir_path=legacy_set_path).add(colorproof)
+            legacy_set = PersistentColorProofSet(root_dir_path=legacy_set_path,
+                                                 object_store=colordb2.object_store)
+            self.assertEqual([proof.hash for proof in legacy_set], [colorproof.hash])
+            self.assertNotIn(colorproof, colordb2.object_store)
+
+    def test_gc(self):
+        """Garbage collection and compaction"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            colordb = PersistentColorProofDb(tmpdir + '/colordb')
+            check_gc(self, colordb)
+            contents = get_colored_outpoints_contents(colordb)
+
+            # Left behind by a crashed writer
+            tmp_path = os.path.join(tmpdir, 'colordb', 'colordefs', 'crashed-tmp-xyz')
+            with open(tmp_path, 'wb') as fd:
+                fd.write(b'junk')
+            os.utime(tmp_path, (0, 0))
+
+            # Make sure everything predates the compaction
+            n_objects = 0
+            for dir_path, dirnames, filenames in os.walk(tmpdir):
+                for name in dirnames + filenames:
+                    os.utime(os.path.join(dir_path, name), (0, 0))
+                n_objects += sum(1 for filename in filenames if filename.endswith('.scobj'))
+
+            stats = colordb.compact()
+            self.assertEqual(stats['tmp_files'], 1)
+            self.assertFalse(os.path.exists(tmp_path))
+
+            # Only the superseded proof's object was unreachable; the spent
+            # proof is still part of the history of the remaining proofs.
+            self.assertEqual(stats['objects'], 1)
+            self.assertGreater(stats['dirs'], 0)
+
+            colordb2 = PersistentColorProofDb(tmpdir + '/colordb', cache=False)
+            self.assertEqual(get_colored_outpoints_contents(colordb2), contents)
+            self.assertEqual(colordb2.state_hash, colordb.state_hash)
+            for outpoint, colorproofs_by_colordef in colordb2.colored_outpoints.items():
+                for colordef, colorproofs in colorproofs_by_colordef.items():
+                    for colorproof in colorproofs:
+                        self.assertEqual(colorproof.calc_hash(), colorproof.hash)
+
+    def test_addblock(self):
+        """Adding whole blocks"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            colordb = PersistentColorProofDb(tmpdir + '/colordb')
+            check_addblock(self, colordb)
+            colordb.close()
+
+    def test_disconnect_block(self):
+        """Undoing blocks"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            colordb = PersistentColorProofDb(tmpdir + '/colordb', utxo_only=True)
+            check_disconnect_block(self, colordb)
+            colordb.close()
+
+    def test_balance(self):
+        """Colored UTXOs by scriptPubKey"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            colordb = PersistentColorProofDb(tmpdir + '/colordb')
+            check_balance(self, colordb)
+            colordb.close()
+
+    def test_best_colorproofs(self):
+        """Best proof index"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            colordb = PersistentColorProofDb(tmpdir + '/colordb')
+            check_best_colorproofs(self, colordb)
+            colordb.close()
+
+    def test_reindex_spent_outpoints(self):
+        """Spent outpoint index"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            colordb = PersistentColorProofDb(tmpdir + '/colordb')
+            check_reindex_spent_outpoints(self, colordb)
+            colordb.close()
+
+    def test_trace_colordef(self):
+        """Tracing colordefs through the spends index"""
+        check_trace_colordef(self, make_colordb_factory(self, PersistentColorProofDb, index_spends=True))
+
+    def test_diff_state(self):
+        """Localize differences between two dbs"""
+        check_diff_state(self, make_colordb_factory(self, PersistentColorProofDb))
+
+    def test_colordef_stats(self):
+        """Per-colordef statistics"""
+        check_colordef_stats(self, make_colordb_factory(self, PersistentColorProofDb)())
+
+    def test_spends(self):
+        """Spend tracking and utxo_only mode"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            check_spends(self, lambda utxo_only: PersistentColorProofDb(tmpdir + '/colordb', utxo_only=utxo_only))
+
+            # Indexes are migrated along with everything else
+            colordb = PersistentColorProofDb(tmpdir + '/colordb')
+            colordb.spent_outpoints[b'\x01'*36] = b'\x02'*32
+            colordb.state_elems[b'ab' + b'\x05'*32] = b'\x06'
+            colordb.migrate_layout(0)
+            colordb.close()
+            colordb = PersistentColorProofDb(tmpdir + '/colordb')
+            self.assertEqual(dict(colordb.spent_outpoints.items()),
+                             {b'\x01'*36:b'\x02'*32, ColorProofDb.SPENT_OUTPOINTS_COMPLETE_KEY:b''})
+            self.assertEqual(list(colordb.state_elems.iter_prefix(b'ab')), [(b'ab' + b'\x05'*32, b'\x06')])
+            colordb.close()
+
+    def test_concurrent_readers(self):
+        """One writer, and readers reading consistent snapshots"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            colordb_path = tmpdir + '/colordb'
+            writer = PersistentColorProofDb(colordb_path, fsync=False)
+            colordefs = [ColorDef(genesis_outpoints={COutPoint(n=i):i}) for i in range(3)]
+            writer.addcolordef(colordefs[0])
+
+            # Other processes can't open the db for writing
+            result = subprocess.run([sys.executable, '-c',
+                                     'import sys, smartcolors.db; smartcolors.db.PersistentColorProofDb(sys.argv[1])',
+                                     colordb_path],
+                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                    env=dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(smartcolors.__file__))))
+            self.assertNotEqual(result.returncode, 0)
+            self.assertIn(b'ColorProofDbLockedError', result.stderr)
+
+            reader = PersistentColorProofDb(colordb_path, readonly=True)
+            self.assertEqual(reader.state_hash, writer.state_hash)
+            with self.assertRaises(PermissionError):
+                reader.addcolordef(colordefs[1])
+
+            # Changes committed while reading are detected...
+            with self.assertRaises(ColorProofDbConcurrentWriteError):
+                with reader.snapshot():
+                    self.assertEqual(set(reader.colordefs), {colordefs[0]})
+                    writer.addcolordef(colordefs[1])
+
+            # ...and retried by snapshot_read()
+            attempts = []
+            def read(colordb):
+                if not attempts:
+                    writer.addcolordef(colordefs[2])
+                attempts.append(True)
+                return (set(colordb.colordefs), colordb.state_hash)
+
+            self.assertEqual(reader.snapshot_read(read), (set(colordefs), writer.state_hash))
+            self.assertEqual(len(attempts), 2)
+
+            # Readers wait for the writer to finish applying changes
+            writer.write_buffer.begin_update()
+            reader.SNAPSHOT_WAIT_TIMEOUT = 0
+            with self.assertRaises(ColorProofDbConcurrentWriteError):
+                reader.snapshot_read(lambda colordb: None, max_attempts=1)
+            writer.write_buffer.end_update()
+            reader.snapshot_read(lambda colordb: None, max_attempts=1)
+
+            writer.close()
+            reader.close()
+
+class Test_LogColorProofDb(unittest.TestCase):
+    def test(self):
+        """Data-driven tests"""
+        for proof_test in sorted(os.listdir(test_data_path('colorproofdb/'))):
+            if proof_test[0] == '.':
+                continue
+            with tempfile.TemporaryDirectory() as tmpdir:
+                run_proof_test(self, 'colorproofdb/' + proof_test,
+                               LogColorProofDb(tmpdir + '/colordb'))
+
+    def test_reopen(self):
+        """Log is replayed on open"""
+        def get_contents(colordb):
+            return {(outpoint, colordef.hash, colorproof.hash)
+                        for outpoint, colorproofs_by_colordef in colordb.colored_outpoints.items()
+                            for colordef, colorproofs in colorproofs_by_colordef.items()
+                                for colorproof in colorproofs}
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            colordb = LogColorProofDb(tmpdir)
+            colordb.addcolordef(ColorDef(genesis_outpoints={COutPoint():1}))
+            expected_contents = get_contents(colordb)
+            self.assertEqual(len(expected_contents), 1)
+
+            # No checkpoint, so everything is replayed
+            colordb2 = LogColorProofDb(tmpdir)
+            self.assertEqual(get_contents(colordb2), expected_contents)
+            self.assertEqual(colordb2.state_hash, colordb.state_hash)
+
+            # A partially written record is discarded
+            segment_path = os.path.join(tmpdir, '00000000.log')
+            good_size = os.path.getsize(segment_path)
+            with open(segment_path, 'ab') as fd:
+                fd.write(b'\xff\xff\x00\x00garbage')
+
+            colordb3 = LogColorProofDb(tmpdir)
+            self.assertEqual(os.path.getsize(segment_path), good_size)
+            self.assertEqual(get_contents(colordb3), expected_contents)
+            self.assertEqual(colordb3.state_hash, colordb.state_hash)
+
+            # Records added after a checkpoint are replayed on top of it
+            colordb3.checkpoint()
+            colordb3.addcolordef(ColorDef(genesis_outpoints={COutPoint(n=1):2}))
+            expected_contents = get_contents(colordb3)
+            self.assertEqual(len(expected_contents), 2)
+
+            colordb4 = LogColorProofDb(tmpdir)
+            self.assertEqual(get_contents(colordb4), expected_contents)
+            self.assertEqual(colordb4.state_hash, colordb3.state_hash)
+            self.assertEqual(colordb4.state_hash, colordb4.calc_state_commitment().digest())
+
+            # Closing checkpoints everything
+            colordb4.close()
+            colordb5 = LogColorProofDb(tmpdir)
+            self.assertEqual(get_contents(colordb5), expected_contents)
+            self.assertEqual(colordb5.state_hash, colordb3.state_hash)
+
+    def test_batch(self):
+        """Batches are only replayed once committed"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            colordb = LogColorProofDb(tmpdir)
+            colordef1 = ColorDef(genesis_outpoints={COutPoint():1})
+            colordb.addcolordef(colordef1)
+            expected_state_hash = colordb.state_hash
+
+            # Crash part way through a batch, leaving the log as it was then
+            colordef2 = ColorDef(genesis_outpoints={COutPoint(n=1):2, COutPoint(n=2):3})
+            with colordb.batch():
+                colordb.addcolordef(colordef2)
+                self.assertIn(colordef2, colordb.colordefs)
+                shutil.copytree(tmpdir, tmpdir + '/crashed', ignore=shutil.ignore_patterns('crashed'))
+
+            crashed_colordb = LogColorProofDb(tmpdir + '/crashed')
+            self.assertEqual(set(crashed_colordb.colordefs), {colordef1})
+            self.assertEqual(set(crashed_colordb.colored_outpoints), {COutPoint()})
+            self.assertEqual(crashed_colordb.state_hash, expected_state_hash)
+            crashed_colordb.close()
+
+            # Committed batches are replayed
+            expected_state_hash = colordb.state_hash
+            colordb2 = LogColorProofDb(tmpdir)
+            self.assertEqual(set(colordb2.colordefs), {colordef1, colordef2})
+            self.assertEqual(colordb2.state_hash, expected_state_hash)
+            self.assertEqual(colordb2.state_hash, colordb2.calc_state_commitment().digest())
+            colordb2.close()
+
+            # Aborted batches are discarded
+            colordef3 = ColorDef(genesis_outpoints={COutPoint(n=3):4})
+            class Abort(Exception):
+                pass
+            with self.assertRaises(Abort):
+                with colordb.batch():
+                    colordb.addcolordef(colordef3)
+                    raise Abort
+            self.assertEqual(set(colordb.colordefs), {colordef1, colordef2})
+            self.assertEqual(colordb.state_hash, expected_state_hash)
+
+            colordb.addcolordef(colordef3)
+            colordb2 = LogColorProofDb(tmpdir)
+            self.assertEqual(set(colordb2.colordefs), {colordef1, colordef2, colordef3})
+            self.assertEqual(colordb2.state_hash, colordb.state_hash)
+
+    def test_gc(self):
+        """Garbage collection and compaction"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            colordb = LogColorProofDb(tmpdir)
+            check_gc(self, colordb)
+            contents = get_colored_outpoints_contents(colordb)
+
+            # Removals are replayed
+            colordb2 = LogColorProofDb(tmpdir)
+            self.assertEqual(get_colored_outpoints_contents(colordb2), contents)
+            self.assertEqual(colordb2.state_hash, colordb.state_hash)
+
+            stats = colordb.compact()
+            self.assertLess(stats['bytes_after'], stats['bytes_before'])
+            self.assertEqual(os.listdir(tmpdir).count('00000000.log'), 0)
+            self.assertEqual(get_colored_outpoints_contents(colordb), contents)
+
+            # Still usable afterwards
+            colordef = ColorDef(genesis_outpoints={COutPoint(n=1):1})
+            colordb.addcolordef(colordef)
+            contents = get_colored_outpoints_contents(colordb)
+            colordb.close()
+
+            colordb3 = LogColorProofDb(tmpdir)
+            self.assertEqual(get_colored_outpoints_contents(colordb3), contents)
+            self.assertEqual(colordb3.state_hash, colordb3.calc_state_commitment().digest())
+
+            # Without a checkpoint the log is replayed from the first segment
+            colordb3.close()
+            os.unlink(os.path.join(tmpdir, 'checkpoint'))
+            colordb4 = LogColorProofDb(tmpdir)
+            self.assertEqual(get_colored_outpoints_contents(colordb4), contents)
+            self.assertEqual(colordb4.state_hash, colordb3.state_hash)
+            colordb4.close()
+
+    def test_addblock(self):
+        """Adding whole blocks"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            colordb = LogColorProofDb(tmpdir)
+            check_addblock(self, colordb)
+            colordb.close()
+
+    def test_disconnect_block(self):
+        """Undoing blocks"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            colordb = LogColorProofDb(tmpdir, utxo_only=True)
+            check_disconnect_block(self, colordb)
+            colordb.close()
+
+    def test_balance(self):
+        """Colored UTXOs by scriptPubKey"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            colordb = LogColorProofDb(tmpdir)
+            check_balance(self, colordb)
+            colordb.close()
+
+    def test_best_colorproofs(self):
+        """Best proof index"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            colordb = LogColorProofDb(tmpdir)
+            check_best_colorproofs(self, colordb)
+            colordb.close()
+
+    def test_reindex_spent_outpoints(self):
+        """Spent outpoint index"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            colordb = LogColorProofDb(tmpdir)
+            check_reindex_spent_outpoints(self, colordb)
+            colordb.close()
+
+    def test_trace_colordef(self):
+        """Tracing colordefs through the spends index"""
+        check_trace_colordef(self, make_colordb_factory(self, LogColorProofDb, index_spends=True))
+
+    def test_diff_state(self):
+        """Localize differences between two dbs"""
+        check_diff_state(self, make_colordb_factory(self, LogColorProofDb))
+
+    def test_colordef_stats(self):
+        """Per-colordef statistics"""
+        check_colordef_stats(self, make_colordb_factory(self, LogColorProofDb)())
+
+    def test_spends(self):
+        """Spend tracking and utxo_only mode"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            check_spends(self, lambda utxo_only: LogColorProofDb(tmpdir, utxo_only=utxo_only))
+
+            # Indexes survive checkpointing and compaction
+            colordb = LogColorProofDb(tmpdir)
+            colordb.spent_outpoints[b'\x01'*36] = b'\x02'*32
+            colordb.state_elems[b'ab' + b'\x05'*32] = b'\x06'
+            colordb.checkpoint()
+            colordb.spent_outpoints[b'\x03'*36] = b'\x04'*32
+            colordb.compact()
+            del colordb.spent_outpoints[b'\x03'*36]
+            colordb.close()
+
+            colordb = LogColorProofDb(tmpdir)
+            self.assertEqual(dict(colordb.spent_outpoints.items()),
+                             {b'\x01'*36:b'\x02'*32, ColorProofDb.SPENT_OUTPOINTS_COMPLETE_KEY:b''})
+            self.assertEqual(list(colordb.state_elems.iter_prefix(b'ab')), [(b'ab' + b'\x05'*32, b'\x06')])
+            colordb.close()
+
+    def test_compact_interrupted(self):
+        """Interrupted compactions are finished or discarded on open"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            colordb = LogColorProofDb(tmpdir)
+            check_gc(self, colordb)
+            contents = get_colored_outpoints_contents(colordb)
+            state_hash = colordb.state_hash
+
+            # Interrupted before the commit point
+            def crash():
+                raise KeyboardInterrupt
+            colordb._write_checkpoint = lambda checkpoint_path: crash()
+            with self.assertRaises(KeyboardInterrupt):
+                colordb.compact()
+
+            colordb2 = LogColorProofDb(tmpdir)
+            self.assertFalse([filename for filename in os.listdir(tmpdir) if filename.endswith('.compact')])
+            self.assertEqual(get_colored_outpoints_contents(colordb2), contents)
+            self.assertEqual(colordb2.state_hash, state_hash)
+
+            # Interrupted after the commit point
+            colordb2._recover_compaction = crash
+            with self.assertRaises(KeyboardInterrupt):
+                colordb2.compact()
+
+            colordb3 = LogColorProofDb(tmpdir)
+            self.assertNotIn('compacting', os.listdir(tmpdir))
+            self.assertNotIn('00000000.log', os.listdir(tmpdir))
+            self.assertEqual(get_colored_outpoints_contents(colordb3), contents)
+            self.assertEqual(colordb3.state_hash, state_hash)
+            colordb3.close()
+
+    def test_readonly(self):
+        """Read-only dbs don't modify the log"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            writer = LogColorProofDb(tmpdir)
+            writer.addcolordef(ColorDef(genesis_outpoints={COutPoint():1}))
+            contents = get_colored_outpoints_contents(writer)
+
+            # Possibly still being written
+            segment_path = os.path.join(tmpdir, '00000000.log')
+            with open(segment_path, 'ab') as fd:
+                fd.write(b'\xff\xff\x00\x00partial')
+            size = os.path.getsize(segment_path)
+
+            reader = LogColorProofDb(tmpdir, readonly=True)
+            self.assertEqual(os.path.getsize(segment_path), size)
+            self.assertEqual(get_colored_outpoints_contents(reader), contents)
+            self.assertEqual(reader.state_hash, writer.state_hash)
+
+            with self.assertRaises(PermissionError):
+                reader.addcolordef(ColorDef(genesis_outpoints={COutPoint(n=1):1}))
+            reader.close()
+
+    def test_readonly_compacted(self):
+        """Readers reindex the log after it's compacted"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            writer = LogColorProofDb(tmpdir)
+            colordefs = {ColorDef(genesis_outpoints={COutPoint(n=i):1}) for i in range(3)}
+            for colordef in colordefs:
+                writer.addcolordef(colordef)
+            writer.checkpoint()
+
+            reader = LogColorProofDb(tmpdir, readonly=True)
+
+            writer.compact()
+            self.assertFalse(os.path.exists(os.path.join(tmpdir, '00000000.log')))
+            self.assertEqual(reader.snapshot_read(lambda colordb: set(colordb.colordefs)), colordefs)
+
+            reader.close()
+
+            # Compacted part way through a read, which is retried
+            reader = LogColorProofDb(tmpdir, readonly=True)
+            attempts = 0
+            def read(colordb):
+                nonlocal attempts
+                attempts += 1
+                if attempts == 1:
+                    writer.compact()
+                return (set(colordb.colordefs), colordb.state_hash)
+            self.assertEqual(reader.snapshot_read(read), (colordefs, writer.state_hash))
+            self.assertEqual(attempts, 2)
+
+            reader.close()
+            writer.close()
+
+class Test_SqliteColorProofDb(unittest.TestCase):
+    def test(self):
+        """Data-driven tests"""
+        for proof_test in sorted(os.listdir(test_data_path('colorproofdb/'))):
+            if proof_test[0] == '.':
+                continue
+            with tempfile.TemporaryDirectory() as tmpdir:
+                colordb = SqliteColorProofDb(tmpdir + '/colordb')
+                run_proof_test(self, 'colorproofdb/' + proof_test, colordb)
+                colordb.close()
+
+    def test_batch(self):
+        """Batches are committed atomically"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            colordb = SqliteColorProofDb(tmpdir)
+            empty_state_hash = colordb.state_hash
+
+            colordef1 = ColorDef(genesis_outpoints={COutPoint():1})
+            colordef2 = ColorDef(genesis_outpoints={COutPoint(n=1):2})
+
+            class Abort(Exception):
+                pass
+
+            with self.assertRaises(Abort):
+                with colordb.batch():
+                    colordb.addcolordef(colordef1)
+                    with colordb.batch():
+                        colordb.addcolordef(colordef2)
+                    self.assertIn(colordef2, colordb.colordefs)
+                    raise Abort
+
+            self.assertNotIn(colordef1, colordb.colordefs)
+            self.assertNotIn(colordef2, colordb.colordefs)
+            self.assertNotIn(COutPoint(), colordb.colored_outpoints)
+            self.assertEqual(colordb.state_hash, empty_state_hash)
+
+            with colordb.batch():
+                colordb.addcolordef(colordef1)
+                colordb.addcolordef(colordef2)
+            colordb.close()
+
+            colordb2 = SqliteColorProofDb(tmpdir)
+            self.assertEqual(set(colordb2.colordefs), {colordef1, colordef2})
+            self.assertEqual(colordb2.state_hash, colordb2.calc_state_commitment().digest())
+            colordb2.close()
+
+    def test_gc(self):
+        """Garbage collection and compaction"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            colordb = SqliteColorProofDb(tmpdir)
+            check_gc(self, colordb)
+            contents = get_colored_outpoints_contents(colordb)
+
+            stats = colordb.compact()
+            self.assertIn('bytes_after', stats)
+            self.assertEqual(get_colored_outpoints_contents(colordb), contents)
+            colordb.close()
+
+            colordb2 = SqliteColorProofDb(tmpdir)
+            self.assertEqual(get_colored_outpoints_contents(colordb2), contents)
+            self.assertEqual(colordb2.state_hash, colordb2.calc_state_commitment().digest())
+            colordb2.close()
+
+    def test_addblock(self):
+        """Adding whole blocks"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            colordb = SqliteColorProofDb(tmpdir)
+            check_addblock(self, colordb)
+            colordb.close()
+
+    def test_disconnect_block(self):
+        """Undoing blocks"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            colordb = SqliteColorProofDb(tmpdir, utxo_only=True)
+            check_disconnect_block(self, colordb)
+            colordb.close()
+
+    def test_balance(self):
+        """Colored UTXOs by scriptPubKey"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            colordb = SqliteColorProofDb(tmpdir)
+            check_balance(self, colordb)
+            colordb.close()
+
+    def test_best_colorproofs(self):
+        """Best proof index"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            colordb = SqliteColorProofDb(tmpdir)
+            check_best_colorproofs(self, colordb)
+            colordb.close()
+
+    def test_reindex_spent_outpoints(self):
+        """Spent outpoint index"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            colordb = SqliteColorProofDb(tmpdir)
+            check_reindex_spent_outpoints(self, colordb)
+            colordb.close()
+
+    def test_trace_colordef(self):
+        """Tracing colordefs through the spends index"""
+        check_trace_colordef(self, make_colordb_factory(self, SqliteColorProofDb, index_spends=True))
+
+    def test_diff_state(self):
+        """Localize differences between two dbs"""
+        check_diff_state(self, make_colordb_factory(self, SqliteColorProofDb))
+
+    def test_colordef_stats(self):
+        """Per-colordef statistics"""
+        check_colordef_stats(self, make_colordb_factory(self, SqliteColorProofDb)())
+
+    def test_spends(self):
+        """Spend tracking and utxo_only mode"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            check_spends(self, lambda utxo_only: SqliteColorProofDb(tmpdir, utxo_only=utxo_only))
+
+    def test_snapshot(self):
+        """Readers see a single version of the db"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            colordef1 = ColorDef(genesis_outpoints={COutPoint():1})
+            colordef2 = ColorDef(genesis_outpoints={COutPoint(n=1):2})
+
+            writer = SqliteColorProofDb(tmpdir)
+            writer.addcolordef(colordef1)
+            state_hash = writer.state_hash
+
+            reader = SqliteColorProofDb(tmpdir, readonly=True)
+            with reader.snapshot():
+                self.assertEqual(reader.state_hash, state_hash)
+                writer.addcolordef(colordef2)
+                self.assertEqual(set(reader.colordefs), {colordef1})
+                self.assertEqual(reader.state_hash, state_hash)
+
+            self.assertEqual(reader.snapshot_read(lambda colordb: (set(colordb.colordefs), colordb.state_hash)),
+                             ({colordef1, colordef2}, writer.state_hash))
+
+            with self.assertRaises(sqlite3.OperationalError):
+                reader.addcolordef(ColorDef(genesis_outpoints={COutPoint(n=2):3}))
+
+            writer.close()
+            reader.close()
@@ -0,0 +1,210 @@
+# Copyright (C) 2014 Peter Todd <pete@petertodd.org>
+#
+# This file is part of python-smartcolors.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of python-smartcolors, including this file, may be copied, modified,
+# propagated, or distributed except according to the terms contained in the
+# LICENSE file.
+
+import io
+import os
+import tempfile
+import unittest
+import unittest.mock
+
+import proofmarshal
+
+from bitcoin.core import *
+from bitcoin.core.script import CScript
+from smartcolors.core import *
+from smartcolors.core.db import ColorProofDb
+from smartcolors.db import PersistentColorProofDb
+from smartcolors.io import *
+
+class Test_FileSerializer(unittest.TestCase):
+    def make_proof(self):
+        outpoint = COutPoint(b'\xaa'*32, n=0)
+        cdef = ColorDef(genesis_outpoints={outpoint:42})
+        genesis_cproof = GenesisOutPointColorProof(cdef, outpoint)
+
+        tx = CTransaction([CTxIn(genesis_cproof.outpoint,
+                                 nSequence=(0xFE | (0xFFFFFF00 & (0x00030000 ^ cdef.nSequence_pad(genesis_cproof.outpoint)))))],
+                          [CTxOut(21 << 1), CTxOut(21 << 1)])
+        return TransferredColorProof(cdef, COutPoint(tx.GetHash(), 0), tx,
+                                     {genesis_cproof.outpoint:genesis_cproof})
+
+    def test_buffer_and_file_deserialize(self):
+        """Buffer and mmap deserialization match stream deserialization"""
+        cproof = self.make_proof()
+
+        fd = io.BytesIO()
+        ColorProofFileSerializer.stream_serialize(cproof, fd)
+        buf = fd.getvalue()
+
+        self.assertEqual(ColorProofFileSerializer.buffer_deserialize(buf), cproof)
+
+        with tempfile.TemporaryFile() as fd:
+            fd.write(buf)
+            fd.flush()
+            fd.seek(0)
+            self.assertEqual(ColorProofFileSerializer.file_deserialize(fd), cproof)
+
+        # Files that can't be mmapped are read as streams
+        r, w = os.pipe()
+        with os.fdopen(r, 'rb') as r_fd:
+            with os.fdopen(w, 'wb') as w_fd:
+                w_fd.write(buf)
+            self.assertEqual(ColorProofFileSerializer.file_deserialize(r_fd), cproof)
+
+        with tempfile.TemporaryFile() as fd:
+            with self.assertRaises(proofmarshal.DataTruncatedError):
+                ColorProofFileSerializer.file_deserialize(fd)
+
+    def test_bad_magic(self):
+        with self.assertRaises(proofmarshal.DeserializationError):
+            ColorDefFileSerializer.buffer_deserialize(b'\x00'*100)
+
+    def test_default_limits(self):
+        """Files are deserialized with limits unless told otherwise"""
+        cproof = self.make_proof()
+
+        fd = io.BytesIO()
+        ColorProofFileSerializer.stream_serialize(cproof, fd)
+        buf = fd.getvalue()
+
+        with unittest.mock.patch.object(DEFAULT_FILE_LIMITS, 'max_total_bytes', len(buf) - 1):
+            with self.assertRaises(proofmarshal.DeserializationLimitError):
+                ColorProofFileSerializer.buffer_deserialize(buf)
+            with self.assertRaises(proofmarshal.DeserializationLimitError):
+                ColorProofFileSerializer.stream_deserialize(io.BytesIO(buf))
+
+            self.assertEqual(ColorProofFileSerializer.buffer_deserialize(buf, limits=None), cproof)
+
+class Test_ColorProofDbSnapshotSerializer(unittest.TestCase):
+    def make_colordb(self):
+        outpoint = COutPoint(b'\xaa'*32, n=0)
+        cdef = ColorDef(genesis_outpoints={outpoint:42, COutPoint(b'\xbb'*32, n=1):2})
+
+        colordb = ColorProofDb()
+        colordb.addcolordef(cdef)
+        colordb.addtx(CTransaction([CTxIn(outpoint,
+                                          nSequence=(0xFE | (0xFFFFFF00 & (0x00030000 ^ cdef.nSequence_pad(outpoint)))))],
+                                   [CTxOut(21 << 1), CTxOut(21 << 1)]))
+
+        # The spent genesis proof remains part of the history of the
+        # transferred proofs, but isn't a colored outpoint any more.
+        colordb.gc(spent=True)
+        return colordb
+
+    @staticmethod
+    def get_contents(colordb):
+        return {(outpoint, colordef.hash, colorproof.hash)
+                    for outpoint, colorproofs_by_colordef in colordb.colored_outpoints.items()
+                        for colordef, colorproofs in colorproofs_by_colordef.items()
+                            for colorproof in colorproofs}
+
+    def test_roundtrip(self):
+        colordb = self.make_colordb()
+        colordb.spent_outpoints[b'\x01'*36] = b'\x02'*32
+
+        fd = io.BytesIO()
+        self.assertEqual(ColorProofDbSnapshotSerializer.stream_serialize(colordb, fd), 4)
+
+        # Quantities are recalculated, once per transferred proof
+        fd.seek(0)
+        with unittest.mock.patch.object(ColorDef, 'apply_kernel', autospec=True,
+                                        side_effect=ColorDef.apply_kernel) as apply_kernel:
+            colordb2 = ColorProofDbSnapshotSerializer.stream_deserialize(fd, ColorProofDb())
+        self.assertEqual(apply_kernel.call_count, 2)
+        self.assertEqual(colordb2.state_hash, colordb.state_hash)
+        self.assertEqual(self.get_contents(colordb2), self.get_contents(colordb))
+        self.assertEqual(set(colordb2.genesis_outpoints), set(colordb.genesis_outpoints))
+        self.assertEqual(len(self.get_contents(colordb2)), 3)
+        self.assertEqual(colordb2.spent_outpoints, {b'\x01'*36:b'\x02'*32,
+                                                    ColorProofDb.SPENT_OUTPOINTS_COMPLETE_KEY:b''})
+
+        # Imported in more than one batch
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fd.seek(0)
+            colordb3 = PersistentColorProofDb(tmpdir + '/colordb')
+            class SmallBatchSnapshotSerializer(ColorProofDbSnapshotSerializer):
+                IMPORT_BATCH_SIZE = 2
+            SmallBatchSnapshotSerializer.stream_deserialize(fd, colordb3)
+            colordb3.close()
+
+            colordb3 = PersistentColorProofDb(tmpdir + '/colordb')
+            self.addCleanup(colordb3.close)
+            self.assertEqual(colordb3.state_hash, colordb.state_hash)
+            self.assertEqual(self.get_contents(colordb3), self.get_contents(colordb))
+            self.assertEqual(dict(colordb3.spent_outpoints.items()), colordb.spent_outpoints)
+
+    def test_roundtrip_small_window(self):
+        """Proofs referred to again outside the window are written again"""
+        colordb = self.make_colordb()
+
+        class SmallWindowSnapshotSerializer(ColorProofDbSnapshotSerializer):
+            PROOF_WINDOW = 1
+
+        fd = io.BytesIO()
+        self.assertEqual(SmallWindowSnapshotSerializer.stream_serialize(colordb, fd), 4)
+        fd2 = io.BytesIO()
+        ColorProofDbSnapshotSerializer.stream_serialize(colordb, fd2)
+        self.assertGreater(len(fd.getvalue()), len(fd2.getvalue()))
+
+        fd.seek(0)
+        colordb2 = SmallWindowSnapshotSerializer.stream_deserialize(fd, ColorProofDb())
+        self.assertEqual(colordb2.state_hash, colordb.state_hash)
+        self.assertEqual(self.get_contents(colordb2), self.get_contents(colordb))
+
+    def test_roundtrip_spent(self):
+        """Spent colored outputs aren't in the imported balances"""
+        outpoint = COutPoint(b'\xaa'*32, n=0)
+        cdef = ColorDef(genesis_outpoints={outpoint:42})
+
+        def make_tx(outpoint, *txouts):
+            return CTransaction([CTxIn(outpoint,
+                                       nSequence=(0xFE | (0xFFFFFF00 & (0x00030000 ^ cdef.nSequence_pad(outpoint)))))],
+                                txouts)
+
+        colordb = ColorProofDb()
+        colordb.addcolordef(cdef)
+        tx1 = make_tx(outpoint, CTxOut(21 << 1, CScript([1])), CTxOut(21 << 1, CScript([2])))
+        colordb.addtx(tx1)
+        colordb.addtx(make_tx(COutPoint(tx1.GetHash(), 0), CTxOut(21 << 1, CScript([3]))))
+        self.assertEqual(colordb.get_balance(CScript([1])), {})
+
+        fd = io.BytesIO()
+        ColorProofDbSnapshotSerializer.stream_serialize(colordb, fd)
+
+        for make_colordb in (ColorProofDb, lambda: PersistentColorProofDb(tmpdir + '/colordb')):
+            with tempfile.TemporaryDirectory() as tmpdir:
+                fd.seek(0)
+                colordb2 = ColorProofDbSnapshotSerializer.stream_deserialize(fd, make_colordb())
+                self.assertEqual(colordb2.state_hash, colordb.state_hash)
+                for scriptPubKey in (CScript([1]), CScript([2]), CScript([3])):
+                    self.assertEqual(colordb2.get_balance(scriptPubKey), colordb.get_balance(scriptPubKey))
+                self.assertTrue(colordb2.is_spent(COutPoint(tx1.GetHash(), 0)))
+                for index_name in ColorProofDb.INDEX_NAMES:
+                    self.assertEqual(dict(getattr(colordb2, index_name).items()),
+                                     dict(getattr(colordb, index_name).items()))
+                colordb2.close()
+
+    def test_corrupt(self):
+        colordb = self.make_colordb()
+
+        fd = io.BytesIO()
+        ColorProofDbSnapshotSerializer.stream_serialize(colordb, fd)
+        snapshot = fd.getvalue()
+
+        for i in (50, len(snapshot) - 100, len(snapshot) - 1):
+            corrupt_snapshot = bytearray(snapshot)
+            corrupt_snapshot[i] ^= 0x01
+            with self.assertRaises(Exception):
+                ColorProofDbSnapshotSerializer.stream_deserialize(io.BytesIO(bytes(corrupt_snapshot)),
+                                                                  ColorProofDb())
+
+        with self.assertRaises(proofmarshal.DataTruncatedError):
+            ColorProofDbSnapshotSerializer.stream_deserialize(io.BytesIO(snapshot[:-40]), ColorProofDb())
@@ -0,0 +1,99 @@
+# Copyright (C) 2014 Peter Todd <pete@petertodd.org>
+#
+# This file is part of python-smartcolors.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of python-smartcolors, including this file, may be copied, modified,
+# propagated, or distributed except according to the terms contained in the
+# LICENSE file.
+
+import unittest
+
+from bitcoin.core import *
+from bitcoin.core.script import CScript
+from smartcolors.core import *
+from smartcolors.core.db import ColorProofDb
+from smartcolors.core.tracer import *
+
+class Test_ColorTracer(unittest.TestCase):
+    def setUp(self):
+        genesis_outpoint = COutPoint(b'\xaa'*32, n=0)
+        self.colordef = ColorDef(genesis_outpoints={genesis_outpoint:42, COutPoint(b'\xbb'*32, n=1):2},
+                                 genesis_scriptPubKeys=[CScript([3])])
+
+        def make_tx(outpoints, *txouts):
+            return CTransaction([CTxIn(outpoint,
+                                       nSequence=(0xFE | (0xFFFFFF00 & (0x00030000 ^ self.colordef.nSequence_pad(outpoint)))))
+                                    for outpoint in outpoints],
+                                txouts)
+
+        tx1 = make_tx([genesis_outpoint], CTxOut(21 << 1, CScript([1])), CTxOut(21 << 1, CScript([3])))
+        tx2 = make_tx([COutPoint(tx1.GetHash(), 0)], CTxOut(21 << 1, CScript([2])))
+        tx3 = make_tx([COutPoint(tx2.GetHash(), 0), COutPoint(tx1.GetHash(), 1)],
+                      CTxOut(40 << 1, CScript([4])), CTxOut(2 << 1, CScript([5])))
+        self.unrelated_tx = make_tx([COutPoint(b'\xcc'*32, n=0)], CTxOut(1 << 1, CScript([1])))
+        self.blocks = [CBlock(vtx=[tx1]),
+                       CBlock(vtx=[self.unrelated_tx, tx2, tx3])]
+
+        # The spends index a db scanning the blocks would have
+        self.spends = {}
+        self.txs = {}
+        for height, block in enumerate(self.blocks):
+            for index, tx in enumerate(block.vtx):
+                self.txs[tx.GetHash()] = tx
+                for txin in tx.vin:
+                    self.spends[txin.prevout] = (tx.GetHash(), height, index)
+
+    def get_tx(self, txid, height, index):
+        self.assertEqual(self.blocks[height].vtx[index].GetHash(), txid)
+        return self.txs[txid]
+
+    def test_colored_outpoints(self):
+        """Same colored outputs as scanning every block"""
+        tracer = ColorTracer(self.colordef, self.spends.get, self.get_tx)
+        colorproofs = list(tracer.trace())
+
+        colordb = ColorProofDb(utxo_only=True)
+        colordb.addcolordef(self.colordef)
+        for height, block in enumerate(self.blocks):
+            colordb.addblock(block, height)
+
+        self.assertEqual(tracer.colored_outpoints,
+                         {outpoint:colordb.get_best_colorproofs(outpoint)[self.colordef]
+                             for outpoint in colordb.colored_outpoints})
+
+        # Every proof of every reached output was emitted, the genesis
+        # scriptPubKey output having two
+        self.assertEqual(len(colorproofs), 6)
+        self.assertEqual(sum(isinstance(colorproof, TransferredColorProof) for colorproof in colorproofs), 5)
+        for colorproof in colorproofs:
+            colorproof.validate()
+
+    def test_stats(self):
+        """Only spends of colored outputs are traced"""
+        def get_tx(txid, height, index):
+            self.assertNotEqual(txid, self.unrelated_tx.GetHash())
+            return self.get_tx(txid, height, index)
+
+        tracer = ColorTracer(self.colordef, self.spends.get, get_tx)
+        self.assertEqual([tx.GetHash() for tx, height, index, prevout_proofs, colorproofs in tracer.iter_txs()],
+                         [tx.GetHash() for tx in self.blocks[0].vtx + self.blocks[1].vtx[1:]])
+
+        self.assertEqual(tracer.stats.txs, 3)
+        self.assertEqual(tracer.stats.kernel_applications, 3)
+        self.assertEqual(tracer.stats.colorproofs, 6)
+
+        # Two genesis outpoints, and the five outputs reached
+        self.assertEqual(tracer.stats.spend_lookups, 7)
+
+        # tx2 and tx3 are both waiting once tx1 is traced
+        self.assertEqual(tracer.stats.max_frontier, 2)
+
+    def test_untraced(self):
+        """Without any spends only the genesis outpoints are colored"""
+        tracer = ColorTracer(self.colordef, lambda outpoint: None, self.get_tx)
+        self.assertEqual(list(tracer.trace()), [])
+        self.assertEqual(set(tracer.colored_outpoints), set(self.colordef.genesis_outpoints))
+        self.assertEqual(tracer.stats.txs, 0)